@@ -0,0 +1,307 @@
+import asyncio
+import io
+import itertools
+import multiprocessing
+import os
+import pickle
+import socket
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict
+
+from agent_sync_arguments import EMPTY_HISTORY, Agent, Answer, History, MultiAgentSystem, QueryContext, Term
+
+COORDINATOR = 0
+
+
+class PipeTransport:
+    """
+    Connects every pair of processes of a runtime with a duplex multiprocessing pipe.
+    """
+
+    def __init__(self):
+        self.pipes = dict()
+
+    def prepare(self, process_count: int):
+        self.pipes = {(i, j): multiprocessing.Pipe(duplex=True)
+                      for i in range(process_count) for j in range(i + 1, process_count)}
+
+    def connect(self, index: int, process_count: int) -> Dict[int, Connection]:
+        connections = dict()
+        for (i, j), (conn_i, conn_j) in self.pipes.items():
+            if i == index:
+                connections[j] = conn_i
+            elif j == index:
+                connections[i] = conn_j
+        return connections
+
+
+class SocketTransport:
+    """
+    Connects every pair of processes of a runtime with a local socket (AF_UNIX by default, or AF_INET).
+    Each process listens on its own address; process i connects to every process j < i and accepts the others.
+    """
+
+    def __init__(self, family: str = "AF_UNIX", authkey: bytes = None):
+        self.family = family
+        self.authkey = authkey if authkey is not None else os.urandom(16)
+        self.listeners = list()
+
+    def prepare(self, process_count: int):
+        address = ("localhost", 0) if self.family == "AF_INET" else None
+        self.listeners = [Listener(address, family=self.family, authkey=self.authkey)
+                          for _ in range(process_count)]
+
+    def connect(self, index: int, process_count: int) -> Dict[int, Connection]:
+        connections = dict()
+        for j in range(index):
+            conn = Client(self.listeners[j].address, family=self.family, authkey=self.authkey)
+            conn.send(index)
+            connections[j] = conn
+        for _ in range(index + 1, process_count):
+            conn = self.listeners[index].accept()
+            connections[conn.recv()] = conn
+        if self.family == "AF_INET":
+            for conn in connections.values():
+                self._disable_nagle(conn)
+        return connections
+
+    @staticmethod
+    def _disable_nagle(conn: Connection):
+        # queries and answers are small request/response messages, delaying them only adds latency
+        sock = socket.fromfd(conn.fileno(), socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        finally:
+            sock.close()
+
+
+class MessageCodec:
+    """
+    Pickles the messages exchanged by the runtime. Agents are sent by id and resolved on arrival to the agent
+    (local or proxy) with that id in the receiving process, so terms, contexts and argument trees never drag
+    a whole agent or system along.
+    """
+
+    def __init__(self, system: MultiAgentSystem):
+        self.system = system
+
+    def dumps(self, message) -> bytes:
+        buffer = io.BytesIO()
+        pickler = pickle.Pickler(buffer, pickle.HIGHEST_PROTOCOL)
+        pickler.persistent_id = self._persistent_id
+        pickler.dump(message)
+        return buffer.getvalue()
+
+    def loads(self, data: bytes):
+        unpickler = pickle.Unpickler(io.BytesIO(data))
+        unpickler.persistent_load = self._persistent_load
+        return unpickler.load()
+
+    def _persistent_id(self, obj):
+        if isinstance(obj, Agent):
+            return obj.id
+        return None
+
+    def _persistent_load(self, agent_id):
+        return self.system.agents[agent_id]
+
+
+class RuntimeNode:
+    """
+    Message loop of one process of the runtime. Serves the queries addressed to the agents it hosts and
+    forwards the queries addressed to remote agents, without blocking while waiting for their answers.
+    """
+
+    def __init__(self, index: int, system: MultiAgentSystem, connections: Dict[int, Connection]):
+        self.index = index
+        self.system = system
+        self.connections = connections
+        self.codec = MessageCodec(system)
+        self.loop = asyncio.new_event_loop()
+        self.pending = dict()
+        self.request_id_generator = itertools.count()
+        self.stopped = None
+
+    def start(self):
+        for peer, conn in self.connections.items():
+            self.loop.add_reader(conn.fileno(), self._on_readable, peer, conn)
+
+    def close(self):
+        for conn in self.connections.values():
+            self.loop.remove_reader(conn.fileno())
+            conn.close()
+        self.loop.close()
+
+    def send(self, peer: int, message):
+        self.connections[peer].send_bytes(self.codec.dumps(message))
+
+    async def request_query(self, owner: int, agent_id, sender: Agent, term: Term, context: QueryContext,
+                            hist: History):
+        request_id = next(self.request_id_generator)
+        future = self.loop.create_future()
+        self.pending[request_id] = future
+        self.send(owner, ("query", request_id, agent_id, sender, term, context, hist))
+        (equivalent_term, truth_value, arg_tree), spent = await future
+        # the copy of the context the query was served under spent messages (and budget) of its own
+        context.add_spent(spent)
+        return Answer(term, context, equivalent_term, truth_value, arg_tree)
+
+    def serve_forever(self):
+        self.stopped = self.loop.create_future()
+        self.loop.run_until_complete(self.stopped)
+
+    def _on_readable(self, peer: int, conn: Connection):
+        try:
+            message = self.codec.loads(conn.recv_bytes())
+        except EOFError:
+            self.loop.remove_reader(conn.fileno())
+            return
+        kind = message[0]
+        if kind == "query":
+            self.loop.create_task(self._serve_query(peer, *message[1:]))
+        elif kind == "answer":
+            _, request_id, result = message
+            self.pending.pop(request_id).set_result(result)
+        elif kind == "error":
+            _, request_id, error = message
+            self.pending.pop(request_id).set_exception(error)
+        elif kind == "end_context":
+            _, agent_id, context = message
+            self.system.agents[agent_id].end_query_context(context)
+            self.system.literal_directory.end_query_context(context)
+            self.system.cycle_analysis.end_query_context(context)
+            # the proxies built their extended rules here to match terms and analyse cycles
+            for agent in self.system.agents.values():
+                if agent.is_remote:
+                    agent.extended_rules_by_context.pop(context.id, None)
+        elif kind == "stop" and self.stopped is not None and not self.stopped.done():
+            self.stopped.set_result(None)
+
+    async def _serve_query(self, peer: int, request_id, agent_id, sender, term, context, hist):
+        spent = context.spent()
+        try:
+            answer = await self.system.agents[agent_id].aquery(sender, term, context, hist)
+        except Exception as error:
+            self.send(peer, ("error", request_id, RuntimeError("agent {} failed: {!r}".format(agent_id, error))))
+            return
+        self.send(peer, ("answer", request_id, ((answer.equivalent_term, answer.truth_value, answer.argument),
+                                                context.spent_since(spent))))
+
+
+class RemoteAgent(Agent):
+    """
+    Proxy for an agent hosted by another process of the runtime. It keeps the query contract of Agent:
+    `aquery` forwards the query through the local node, and `query` does the same for callers outside
+    an event loop (e.g. the coordinator).
+    Given the agent it stands for (origin), as copied into this process when the workers were forked, it knows
+    its rules: the agents able to answer a term and the answers that do not depend on the order the agents are
+    asked in are then found here, as with local agents. Its terms keep the origin as definer, like the terms of
+    the rules of the other agents.
+    """
+    is_remote = True
+
+    def __init__(self, id_, system: MultiAgentSystem, node: RuntimeNode, owner: int, origin: Agent = None):
+        super().__init__(id_, system)
+        self.node = node
+        self.owner = owner
+        self.origin = origin
+        if origin is not None:
+            self.load_rules(origin.rules)
+
+    @property
+    def rules_known(self) -> bool:
+        return self.origin is not None
+
+    def convert_term_to_local(self, term: Term) -> Term:
+        return Term(self.origin if self.origin is not None else self, term.literal)
+
+    def query(self, sender: Agent, term: Term, context: QueryContext, hist: History = EMPTY_HISTORY):
+        return self.node.loop.run_until_complete(self.aquery(sender, term, context, hist))
+
+    async def aquery(self, sender: Agent, term: Term, context: QueryContext, hist: History = EMPTY_HISTORY):
+        return await self.node.request_query(self.owner, self.id, sender, term, context, hist)
+
+    def iquery(self, sender: Agent, term: Term, context: QueryContext, hist: History = EMPTY_HISTORY):
+        # the remote agent answers as a whole, so its step of the iterative engine is a single one
+        return self.query(sender, term, context, hist)
+        yield
+
+    def end_query_context(self, context: QueryContext):
+        self.extended_rules_by_context.pop(context.id, None)
+        self.node.send(self.owner, ("end_context", self.id, context))
+
+
+def _replace_remote_agents(system: MultiAgentSystem, node: RuntimeNode, placement: Dict[str, int]):
+    system.agents = {
+        agent_id: agent if placement[agent_id] == node.index else RemoteAgent(agent_id, system, node,
+                                                                              placement[agent_id], agent)
+        for agent_id, agent in system.agents.items()
+    }
+
+
+def _run_worker(index: int, system: MultiAgentSystem, placement: Dict[str, int], transport, process_count: int):
+    node = RuntimeNode(index, system, transport.connect(index, process_count))
+    _replace_remote_agents(system, node, placement)
+    node.start()
+    try:
+        node.serve_forever()
+    finally:
+        node.close()
+
+
+class ProcessRuntime:
+    """
+    Runs the agents of a system in worker processes. While the runtime is started, `system.agents` holds
+    proxies, so `initialize_query` (or `MultiAgentSystem.aquery`) is used exactly as with local agents.
+    Workers use the async engine, so queries broadcast to agents of different workers run in parallel when
+    their answers do not depend on the order the agents are asked in (see CycleAnalysis.aasks_together).
+
+    Workers are forked, so the system (including its similarity function) does not need to be picklable.
+    """
+
+    def __init__(self, system: MultiAgentSystem, worker_count: int = None, placement: Dict[str, int] = None,
+                 transport=None):
+        self.system = system
+        if placement is None:
+            worker_count = worker_count or min(os.cpu_count() or 1, max(len(system.agents), 1))
+            placement = {agent_id: 1 + position % worker_count
+                         for position, agent_id in enumerate(system.agents)}
+        self.placement = placement
+        self.worker_count = max(placement.values(), default=0)
+        self.transport = transport if transport is not None else PipeTransport()
+        self.local_agents = None
+        self.node = None
+        self.workers = list()
+
+    def start(self):
+        process_count = self.worker_count + 1
+        self.transport.prepare(process_count)
+        context = multiprocessing.get_context("fork")
+        self.workers = [
+            context.Process(target=_run_worker, args=(index, self.system, self.placement, self.transport,
+                                                      process_count), daemon=True)
+            for index in range(1, process_count)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+        self.node = RuntimeNode(COORDINATOR, self.system, self.transport.connect(COORDINATOR, process_count))
+        self.local_agents = self.system.agents
+        _replace_remote_agents(self.system, self.node, self.placement)
+        self.node.start()
+        return self
+
+    def stop(self):
+        for peer in self.node.connections:
+            self.node.send(peer, ("stop",))
+        for worker in self.workers:
+            worker.join()
+        self.node.close()
+        self.system.agents = self.local_agents
+        self.workers = list()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
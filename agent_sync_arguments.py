@@ -1,7 +1,21 @@
+import asyncio
+import hashlib
+import inspect
 import itertools
+import threading
+import time
+import weakref
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from enum import Enum, auto
-from typing import List, Tuple, Union
+from typing import Dict, FrozenSet, Generator, Hashable, Iterable, Iterator, List, Tuple, Union
+
+import numpy
+
+from dependency_graph import nodes_leading_to, nodes_on_cycles
+from query_memory import QueryMemory
+from similarity import SimilarityCache, SimilarityMatrix, best_match
 
 
 class TruthValue(Enum):
@@ -24,6 +38,7 @@ class ComparableObjectOld:
 
 
 class ComparableObject:
+    __slots__ = ()
 
     def _key(self):
         return tuple([attr_value for attr_value in self.__dict__.values()])
@@ -37,24 +52,107 @@ class ComparableObject:
         return NotImplemented
 
 
-class Literal(ComparableObject):
+# interned objects are created under this lock, so that two threads never get two instances of a key
+INTERNING_LOCK = threading.Lock()
 
-    def __init__(self, symbol, positive=True):
-        self.symbol = symbol
-        self.positive = positive
 
-    def __neg__(self):
-        return Literal(self.symbol, not self.positive)
+class InternedObject(ComparableObject):
+    """
+    Immutable object of which there is a single instance per key, so equality is identity and the hash is
+    computed only once.
+    """
+    __slots__ = ("_hash", "_complement", "__weakref__")
+
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, name):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return self is other
+
+    def __ne__(self, other):
+        return self is not other
+
+    def _init_slots(self, **values):
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def _set_complement(self, complement):
+        object.__setattr__(self, "_complement", complement)
+        object.__setattr__(complement, "_complement", self)
 
 
-class Term(ComparableObject):
+class Literal(InternedObject):
+    __slots__ = ("symbol", "positive")
+    _interned = weakref.WeakValueDictionary()
 
-    def __init__(self, definer, literal):
-        self.definer = definer
-        self.literal = literal
+    def __new__(cls, symbol, positive=True):
+        key = (symbol, positive)
+        literal = cls._interned.get(key)
+        if literal is None:
+            with INTERNING_LOCK:
+                literal = cls._interned.get(key)
+                if literal is None:
+                    literal = object.__new__(cls)
+                    literal._init_slots(symbol=symbol, positive=positive, _hash=hash(key), _complement=None)
+                    cls._interned[key] = literal
+        return literal
 
     def __neg__(self):
-        return Term(self.definer, - self.literal)
+        if self._complement is None:
+            self._set_complement(Literal(self.symbol, not self.positive))
+        return self._complement
+
+    def __reduce__(self):
+        return Literal, (self.symbol, self.positive)
+
+    def __repr__(self):
+        return "Literal({!r}, {!r})".format(self.symbol, self.positive)
+
+
+class Term(InternedObject):
+    __slots__ = ("definer", "literal")
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, definer, literal):
+        # agents compare by id, but a term must keep the very agent object it was built with,
+        # so agents are told apart by identity here (definers such as "X" by value)
+        key = (definer if isinstance(definer, str) else id(definer), literal)
+        term = cls._interned.get(key)
+        if term is None:
+            with INTERNING_LOCK:
+                term = cls._interned.get(key)
+                if term is None:
+                    term = object.__new__(cls)
+                    term._init_slots(definer=definer, literal=literal, _hash=hash((definer, literal)),
+                                     _complement=None)
+                    cls._interned[key] = term
+        return term
+
+    def __neg__(self):
+        if self._complement is None:
+            self._set_complement(Term(self.definer, - self.literal))
+        return self._complement
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, InstantiatedTerm):
+            return other.term is self
+        return False
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = InternedObject.__hash__
+
+    def __reduce__(self):
+        return Term, (self.definer, self.literal)
 
     def has_instantiated_term_in(self, list_):
         if self.definer != "X":
@@ -64,12 +162,34 @@ class Term(ComparableObject):
     def _key(self):
         return self.definer, self.literal
 
+
 class InstantiatedTerm(Term):
+    """
+    Term found by similarity to another one. It is equal to (and hashes as) the interned term with the same
+    definer and literal.
+    """
+    __slots__ = ("original_literal", "sim_degree", "term")
+
+    def __new__(cls, definer, literal, original_literal, sim_degree):
+        return object.__new__(cls)
 
     def __init__(self, definer, literal, original_literal, sim_degree):
-        super().__init__(definer, literal)
-        self.original_literal = original_literal
-        self.sim_degree = sim_degree
+        term = Term(definer, literal)
+        self._init_slots(definer=definer, literal=literal, original_literal=original_literal,
+                         sim_degree=sim_degree, term=term, _hash=term._hash, _complement=None)
+
+    def __neg__(self):
+        return - self.term
+
+    def __eq__(self, other):
+        if isinstance(other, InstantiatedTerm):
+            other = other.term
+        return self.term is other
+
+    __hash__ = InternedObject.__hash__
+
+    def __reduce__(self):
+        return InstantiatedTerm, (self.definer, self.literal, self.original_literal, self.sim_degree)
 
 
 class Rule(ComparableObject):
@@ -90,40 +210,832 @@ class StaticRule(Rule):
     pass
 
 
+class RuleIndex:
+    """
+    Set of rules indexed by head term, so that finding the rules for a term does not scan the whole knowledge base.
+    An index may extend a base index (e.g. the agent's rules extended with the focus knowledge) without copying it.
+    """
+
+    def __init__(self, rules: Iterable[Rule] = (), base: "RuleIndex" = None):
+        self.base = base
+        self.version = 0
+        self._rules = []
+        self._members = set()
+        self._by_head = dict()
+        self._strict_by_head = dict()
+        self._heads_by_literal = dict()
+        self._encoded_heads = None
+        self._strict_closure = None
+        self.extend(rules)
+
+    def append(self, rule: Rule):
+        if rule in self:
+            return
+        self.version += 1
+        if not self.has_head(rule.head):
+            self._heads_by_literal.setdefault(rule.head.literal, []).append(rule.head)
+        self._rules.append(rule)
+        self._members.add(rule)
+        self._by_head.setdefault(rule.head, []).append(rule)
+        if isinstance(rule, StaticRule):
+            self._strict_by_head.setdefault(rule.head, []).append(rule)
+
+    def extend(self, rules: Iterable[Rule]):
+        for rule in rules:
+            self.append(rule)
+
+    def added_since(self, version: int) -> List[Rule]:
+        # rules appended on top of the base index after the given version
+        return self._rules[version:]
+
+    def has_head(self, head: Term) -> bool:
+        return head in self._by_head or (self.base is not None and self.base.has_head(head))
+
+    def rules_for(self, head: Term) -> List[Rule]:
+        rules = self._by_head.get(head, [])
+        if self.base is None:
+            return rules
+        return self.base.rules_for(head) + rules
+
+    def strict_rules_for(self, head: Term) -> List[Rule]:
+        rules = self._strict_by_head.get(head, [])
+        if self.base is None:
+            return rules
+        return self.base.strict_rules_for(head) + rules
+
+    def strict_rules(self) -> Iterator[Rule]:
+        if self.base is not None:
+            yield from self.base.strict_rules()
+        for rules in self._strict_by_head.values():
+            yield from rules
+
+    def heads(self) -> Iterator[Term]:
+        if self.base is not None:
+            yield from self.base.heads()
+        for head in self._by_head:
+            if self.base is None or not self.base.has_head(head):
+                yield head
+
+    def own_heads(self) -> Iterator[Term]:
+        # heads of the rules added on top of the base index
+        for heads in self._heads_by_literal.values():
+            yield from heads
+
+    def heads_with_literal(self, literal: Literal) -> List[Term]:
+        heads = self._heads_by_literal.get(literal, [])
+        if self.base is None:
+            return heads
+        return self.base.heads_with_literal(literal) + heads
+
+    def __contains__(self, rule: Rule) -> bool:
+        return rule in self._members or (self.base is not None and rule in self.base)
+
+    def __iter__(self) -> Iterator[Rule]:
+        if self.base is not None:
+            yield from self.base
+        yield from self._rules
+
+    def __len__(self) -> int:
+        return len(self._rules) + (len(self.base) if self.base is not None else 0)
+
+    def state(self) -> Tuple:
+        return (self.version,) + (self.base.state() if self.base is not None else ())
+
+    def encoded_heads(self, matrix: SimilarityMatrix) -> Tuple[List[Term], numpy.ndarray]:
+        """
+        The heads, along with the rows of their literals in the similarity matrix (-1 if not in it).
+        Kept until the rules (or the matrix) change; the heads of the base index are encoded by the base index,
+        once for all the indexes extending it.
+        """
+        key = (matrix, self.state())
+        if self._encoded_heads is None or self._encoded_heads[0] != key:
+            heads = list(self._by_head) if self.base is None else \
+                [head for head in self._by_head if not self.base.has_head(head)]
+            rows = matrix.rows_of(head.literal for head in heads) if matrix is not None else None
+            if self.base is not None:
+                base_heads, base_rows = self.base.encoded_heads(matrix)
+                heads = base_heads + heads
+                rows = numpy.concatenate((base_rows, rows)) if matrix is not None else None
+            self._encoded_heads = key, heads, rows
+        return self._encoded_heads[1], self._encoded_heads[2]
+
+    def strict_closure(self) -> FrozenSet[Term]:
+        """
+        Terms derivable with the strict rules alone, kept until the rules change.
+        """
+        state = self.state()
+        if self._strict_closure is None or self._strict_closure[0] != state:
+            self._strict_closure = state, derive_strictly(self.strict_rules())
+        return self._strict_closure[1]
+
+
+def derive_strictly(strict_rules: Iterable[Rule]) -> FrozenSet[Term]:
+    """
+    Least fixpoint of the strict rules, by semi-naive forward chaining: each rule waits for the members of its
+    body not derived yet, and each newly derived term is only joined with the rules waiting for it, so every
+    rule is considered once per body member whatever the depth of the derivations (and cycles are harmless).
+    """
+    waiting_rules = dict()
+    missing_members = []
+    derived = set()
+    agenda = []
+    for rule in strict_rules:
+        body = set(rule.body)
+        if not body:
+            agenda.append(rule.head)
+            continue
+        for member in body:
+            waiting_rules.setdefault(member, []).append(len(missing_members))
+        missing_members.append([len(body), rule.head])
+
+    while agenda:
+        term = agenda.pop()
+        if term in derived:
+            continue
+        derived.add(term)
+        for position in waiting_rules.pop(term, ()):
+            waiting = missing_members[position]
+            waiting[0] -= 1
+            if waiting[0] == 0:
+                agenda.append(waiting[1])
+    return frozenset(derived)
+
+
 class QueryContext(ComparableObject):
 
-    def __init__(self, id_, term, agent, focus_knowledge):
+    def __init__(self, id_, term, agent, focus_knowledge, memory_scope=None, budget: "SpentBudget" = None,
+                 verdict_only: bool = False, keeps_answers: bool = False):
         self.id = id_
         self.term = term
         self.agent = agent
         self.focus_knowledge = focus_knowledge
+        # answers are memorized under the scope: the context itself, or a scope shared by all the contexts
+        # with the same focus knowledge and the same rules
+        self.memory_scope = memory_scope if memory_scope is not None else id_
+        # a context keeping answers for more than one evaluation (it shares its scope, or answers several terms)
+        # memorizes the answers of each evaluation under an evaluation scope of its own, ended with it, as if
+        # under a context of its own; only the order-free answers (see CycleAnalysis.order_free_answers) are
+        # kept under the memory scope for the other evaluations, along with the answers to the terms queried
+        self.keeps_answers = keeps_answers or self.shares_answers
+        self.evaluation_scope = self.memory_scope
+        self.evaluations = 0
+        self.order_free = None
+        # the answers recalled or memorized by each query under way whose answer may be kept (see KeptAnswer)
+        self.visits = []
+        self.budget = budget
+        # when set, the arguments built here keep only what stronger compares (see ArgSummary)
+        self.verdict_only = verdict_only
+        self.arena = ArgumentArena()
+        # queries sent to the agents and answers memorized under the context so far, and the negated terms being
+        # expanded on the way to the current query along with the history and the count of memorized answers
+        # they were expanded under
+        self.messages = 0
+        self.memorized = 0
+        self.expansions = dict()
+
+    @property
+    def shares_answers(self) -> bool:
+        return self.memory_scope != self.id
+
+    def __getstate__(self):
+        # the arena holds the leaves of the trees built here, a context sent elsewhere starts a new one
+        return dict(self.__dict__, arena=None, visits=[])
+
+    def __setstate__(self, state):
+        self.__dict__.update(state, arena=ArgumentArena())
+
+    def branch(self) -> "QueryContext":
+        """
+        Copy of the context for one of the queries awaited together (see Agent.aquery_agents_together): it
+        collects the answers visited by its query and follows the expansions on its way, and shares the rest
+        (memory scopes, arena, budget); what it spends is added back to the context with add_spent.
+        """
+        branch = object.__new__(QueryContext)
+        branch.__dict__.update(self.__dict__)
+        branch.visits = []
+        branch.expansions = {term: list(expansions) for term, expansions in self.expansions.items()}
+        return branch
+
+    def repeats_expansion(self, term: Term, hist: "History") -> bool:
+        """
+        Whether expanding the term under the history would repeat an expansion of it still under way: with the
+        same terms in the history and no answer memorized since, the evaluation is the same, so it would come
+        back here again and again.
+        """
+        for expansion_hist, memorized in self.expansions.get(term, ()):
+            if memorized == self.memorized and \
+                    all(other in expansion_hist for other in itertools.islice(hist, len(hist) - len(expansion_hist))):
+                return True
+        return False
+
+    @contextmanager
+    def expanding(self, term: Term, hist: "History"):
+        # hist is the history the term is expanded under (the term included); a term left out of it is on no
+        # cycle, so its expansion is never repeated
+        if hist.term != term:
+            yield
+            return
+        expansion = (hist, self.memorized)
+        self.expansions.setdefault(term, []).append(expansion)
+        try:
+            yield
+        finally:
+            expansions = self.expansions[term]
+            expansions.remove(expansion)
+            if not expansions:
+                del self.expansions[term]
+
+    def spent(self) -> Tuple[int, int, int, bool, bool]:
+        # messages and memorized answers counted so far, and the messages, exhaustion and partiality of the budget
+        budget = self.budget
+        if budget is None:
+            return self.messages, self.memorized, 0, False, False
+        return self.messages, self.memorized, budget.messages, budget.exhausted, budget.partial
+
+    def spent_since(self, spent: Tuple[int, int, int, bool, bool]) -> Tuple[int, int, int, bool, bool]:
+        messages, memorized, budget_messages, exhausted, partial = self.spent()
+        return messages - spent[0], memorized - spent[1], budget_messages - spent[2], exhausted, partial
+
+    def add_spent(self, spent: Tuple[int, int, int, bool, bool]):
+        """
+        Adds what a copy of the context spent elsewhere (see spent_since), e.g. in the process of a remote agent,
+        so that the budget and the counts cover the whole evaluation. Copies sent out together spend from the
+        same count, so their messages may go over max_messages by as many copies.
+        """
+        messages, memorized, budget_messages, exhausted, partial = spent
+        self.messages += messages
+        self.memorized += memorized
+        if self.budget is not None:
+            self.budget.messages += budget_messages
+            self.budget.exhausted = self.budget.exhausted or exhausted
+            self.budget.partial = self.budget.partial or partial
+
+    def begin_evaluation(self, order_free: FrozenSet[Tuple[str, Term]]):
+        self.evaluation_scope = (self.id, self.evaluations)
+        self.evaluations += 1
+        self.order_free = order_free
+
+    def end_evaluation(self) -> Hashable:
+        evaluation_scope = self.evaluation_scope
+        self.evaluation_scope = self.memory_scope
+        self.order_free = None
+        return evaluation_scope
+
+    def evaluation_scopes(self) -> List[Hashable]:
+        return [(self.id, n) for n in range(self.evaluations)]
+
+    def is_order_free(self, term: Term, agent: "Agent") -> bool:
+        return self.order_free is not None and (agent.id, term) in self.order_free
+
+    @contextmanager
+    def visiting(self) -> Iterator[list]:
+        # collects the answers recalled or memorized by the query made in the block
+        if self.order_free is None:
+            yield []
+            return
+        visits = []
+        self.visits.append(visits)
+        try:
+            yield visits
+        finally:
+            self.visits.pop()
+
+    def visited(self, asker: "Agent", term: Term, agent_id: str, memorized: Tuple):
+        if self.visits:
+            self.visits[-1].append((asker, term, agent_id, memorized))
+
+    def take(self, asker: "Agent", term: Term, agent_id: str, kept: "KeptAnswer"):
+        """
+        Memorizes a kept answer under the evaluation scope along with the answers it was given from, which the
+        evaluation would have memorized on its way to it, as one more memorized answer.
+        """
+        pending = [(asker, term, agent_id, kept)]
+        while pending:
+            asker, term, agent_id, kept = pending.pop()
+            key = (self.evaluation_scope, term, agent_id)
+            if key not in asker.query_memory:
+                asker.query_memory[key] = kept
+                pending.extend(kept.visits)
+        self.memorized += 1
+
+    def new_arg_tree(self, conclusion: Term) -> "ArgTree":
+        if self.verdict_only:
+            return ArgSummary(self.arena)
+        return ArgTree(SummarizedArgument(conclusion), arena=self.arena)
 
     def _key(self):
         return self.id
 
 
+class KeptAnswer(tuple):
+    """
+    Order-free answer memorized under the memory scope of a context, for its other evaluations: the equivalent
+    term, the truth value and the argument tree, and the answers the agent asked recalled or memorized to give
+    it (asker, term, id of the agent asked, answer), all order-free too.
+    """
+
+    def __new__(cls, memorized: Tuple, visits: Iterable[Tuple] = ()):
+        kept = super().__new__(cls, memorized)
+        kept.visits = tuple(visits)
+        return kept
+
+    def __reduce__(self):
+        return KeptAnswer, (tuple(self), self.visits)
+
+
+class QueryBudget:
+    """
+    Limits of the evaluation of a query: a time limit (in seconds), a number of messages (queries sent to the
+    agents, the asking agent included) and a depth (levels of messages below the query). Once a limit is
+    reached, the agents are no longer asked: their answers are UNDEFINED, as for a term met again in a cycle,
+    and the answers given by the context are partial. Each context spends a budget of its own (start).
+    """
+
+    def __init__(self, time_limit: float = None, max_messages: int = None, max_depth: int = None):
+        self.time_limit = time_limit
+        self.max_messages = max_messages
+        self.max_depth = max_depth
+
+    def start(self) -> "SpentBudget":
+        return SpentBudget(self)
+
+
+class SpentBudget:
+
+    def __init__(self, budget: QueryBudget):
+        self.budget = budget
+        self.deadline = time.monotonic() + budget.time_limit if budget.time_limit is not None else None
+        self.messages = 0
+        # no message is sent anymore once the time or the messages run out, while a message too deep is
+        # only refused to the branch it would extend
+        self.exhausted = False
+        self.partial = False
+
+    def __getstate__(self):
+        # the clock of another process may not have the same origin, so the deadline travels as the time left
+        state = dict(self.__dict__)
+        if self.deadline is not None:
+            state["deadline"] = self.deadline - time.monotonic()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.deadline is not None:
+            self.deadline += time.monotonic()
+
+    def allows_message(self, depth: int) -> bool:
+        budget = self.budget
+        if not self.exhausted and (
+                budget.max_messages is not None and self.messages >= budget.max_messages or
+                self.deadline is not None and time.monotonic() >= self.deadline):
+            self.exhausted = True
+        if self.exhausted or budget.max_depth is not None and depth > budget.max_depth:
+            self.partial = True
+            return False
+        self.messages += 1
+        return True
+
+
+class LiteralDirectory:
+    """
+    Ids of the agents with a rule head similar enough to a term, so that a query on a term of an unknown
+    definer ("X") is sent only to the agents able to answer it (the others would answer FALSE).
+    Matches against the agents' rules are kept until the rules of some agent change; matches against the
+    focus knowledge (which every agent extends its rules with) are kept until the context ends.
+    Agents whose rules are not known locally (remote agents without a copy of them) are always included.
+    """
+
+    def __init__(self, system: "MultiAgentSystem"):
+        self.system = system
+        self.knowledge_version = None
+        self._rule_matches = dict()
+        self._focus_matches_by_context = dict()
+        self._lock = threading.Lock()
+
+    def agent_ids_for(self, term: Term, context: QueryContext) -> FrozenSet:
+        rule_matches_by_term, focus_matches_by_term = self._caches(context)
+        rule_matches = rule_matches_by_term.get(term)
+        if rule_matches is None:
+            rule_matches = rule_matches_by_term[term] = frozenset(
+                agent.id for agent in self.system.agents.values()
+                if not agent.rules_known or agent.look_for_similar_term(term, agent.rules) is not None
+            )
+        focus_matches = focus_matches_by_term.get(term)
+        if focus_matches is None:
+            focus_matches = focus_matches_by_term[term] = frozenset(
+                agent.id for agent in self.system.agents.values()
+                if agent.id not in rule_matches and self._matches_focus(agent, term, context)
+            )
+        return rule_matches | focus_matches
+
+    async def aagent_ids_for(self, term: Term, context: QueryContext) -> FrozenSet:
+        rule_matches_by_term, focus_matches_by_term = self._caches(context)
+        rule_matches = rule_matches_by_term.get(term)
+        if rule_matches is None:
+            rule_matches = set()
+            for agent in list(self.system.agents.values()):
+                if not agent.rules_known or await agent.alook_for_similar_term(term, agent.rules) is not None:
+                    rule_matches.add(agent.id)
+            rule_matches = rule_matches_by_term.setdefault(term, frozenset(rule_matches))
+        focus_matches = focus_matches_by_term.get(term)
+        if focus_matches is None:
+            focus_matches = set()
+            for agent in list(self.system.agents.values()):
+                if agent.id not in rule_matches and await self._amatches_focus(agent, term, context):
+                    focus_matches.add(agent.id)
+            focus_matches = focus_matches_by_term.setdefault(term, frozenset(focus_matches))
+        return rule_matches | focus_matches
+
+    def end_query_context(self, context: QueryContext):
+        self._focus_matches_by_context.pop(context.id, None)
+
+    def _caches(self, context: QueryContext) -> Tuple[Dict[Term, FrozenSet], Dict[Term, FrozenSet]]:
+        # the matches by term against the rules and against the focus knowledge of the context; the caches are
+        # handed out, so a thread resetting them does not pull them from under another one
+        knowledge_version = self.system.knowledge_version()
+        with self._lock:
+            if knowledge_version != self.knowledge_version:
+                # focus matches leave out the agents matched by their rules, so they are outdated as well
+                self.knowledge_version = knowledge_version
+                self._rule_matches = dict()
+                self._focus_matches_by_context = dict()
+            return self._rule_matches, self._focus_matches_by_context.setdefault(context.id, dict())
+
+    def _matches_focus(self, agent: "Agent", term: Term, context: QueryContext) -> bool:
+        # the extended rules are the ones the agent uses when queried, so they are not built in vain
+        focus_heads = agent.get_extended_rules(context).own_heads()
+        return any(self.system.similar_enough(agent.similarity(head, term)) for head in focus_heads)
+
+    async def _amatches_focus(self, agent: "Agent", term: Term, context: QueryContext) -> bool:
+        for head in agent.get_extended_rules(context).own_heads():
+            if self.system.similar_enough(await self.system.asimilarity(head, term)):
+                return True
+        return False
+
+
+def tracks_depth(context: QueryContext) -> bool:
+    # the depth of a message is read from the history, so every term must enter it
+    return context.budget is not None and context.budget.budget.max_depth is not None
+
+
+class CycleAnalysis:
+    """
+    Terms on the cycles of the dependency graph of the rules: only these terms can be met again while they are
+    being evaluated, so only they need to enter the history of a query. In the graph, the head of a rule (of an
+    agent's rules extended with the focus knowledge) depends on the terms the members of its body are answered
+    with, i.e. the heads matched by the agents asked about them, in both polarities (an agent answering a term
+    weighs the support of its negation too). The terms are found again for another focus knowledge, or when the
+    rules of some agent change. When the rules of some agent are not known locally, or some head is
+    defined by "X" (which has_instantiated_term_in compares with any term of the history), every term is
+    tracked (None), as it is when the system does not analyse cycles.
+    The same graph gives the answers that can be kept for the other evaluations of a context (see
+    order_free_answers), whether the system analyses cycles or not.
+    """
+
+    def __init__(self, system: "MultiAgentSystem"):
+        self.system = system
+        self.knowledge_version = None
+        self._by_focus = dict()
+        self._by_context = dict()
+        self._lock = threading.Lock()
+
+    def terms_on_cycles(self, context: QueryContext) -> FrozenSet[Term]:
+        if not self.system.analyse_cycles or tracks_depth(context):
+            return None
+        return self.analyse(context)[0]
+
+    async def aterms_on_cycles(self, context: QueryContext) -> FrozenSet[Term]:
+        if not self.system.analyse_cycles or tracks_depth(context):
+            return None
+        return (await self.aanalyse(context))[0]
+
+    def order_free_answers(self, context: QueryContext) -> FrozenSet[Tuple[str, Term]]:
+        """
+        The answers, by id of the agent asked and term asked about, that are the same whatever the history and
+        the answers memorized when they are asked: the terms the agent answers with lead to no cycle, so their
+        evaluation never meets a term of the history and gives the same answer in every evaluation. None when
+        the context keeps no answers for other evaluations, or has a budget (its answers may be partial).
+        """
+        if not context.keeps_answers or context.budget is not None:
+            return None
+        return self.analyse(context)[1]
+
+    async def aorder_free_answers(self, context: QueryContext) -> FrozenSet[Tuple[str, Term]]:
+        if not context.keeps_answers or context.budget is not None:
+            return None
+        return (await self.aanalyse(context))[1]
+
+    async def aasks_together(self, agents: List["Agent"], term: Term, context: QueryContext) -> bool:
+        """
+        Whether the agents can be asked about the term all at once: the answer of each of them is order-free
+        (see order_free_answers), so it meets no term of the history and does not depend on what the others
+        memorize. Not under a budget, which the queries spend in turn.
+        """
+        if context.budget is not None or len(agents) < 2:
+            return False
+        order_free = (await self.aanalyse(context))[1]
+        return order_free is not None and all((agent.id, term) in order_free for agent in agents)
+
+    def analyse(self, context: QueryContext) -> Tuple[FrozenSet[Term], FrozenSet[Tuple[str, Term]]]:
+        by_focus, key = self._key(context)
+        if key not in by_focus:
+            matches = dict()
+            rule_matches = [] if self._analysable(context) else None
+            for agent, rule in self._rules(context) if rule_matches is not None else ():
+                rule_matches.append((rule.head, None, None))
+                for member in rule.body:
+                    for asked_agent in agent.agents_to_ask(member, context):
+                        match_key = (asked_agent.id, member)
+                        if match_key not in matches:
+                            matches[match_key] = asked_agent.look_for_similar_term(
+                                member, asked_agent.get_extended_rules(context))
+                        rule_matches.append((rule.head, match_key, matches[match_key]))
+            by_focus[key] = self._analysis(rule_matches)
+        return by_focus[key]
+
+    async def aanalyse(self, context: QueryContext) -> Tuple[FrozenSet[Term], FrozenSet[Tuple[str, Term]]]:
+        by_focus, key = self._key(context)
+        if key not in by_focus:
+            matches = dict()
+            rule_matches = [] if self._analysable(context) else None
+            for agent, rule in self._rules(context) if rule_matches is not None else ():
+                rule_matches.append((rule.head, None, None))
+                for member in rule.body:
+                    for asked_agent in await agent.aagents_to_ask(member, context):
+                        match_key = (asked_agent.id, member)
+                        if match_key not in matches:
+                            matches[match_key] = await asked_agent.alook_for_similar_term(
+                                member, asked_agent.get_extended_rules(context))
+                        rule_matches.append((rule.head, match_key, matches[match_key]))
+            by_focus[key] = self._analysis(rule_matches)
+        return by_focus[key]
+
+    def end_query_context(self, context: QueryContext):
+        self._by_context.pop(context.id, None)
+
+    def _key(self, context: QueryContext) -> Tuple[dict, str]:
+        knowledge_version = self.system.knowledge_version()
+        with self._lock:
+            if knowledge_version != self.knowledge_version:
+                self.knowledge_version = knowledge_version
+                self._by_focus = dict()
+            by_focus = self._by_focus
+        key = self._by_context.get(context.id)
+        if key is None:
+            key = self._by_context[context.id] = focus_knowledge_fingerprint(context.focus_knowledge)
+        return by_focus, key
+
+    def _analysable(self, context: QueryContext) -> bool:
+        return all(agent.rules_known for agent in self.system.agents.values()) and \
+            not any(rule.head.definer == "X" for _, rule in self._rules(context))
+
+    def _rules(self, context: QueryContext) -> Iterator[Tuple["Agent", Rule]]:
+        for agent in list(self.system.agents.values()):
+            for rule in agent.get_extended_rules(context):
+                yield agent, rule
+
+    @staticmethod
+    def _analysis(rule_matches: List[Tuple[Term, Tuple[str, Term], InstantiatedTerm]]
+                  ) -> Tuple[FrozenSet[Term], FrozenSet[Tuple[str, Term]]]:
+        # rule_matches holds, for each rule, its head alone and then the (head, (agent asked, member), term
+        # answered with) of the members of its body
+        if rule_matches is None:
+            return None, None
+        graph = dict()
+        for head, _, equivalent_term in rule_matches:
+            successors = graph.setdefault(head, set())
+            if equivalent_term is not None:
+                successors.add(equivalent_term.term)
+                successors.add(- equivalent_term)
+        on_cycles = nodes_on_cycles(graph)
+        leading_to_cycles = nodes_leading_to(graph, on_cycles)
+        order_free = frozenset(match_key for _, match_key, equivalent_term in rule_matches
+                               if match_key is not None and
+                               (equivalent_term is None or equivalent_term.term not in leading_to_cycles and
+                                - equivalent_term not in leading_to_cycles))
+        return on_cycles, order_free
+
+
 class MultiAgentSystem(ComparableObject):
 
-    def __init__(self, similarity_function=lambda term1, term2: term1 == term2, similarity_threshold=0):
+    def __init__(self, similarity_function=lambda term1, term2: term1 == term2, similarity_threshold=0,
+                 query_memory_size=None, share_answers=False, best_match=False, analyse_cycles=False,
+                 verdict_only=False):
         self.similarity_threshold = similarity_threshold
         self.similarity_function = similarity_function
+        self.query_memory_size = query_memory_size
+        # when set, answers are reused by every context with the same focus knowledge while the agents' rules
+        # are unchanged (changes to preference functions are not tracked: call forget_shared_answers); only
+        # the answers the history cannot change are reused (see QueryContext.keeps_answers), so the contexts
+        # sharing a scope may be evaluated concurrently and in any order
+        self.share_answers = share_answers
+        # when set, an agent matches a term to its most similar rule head instead of the first one similar enough
+        self.best_match = best_match
+        # when set, only the terms on cycles of the dependency graph of the rules enter the history of a query;
+        # the graph covers all the rules, so it pays off when many queries share the focus knowledge
+        self.analyse_cycles = analyse_cycles
+        # when set, queries give the truth values without building the argument trees, which are rebuilt when
+        # an answer's arg_tree is asked for (see Answer.explain)
+        self.verdict_only = verdict_only
         self.agents = dict()
         self.query_contexts = dict()
+        # queries sent to the agents by the contexts ended so far
+        self.messages_sent = 0
+        self.literal_directory = LiteralDirectory(self)
+        self.cycle_analysis = CycleAnalysis(self)
+        # optional layers in front of the similarity function (see memoize_similarity and precompute_similarity)
+        self.similarity_cache = None
+        self.similarity_matrix = None
 
         self.query_context_id_generator = ("q" + str(n) for n in itertools.count(start=0))
+        # contexts under way by shared scope: the scopes left behind by a change of the rules are dropped once
+        # no context uses them
+        self._scope_users = dict()
+        self._lock = threading.Lock()
 
     def similar_enough(self, sim_degree):
         return sim_degree >= self.similarity_threshold
 
     def similarity(self, term1, term2):
+        if self.similarity_matrix is not None:
+            sim_degree = self.similarity_matrix.similarity(term1.literal, term2.literal)
+            if sim_degree is not None:
+                return sim_degree
+        if self.similarity_cache is not None:
+            return self.similarity_cache.similarity(term1, term2)
         return self.similarity_function(term1, term2)
 
-    def new_query_context(self, term, agent, focus_knowledge):
-        new_id = next(self.query_context_id_generator)
-        new_query_context = QueryContext(new_id, term, agent, focus_knowledge)
+    async def asimilarity(self, term1, term2):
+        if self.similarity_matrix is not None:
+            sim_degree = self.similarity_matrix.similarity(term1.literal, term2.literal)
+            if sim_degree is not None:
+                return sim_degree
+        if self.similarity_cache is not None:
+            return await self.similarity_cache.asimilarity(term1, term2)
+        sim_degree = self.similarity_function(term1, term2)
+        if inspect.isawaitable(sim_degree):
+            sim_degree = await sim_degree
+        return sim_degree
+
+    def memoize_similarity(self, max_entries: int = None) -> SimilarityCache:
+        # only for similarity functions that depend on the literals of the terms alone; the function is looked
+        # up on each miss, so it may still be replaced
+        self.similarity_cache = SimilarityCache(
+            lambda term1, term2: self.similarity_function(term1, term2), max_entries)
+        return self.similarity_cache
+
+    def precompute_similarity(self, literals: Iterable[Literal] = ()) -> SimilarityMatrix:
+        """
+        Computes the similarity matrix over the literals of the agents' rules (both polarities) and the given
+        ones, e.g. those of the focus knowledge. Same assumption as memoize_similarity; a matrix computed
+        elsewhere (e.g. from embeddings) may be assigned to similarity_matrix instead.
+        """
+        vocabulary = list(dict.fromkeys(itertools.chain(self.literal_vocabulary(), literals)))
+        self.similarity_matrix = SimilarityMatrix.from_function(
+            [Term("X", literal) for literal in vocabulary], self.similarity_function, self.similarity_threshold)
+        return self.similarity_matrix
+
+    def literal_vocabulary(self) -> List[Literal]:
+        literals = dict()
+        for agent in self.agents.values():
+            for rule in agent.rules:
+                for term in itertools.chain([rule.head], rule.body):
+                    literals[term.literal] = None
+                    literals[- term.literal] = None
+        return list(literals)
+
+    def new_query_context(self, term, agent, focus_knowledge, budget: QueryBudget = None, verdict_only: bool = None,
+                          keeps_answers: bool = False):
+        with self._lock:
+            new_id = next(self.query_context_id_generator)
+        verdict_only = self.verdict_only if verdict_only is None else verdict_only
+        memory_scope = None
+        # partial answers are kept to the context that gave them, and the answers without argument trees are
+        # only shared with the other verdict-only contexts
+        if self.share_answers and budget is None:
+            memory_scope = (focus_knowledge_fingerprint(focus_knowledge), self.knowledge_version(), verdict_only)
+            with self._lock:
+                self._scope_users[memory_scope] = self._scope_users.get(memory_scope, 0) + 1
+            self.drop_superseded_scopes(memory_scope[1])
+        new_query_context = QueryContext(new_id, term, agent, focus_knowledge, memory_scope,
+                                         budget.start() if budget is not None else None, verdict_only, keeps_answers)
         self.query_contexts[new_id] = new_query_context
         return new_query_context
 
+    def end_query_context(self, context):
+        for agent in self.agents.values():
+            agent.end_query_context(context)
+        self.literal_directory.end_query_context(context)
+        self.cycle_analysis.end_query_context(context)
+        with self._lock:
+            self.messages_sent += context.messages
+            if context.shares_answers:
+                self._scope_users[context.memory_scope] -= 1
+        if context.shares_answers:
+            self.drop_superseded_scopes(self.knowledge_version())
+        self.query_contexts.pop(context.id, None)
+
+    def drop_superseded_scopes(self, knowledge_version: Tuple):
+        # the answers of the shared scopes of other rules than the current ones, that no context uses
+        with self._lock:
+            superseded = [scope for scope, users in self._scope_users.items()
+                          if users == 0 and scope[1] != knowledge_version]
+            for scope in superseded:
+                del self._scope_users[scope]
+        for scope in superseded:
+            for agent in self.agents.values():
+                agent.query_memory.end_context(scope)
+
+    @contextmanager
+    def evaluation(self, context: QueryContext, order_free: FrozenSet[Tuple[str, Term]]):
+        # a term answered under a context keeping answers for other evaluations (see QueryContext.keeps_answers)
+        if not context.keeps_answers:
+            yield
+            return
+        context.begin_evaluation(order_free)
+        try:
+            yield
+        finally:
+            evaluation_scope = context.end_evaluation()
+            for agent in self.agents.values():
+                agent.query_memory.end_context(evaluation_scope)
+
+    def knowledge_version(self) -> Tuple:
+        return tuple((agent_id, agent.rules_version) for agent_id, agent in self.agents.items())
+
+    def forget_shared_answers(self):
+        for agent in self.agents.values():
+            agent.query_memory.clear()
+
+    def query_memory_stats(self) -> Dict[str, int]:
+        stats = dict(hits=0, misses=0, evictions=0, entries=0)
+        for agent in self.agents.values():
+            for name, value in agent.query_memory.stats().items():
+                stats[name] += value
+        return stats
+
+    async def aquery(self, term, focus_knowledge, budget: QueryBudget = None):
+        return await self.agents[term.definer.id].ainitialize_query(term, focus_knowledge, budget)
+
+    def query_many(self, terms: Iterable[Term], focus_knowledge, budget: QueryBudget = None
+                   ) -> Dict[Term, "Answer"]:
+        # all the terms are evaluated under a single context, so they share the extended rules, the order-free
+        # answers (see QueryContext.keeps_answers) and the budget: each answer is the one the term gets alone
+        # (unless the budget runs out)
+        terms = list(terms)
+        context = self.new_query_context(tuple(terms), None, focus_knowledge, budget, keeps_answers=True)
+        try:
+            return {term: self.agents[term.definer.id].answer_in_context(term, context) for term in terms}
+        finally:
+            self.end_query_context(context)
+
+    def query_in_parallel(self, terms: Iterable[Term], focus_knowledge, max_workers: int = None,
+                          budget: QueryBudget = None) -> Dict[Term, "Answer"]:
+        # each term is answered under a context of its own (with a budget of its own), by a pool of threads;
+        # the answers are the ones initialize_query gives
+        terms = list(terms)
+        with ThreadPoolExecutor(max_workers) as executor:
+            answers = executor.map(lambda term: term.definer.initialize_query(term, focus_knowledge, budget),
+                                   terms)
+            return dict(zip(terms, answers))
+
+    def query_iteratively(self, term, focus_knowledge, budget: QueryBudget = None):
+        return term.definer.initialize_query_iteratively(term, focus_knowledge, budget)
+
+    async def aquery_many(self, terms: Iterable[Term], focus_knowledge, budget: QueryBudget = None
+                          ) -> Dict[Term, "Answer"]:
+        terms = list(terms)
+        context = self.new_query_context(tuple(terms), None, focus_knowledge, budget, keeps_answers=True)
+        try:
+            answers = dict()
+            for term in terms:
+                answers[term] = await self.agents[term.definer.id].aanswer_in_context(term, context)
+            return answers
+        finally:
+            self.end_query_context(context)
+
+
+def run_iteratively(steps: Generator):
+    """
+    Drives the generators of the iterative engine with an explicit stack: a generator yields the generator of
+    each nested call and is resumed with its result, so the depth of an evaluation is bounded by memory and
+    not by the Python recursion limit.
+    """
+    stack = [steps]
+    value = None
+    while True:
+        try:
+            nested = stack[-1].send(value)
+        except StopIteration as stop:
+            stack.pop()
+            if not stack:
+                return stop.value
+            value = stop.value
+        else:
+            stack.append(nested)
+            value = None
+
+
 class Answer(ComparableObject):
 
     def __init__(self, queried_term, context, equivalent_term, truth_value, arg_tree):
@@ -131,7 +1043,124 @@ class Answer(ComparableObject):
         self.context = context
         self.equivalent_term = equivalent_term
         self.truth_value = truth_value
-        self.arg_tree = arg_tree
+        # the argument tree built by the engine, or its summary under a verdict-only context
+        self.argument = arg_tree
+        # some agent was left unasked before the answer was given, for want of budget
+        self.partial = context is not None and context.budget is not None and context.budget.partial
+
+    @property
+    def arg_tree(self) -> "ArgTree":
+        if isinstance(self.argument, ArgSummary):
+            self.argument = self.explain()
+        return self.argument
+
+    def explain(self) -> "ArgTree":
+        """
+        Evaluates the queried term again, building the argument trees, under a new context with the focus
+        knowledge and the budget of the answer's context, and returns the argument tree found. The tree comes
+        from the knowledge of the agents at that time. It is built by the iterative engine, whatever engine gave
+        the answer, so that a deep argument does not hit the recursion limit.
+        """
+        agent = self.context.agent or self.queried_term.definer
+        budget = self.context.budget.budget if self.context.budget is not None else None
+        context = agent.system.new_query_context(self.queried_term, agent, self.context.focus_knowledge, budget,
+                                                 verdict_only=False)
+        try:
+            return run_iteratively(agent.ianswer_in_context(self.queried_term, context)).argument
+        finally:
+            agent.system.end_query_context(context)
+
+
+def focus_knowledge_fingerprint(focus_knowledge: Iterable[Rule]) -> str:
+    # definers are left out, as focus rules are converted to the terms of each agent before being used
+    signatures = sorted(
+        repr((type(rule).__name__, rule.id,
+              (rule.head.literal.symbol, rule.head.literal.positive),
+              tuple((term.literal.symbol, term.literal.positive) for term in rule.body)))
+        for rule in focus_knowledge
+    )
+    return hashlib.sha256("\n".join(signatures).encode("utf-8")).hexdigest()
+
+
+class History:
+    """
+    Terms being evaluated on the way to a query, as a persistent linked list: a history is extended by sharing
+    it instead of copying it. Every CHECKPOINT terms, a node keeps the set of the terms up to it, so a
+    membership test walks at most CHECKPOINT nodes before a set lookup.
+    """
+    __slots__ = ("term", "parent", "length", "members")
+    CHECKPOINT = 16
+
+    def __init__(self, term=None, parent: "History" = None):
+        self.term = term
+        self.parent = parent
+        self.length = parent.length + 1 if parent is not None else 0
+        self.members = None
+        if parent is None:
+            self.members = frozenset()
+        elif self.length % self.CHECKPOINT == 0:
+            terms, checkpoint = self._since_checkpoint()
+            self.members = checkpoint.members.union(terms)
+
+    @classmethod
+    def of(cls, terms: Iterable[Term]) -> "History":
+        history = EMPTY_HISTORY
+        for term in terms:
+            history = history.add(term)
+        return history
+
+    def add(self, term) -> "History":
+        return History(term, self)
+
+    def _since_checkpoint(self) -> Tuple[List[Term], "History"]:
+        terms = []
+        history = self
+        while history.members is None:
+            terms.append(history.term)
+            history = history.parent
+        return terms, history
+
+    def __contains__(self, term) -> bool:
+        history = self
+        while history.members is None:
+            if history.term == term:
+                return True
+            history = history.parent
+        return term in history.members
+
+    def __iter__(self) -> Iterator[Term]:
+        # from the most recent term
+        history = self
+        while history.parent is not None:
+            yield history.term
+            history = history.parent
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __reduce__(self):
+        # flat, as the history may be longer than the recursion limit of pickle
+        return History.of, (list(self)[::-1],)
+
+
+EMPTY_HISTORY = History()
+
+
+def extend_hist(hist: History, term: Term, terms_on_cycles: FrozenSet[Term]) -> History:
+    # a term on no cycle of the dependency graph is never met again while being evaluated
+    if terms_on_cycles is not None and term not in terms_on_cycles:
+        return hist
+    return hist.add(term)
+
+
+def allows_message(context: QueryContext, hist: History) -> bool:
+    # the depth of a message is the number of terms being evaluated on the way to it
+    return context.budget is None or context.budget.allows_message(len(hist))
+
+
+def unexplored_answer(term: Term) -> Tuple[Term, TruthValue, "ArgTree"]:
+    # what an agent left unasked for want of budget answers, as if the term were met again in a cycle
+    return term, TruthValue.UNDEFINED, arg_tree_promise_for(term)
 
 
 def get_next_from_hist(hist, term):
@@ -144,28 +1173,270 @@ def hist_after_element(hist: list, element):
     return hist[index_element+1:]
 
 
+SMALL_BITSET = 1 << 64
+
+
+def codes_in(bits: int) -> Union[List[int], numpy.ndarray]:
+    # positions of the bits set, in increasing order; past a machine word, unpacked by numpy in one go
+    if bits < SMALL_BITSET:
+        codes = []
+        while bits:
+            lowest = bits & -bits
+            codes.append(lowest.bit_length() - 1)
+            bits ^= lowest
+        return codes
+    octets = numpy.frombuffer(bits.to_bytes((bits.bit_length() + 7) // 8, "little"), dtype=numpy.uint8)
+    return numpy.flatnonzero(numpy.unpackbits(octets, bitorder="little"))
+
+
+class ArgumentArena:
+    """
+    Foreign leaves of the argument trees built under a context, numbered so that the support set of a tree is
+    an integer bitset over them: the union of the support sets of the children is a bitwise or, and a support
+    set costs a bit per leaf of the context instead of a set entry per leaf below the tree. The leaf of each
+    number, the index of its definer and its similarity degree are kept in parallel arrays, from which a
+    support set is ranked without going through its leaves.
+    A leaf is numbered by its term, similarity degree and original literal. A term met with several degrees
+    (or original literals) has several numbers, of which a support set keeps the first one met below the tree,
+    as a set of terms does.
+    Trees of several contexts may be summarized into the same arena (answers shared by contexts running in
+    threads), so leaves are numbered under a lock.
+    """
+
+    def __init__(self):
+        self.leaves = []
+        self.leaf_definers = []
+        self.sim_degrees = []
+        self.definer_ids = []
+        self.definer_indexes = dict()
+        self.codes = dict()
+        self.mask_by_term = dict()
+        self.ambiguous_terms = dict()
+        self.ambiguous_mask = 0
+        self._arrays = None
+        self._lock = threading.Lock()
+
+    def code_of(self, leaf: InstantiatedTerm) -> int:
+        key = (leaf, leaf.original_literal, leaf.sim_degree)
+        code = self.codes.get(key)
+        if code is None:
+            with self._lock:
+                code = self.codes.get(key)
+                if code is None:
+                    code = self._number(key, leaf)
+        return code
+
+    def _number(self, key: Tuple, leaf: InstantiatedTerm) -> int:
+        # the lists are appended to before the code is published, so a code read without the lock is complete
+        code = len(self.leaves)
+        self.leaves.append(leaf)
+        definer_id = leaf.definer.id
+        if definer_id not in self.definer_indexes:
+            self.definer_indexes[definer_id] = len(self.definer_ids)
+            self.definer_ids.append(definer_id)
+        self.leaf_definers.append(self.definer_indexes[definer_id])
+        self.sim_degrees.append(leaf.sim_degree)
+        mask = self.mask_by_term.get(leaf, 0)
+        self.mask_by_term[leaf] = mask | 1 << code
+        if mask:
+            self.ambiguous_terms[leaf] = mask | 1 << code
+            self.ambiguous_mask |= mask | 1 << code
+        self.codes[key] = code
+        return code
+
+    def bits_of(self, leaves: Iterable[InstantiatedTerm]) -> int:
+        bits = 0
+        for leaf in leaves:
+            bits |= 1 << self.code_of(leaf)
+        return bits
+
+    def leaves_in(self, bits: int) -> Iterator[InstantiatedTerm]:
+        codes = codes_in(bits)
+        return map(self.leaves.__getitem__, codes if isinstance(codes, list) else codes.tolist())
+
+    def rank(self, bits: int, preference_function: Dict[str, float]) -> float:
+        # the preference for the definer of each leaf times its similarity degree, summed in the order of the
+        # leaves whatever the size of the set
+        codes = codes_in(bits)
+        if isinstance(codes, list):
+            return sum([preference_function.get(self.definer_ids[self.leaf_definers[code]], 0) * self.sim_degrees[code]
+                        for code in codes])
+        leaf_definers, sim_degrees = self._parallel_arrays()
+        preferences = numpy.array([preference_function.get(definer_id, 0) for definer_id in self.definer_ids],
+                                  dtype=float)
+        # cumsum adds from left to right, as sum does
+        return numpy.cumsum(preferences[leaf_definers[codes]] * sim_degrees[codes]).item(-1)
+
+    def _parallel_arrays(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        if self._arrays is None or len(self._arrays[0]) != len(self.leaves):
+            self._arrays = numpy.array(self.leaf_definers, dtype=numpy.intp), numpy.array(self.sim_degrees,
+                                                                                            dtype=float)
+        return self._arrays
+
+    def first_met(self, bits: int, own_codes: List[int], children_bits: List[int]) -> int:
+        # the terms with several numbers in the bits keep the number of their first leaf: an own leaf of the
+        # tree, else the leaf of the first child with the term (a child keeps a single number per term)
+        with self._lock:
+            masks = list(self.ambiguous_terms.values())
+        for mask in masks:
+            present = bits & mask
+            if present & (present - 1):
+                first = next((1 << code for code in own_codes if 1 << code & mask), 0) or \
+                    next(child_bits & mask for child_bits in children_bits if child_bits & mask)
+                bits = bits & ~mask | first
+        return bits
+
+
 class SummarizedArgument:
+    __slots__ = ("conclusion", "foreign_leaves")
 
     def __init__(self, conclusion: Term, foreign_leaves: List[InstantiatedTerm] = None):
         self.conclusion = conclusion
-        self.foreign_leaves = foreign_leaves
+        self.foreign_leaves = foreign_leaves if foreign_leaves is not None else list()
 
 
 class ArgTree(object):
-
-    def __init__(self, parent: SummarizedArgument = None, children: List["ArgTree"] = None, is_promise: bool = False):
+    """
+    The support set (all foreign leaves, as a bitset over the leaves of an arena) and the rank given by each
+    agent are computed once and kept. A tree only changes while it is being built, through add_child and
+    add_foreign_leaf, which reset them; a subtree must be complete before it is added to another tree, and is
+    referenced, not copied. A tree built without an arena summarizes its leaves in the arena of its children
+    (or a new one), and the support set of a child from another arena (another context) is numbered anew.
+    """
+    __slots__ = ("parent", "children", "is_promise", "arena", "support_bits", "support_set", "ranks")
+
+    def __init__(self, parent: SummarizedArgument = None, children: List["ArgTree"] = None, is_promise: bool = False,
+                 arena: ArgumentArena = None):
         self.parent = parent
         self.children = children if children is not None else list()
         self.is_promise = is_promise
-
-    def get_all_foreign_leaves(self):
-        children_foreign_leaves = set()
+        self.arena = arena
+        self.support_bits = None
+        self.support_set = None
+        self.ranks = dict()
+
+    def get_all_foreign_leaves(self) -> FrozenSet[InstantiatedTerm]:
+        if self.support_set is None:
+            self.support_set = frozenset(self.support_leaves())
+        return self.support_set
+
+    def support_leaves(self) -> Iterator[InstantiatedTerm]:
+        bits = self.get_support_bits()
+        return self.arena.leaves_in(bits) if bits else iter(())
+
+    def rank(self, preference_function: Dict[str, float]) -> float:
+        bits = self.get_support_bits()
+        return self.arena.rank(bits, preference_function) if bits else 0
+
+    def get_support_bits(self) -> int:
+        # subtrees are summarized bottom-up with an explicit stack, so deep trees do not hit the recursion limit
+        pending = [self]
+        while pending:
+            tree = pending[-1]
+            if tree.support_bits is not None:
+                pending.pop()
+                continue
+            unsummarized = [child for child in tree.children if child.support_bits is None]
+            if unsummarized:
+                pending.extend(unsummarized)
+                continue
+            pending.pop()
+            tree._summarize()
+        return self.support_bits
+
+    def _summarize(self):
+        foreign_leaves = self.parent.foreign_leaves if self.parent is not None else ()
+        arena = self.arena
+        if arena is None and (foreign_leaves or any(child.support_bits for child in self.children)):
+            arena = self.arena = next((child.arena for child in self.children if child.support_bits),
+                                      None) or ArgumentArena()
+        own_codes = [arena.code_of(leaf) for leaf in foreign_leaves]
+        bits = 0
+        for code in own_codes:
+            bits |= 1 << code
+        children_bits = []
         for child in self.children:
-            children_result_set = children_foreign_leaves.union(child.get_all_foreign_leaves())
-        return set(self.parent.foreign_leaves).union(children_result_set)
+            child_bits = child.support_bits
+            if child_bits and child.arena is not arena:
+                child_bits = arena.bits_of(child.support_leaves())
+            children_bits.append(child_bits)
+            bits |= child_bits
+        if bits & (arena.ambiguous_mask if arena is not None else 0):
+            bits = arena.first_met(bits, own_codes, children_bits)
+        self.support_bits = bits
 
     def add_child(self, tree: "ArgTree"):
         self.children.append(tree)
+        self.reset_summary()
+
+    def add_foreign_leaf(self, term: InstantiatedTerm):
+        self.parent.foreign_leaves.append(term)
+        self.reset_summary()
+
+    def reset_summary(self):
+        self.support_bits = None
+        self.support_set = None
+        self.ranks.clear()
+
+    def __getstate__(self):
+        # the summary is computed again where the tree is unpickled, in the arena of the context found there
+        return self.parent, self.children, self.is_promise
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+class ArgSummary(ArgTree):
+    """
+    Argument built under a verdict-only context: it keeps what stronger compares, the support set and the
+    ranks, and no conclusion. Its subtrees are let go once its support set is computed, so the arguments kept in
+    the query memory do not hold the trees below them; a summary must be complete before it is ranked.
+    """
+    __slots__ = ()
+
+    def __init__(self, arena: ArgumentArena = None, foreign_leaves: List[InstantiatedTerm] = None):
+        super().__init__(SummarizedArgument(None, foreign_leaves), None, False, arena)
+
+    def _summarize(self):
+        super()._summarize()
+        self.children = list()
+
+    def __getstate__(self):
+        # sent as the leaves of its support set, numbered again where it is unpickled
+        return list(self.support_leaves()),
+
+    def __setstate__(self, state):
+        self.__init__(None, *state)
+
+
+class EmptyArgTree(ArgTree):
+    """
+    Tree without any argument, shared as NO_ARG_TREE: its summary is given at once, so nothing is ever
+    written to it, and it cannot be extended.
+    """
+    __slots__ = ()
+
+    def __init__(self):
+        super().__init__()
+        self.support_bits = 0
+        self.support_set = frozenset()
+
+    def rank(self, preference_function: Dict[str, float]) -> float:
+        return 0
+
+    def add_child(self, tree: ArgTree):
+        raise TypeError("the empty argument tree is shared and cannot be extended")
+
+    def add_foreign_leaf(self, term: InstantiatedTerm):
+        raise TypeError("the empty argument tree is shared and cannot be extended")
+
+    def __reduce__(self):
+        # unpickled as the NO_ARG_TREE of the receiving process
+        return "NO_ARG_TREE"
+
+
+# placeholder of query_agents while no agent has answered; it is never changed
+NO_ARG_TREE = EmptyArgTree()
 
 
 def arg_tree_promise_for(term):
@@ -178,23 +1449,140 @@ def arg_tree_leaf_for(term):
     return ArgTree(arg, None, False)
 
 
+def wrap_method(obj, name: str, wrapper):
+    """
+    Replaces a method of an object (not of its class) with wrapper(method), e.g. to trace its calls. A method
+    wrapped several times runs the wrappers in the order they were added, and unwrap_method removes any of them
+    while keeping the others.
+    """
+    obj.__dict__.setdefault("method_wrappers", dict()).setdefault(name, []).append(wrapper)
+    _apply_wrappers(obj, name)
+
+
+def unwrap_method(obj, name: str, wrapper):
+    obj.method_wrappers[name].remove(wrapper)
+    _apply_wrappers(obj, name)
+
+
+def _apply_wrappers(obj, name: str):
+    obj.__dict__.pop(name, None)
+    wrappers = obj.method_wrappers[name]
+    if not wrappers:
+        del obj.method_wrappers[name]
+        return
+    method = getattr(obj, name)
+    for wrapper in wrappers:
+        method = wrapper(method)
+    setattr(obj, name, method)
+
+
 class Agent(ComparableObject):
+    is_remote = False
+    # whether the rules of the agent are known in this process (see LiteralDirectory and CycleAnalysis)
+    rules_known = True
 
     def __init__(self, id_, system):
         self.id = id_
         self.system = system
-        self.rules = []
+        self._rules = RuleIndex()
+        self._rules_generation = 0
         self.preference_function = dict()
-        self.query_memory = dict()
-        self.known_agents = self.system.agents.values()
+        self.query_memory = QueryMemory(system.query_memory_size)
+        self.extended_rules_by_context = dict()
+
+    @property
+    def rules(self) -> RuleIndex:
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules: Iterable[Rule]):
+        self._rules = RuleIndex(rules)
+        self._rules_generation += 1
+
+    def load_rules(self, rule_index):
+        """
+        Uses a prebuilt (e.g. compiled) rule index as the agent's rules, without copying it: rules appended
+        afterwards are kept on top of it.
+        """
+        self._rules = RuleIndex(base=rule_index)
+        self._rules_generation += 1
+
+    @property
+    def rules_version(self) -> Tuple[int, int]:
+        return self._rules_generation, self._rules.version
+
+    @property
+    def known_agents(self) -> List["Agent"]:
+        return list(self.system.agents.values())
+
+    def initialize_query(self, term, focus_knowledge, budget: QueryBudget = None):
+        context = self.system.new_query_context(term, self, focus_knowledge, budget)
+        try:
+            return self.answer_in_context(term, context)
+        finally:
+            self.system.end_query_context(context)
+
+    def answer_in_context(self, term: Term, context: QueryContext) -> Answer:
+        # top-level answers are memorized too, so a term already answered under the context (or under its
+        # shared scope) is not evaluated again
+        memorized = self.memorized_answer_for(term, context)
+        if memorized is not None:
+            return memorized
+        with self.system.evaluation(context, self.system.cycle_analysis.order_free_answers(context)):
+            return self.memorize_answer(self.query(self, term, context))
+
+    def has_memorized(self, term: Term, context: QueryContext) -> bool:
+        return (context.evaluation_scope, term, term.definer.id) in self.query_memory
+
+    def recall(self, term: Term, agent: "Agent", context: QueryContext) -> Tuple[Term, TruthValue, "ArgTree"]:
+        # the answer of the agent to the term memorized by the evaluation under way, or kept by another one
+        memorized = self.query_memory.get((context.evaluation_scope, term, agent.id))
+        if memorized is None and context.is_order_free(term, agent):
+            memorized = self.query_memory.get((context.memory_scope, term, agent.id))
+            if not isinstance(memorized, KeptAnswer):
+                return None
+            context.take(self, term, agent.id, memorized)
+        if memorized is not None:
+            context.visited(self, term, agent.id, memorized)
+        return memorized
+
+    def memorize(self, term: Term, agent: "Agent", answer: Answer, visits: List[Tuple], context: QueryContext
+                 ) -> Tuple[Term, TruthValue, "ArgTree"]:
+        memorized = answer.equivalent_term, answer.truth_value, answer.argument
+        if context.is_order_free(term, agent):
+            memorized = KeptAnswer(memorized, visits)
+            self.query_memory.keep((context.memory_scope, term, agent.id), memorized)
+        self.query_memory[(context.evaluation_scope, term, agent.id)] = memorized
+        context.memorized += 1
+        context.visited(self, term, agent.id, memorized)
+        return memorized
+
+    def memorized_answer_for(self, term: Term, context: QueryContext) -> Answer:
+        memorized = self.query_memory.get((context.memory_scope, term, self.id))
+        if memorized is None:
+            return None
+        return Answer(term, context, *memorized)
+
+    def memorize_answer(self, answer: Answer) -> Answer:
+        answer.context.memorized += 1
+        key = (answer.context.memory_scope, answer.queried_term, self.id)
+        memorized = answer.equivalent_term, answer.truth_value, answer.argument
+        if answer.context.keeps_answers:
+            self.query_memory.keep(key, memorized)
+        else:
+            self.query_memory[key] = memorized
+        return answer
 
-    def initialize_query(self, term, focus_knowledge):
-        context = self.system.new_query_context(term, self, focus_knowledge)
-        return self.query(self, term, context, [])
+    def end_query_context(self, context: QueryContext):
+        self.extended_rules_by_context.pop(context.id, None)
+        for evaluation_scope in context.evaluation_scopes():
+            self.query_memory.end_context(evaluation_scope)
+        if not context.shares_answers:
+            self.query_memory.end_context(context.id)
 
-    def query(self, sender: "Agent", term: Term, context: QueryContext, hist: List[InstantiatedTerm] = []):
+    def query(self, sender: "Agent", term: Term, context: QueryContext, hist: History = EMPTY_HISTORY):
 
-        extended_rules = self.create_extended_rules(context.focus_knowledge)
+        extended_rules = self.get_extended_rules(context)
         equivalent_term = self.look_for_similar_term(term, extended_rules)
 
         if equivalent_term is None:
@@ -204,15 +1592,21 @@ class Agent(ComparableObject):
         if self.local_ans(- equivalent_term, extended_rules):
             return Answer(term, context, equivalent_term, TruthValue.FALSE, None)
 
+        terms_on_cycles = self.system.cycle_analysis.terms_on_cycles(context)
         if equivalent_term in hist:
             # return Answer(term, context, equivalent_term, TruthValue.UNDEFINED, arg_tree_promise_for(equivalent_term))
-            _, _, arg_tree_q = self.query_agents([equivalent_term.definer], equivalent_term, context, hist)
-            ## a ideia aqui é que se já estava no historico, então o agente em questão já possui em sua query_memory
-            ## a argumentation tree
+            if self.has_memorized(equivalent_term, context):
+                _, _, arg_tree_q = self.query_agents([equivalent_term.definer], equivalent_term, context, hist)
+                ## a ideia aqui é que se já estava no historico, então o agente em questão já possui em sua query_memory
+                ## a argumentation tree
+            else:
+                # the cycle is still open, so there is no tree in the query memory yet (asking the agent again
+                # would never end)
+                arg_tree_q = arg_tree_promise_for(equivalent_term)
             unblocked_q = True
             supported_q = False
         else:
-            hist_q = hist + [equivalent_term]
+            hist_q = extend_hist(hist, equivalent_term, terms_on_cycles)
 
             unblocked_q, supported_q, arg_tree_q = self.find_support(
                 equivalent_term, extended_rules, context, hist_q
@@ -226,12 +1620,25 @@ class Agent(ComparableObject):
             ## a argumentation tree
             unblocked_neg_q = True
             supported_neg_q = False
+        elif context.repeats_expansion(- equivalent_term, hist):
+            # the expansion would never end, so the negated term is met again as in a cycle still open
+            arg_tree_neg_q = arg_tree_promise_for(- equivalent_term)
+            unblocked_neg_q = True
+            supported_neg_q = False
         else:
-            hist_neg_q = hist + [- equivalent_term]
-            unblocked_neg_q, supported_neg_q, arg_tree_neg_q = self.find_support(
-                - equivalent_term, extended_rules, context, hist_neg_q
-            )
-
+            hist_neg_q = extend_hist(hist, - equivalent_term, terms_on_cycles)
+            with context.expanding(- equivalent_term, hist_neg_q):
+                unblocked_neg_q, supported_neg_q, arg_tree_neg_q = self.find_support(
+                    - equivalent_term, extended_rules, context, hist_neg_q
+                )
+
+        return self.resolve_answer(term, context, equivalent_term,
+                                   unblocked_q, supported_q, arg_tree_q,
+                                   unblocked_neg_q, supported_neg_q, arg_tree_neg_q)
+
+    def resolve_answer(self, term, context, equivalent_term,
+                       unblocked_q, supported_q, arg_tree_q,
+                       unblocked_neg_q, supported_neg_q, arg_tree_neg_q) -> Answer:
         if supported_q and (not unblocked_neg_q or self.stronger(arg_tree_q, arg_tree_neg_q) == arg_tree_q):
             return Answer(term, context, equivalent_term, TruthValue.TRUE, arg_tree_q)
         elif supported_neg_q and (not unblocked_q or self.stronger(arg_tree_q, arg_tree_neg_q) != arg_tree_q):
@@ -239,9 +1646,15 @@ class Agent(ComparableObject):
         else:
             return Answer(term, context, equivalent_term, TruthValue.UNDEFINED, arg_tree_q)
 
-    def create_extended_rules(self, focus_knowledge) -> List[Rule]:
+    def get_extended_rules(self, context: QueryContext) -> RuleIndex:
+        # the focus knowledge of a context never changes, so it is converted only once per context
+        if context.id not in self.extended_rules_by_context:
+            self.extended_rules_by_context[context.id] = self.create_extended_rules(context.focus_knowledge)
+        return self.extended_rules_by_context[context.id]
+
+    def create_extended_rules(self, focus_knowledge) -> RuleIndex:
         converted_focus_knowledge = [self.convert_focus_rule_to_local(rule) for rule in focus_knowledge]
-        return set(self.rules).union(set(converted_focus_knowledge))
+        return RuleIndex(converted_focus_knowledge, base=self.rules)
 
     def convert_focus_rule_to_local(self, rule: Rule) -> Rule:
         return Rule(
@@ -252,33 +1665,72 @@ class Agent(ComparableObject):
     def convert_term_to_local(self, term: Term) -> Term:
         return Term(self, term.literal)
 
-    def look_for_similar_term(self, term: Term, rules: List[Rule]) -> InstantiatedTerm:
-        for rule in rules:
-            sim_degree = self.similarity(rule.head, term)
+    def look_for_similar_term(self, term: Term, rules: RuleIndex) -> InstantiatedTerm:
+        if self.system.best_match:
+            return self.look_for_most_similar_term(term, rules)
+        for head in self._candidate_heads(term, rules):
+            sim_degree = self.similarity(head, term)
             if self.similar_enough(sim_degree):
-                return InstantiatedTerm(rule.head.definer, rule.head.literal, term.literal, sim_degree)
+                return InstantiatedTerm(head.definer, head.literal, term.literal, sim_degree)
         return None
 
+    def _candidate_heads(self, term: Term, rules: RuleIndex) -> Iterable[Term]:
+        # heads with the same literal are the likely matches, so they are tried before the others; the heads
+        # the similarity matrix finds not similar enough are left out in one go
+        matrix = self.system.similarity_matrix
+        if matrix is not None and term.literal in matrix:
+            heads, rows = rules.encoded_heads(matrix)
+            candidates = matrix.similar_to(rows, term.literal, self.system.similarity_threshold) | (rows < 0)
+            same_literal = rows == matrix.index[term.literal]
+            positions = itertools.chain(numpy.flatnonzero(candidates & same_literal),
+                                        numpy.flatnonzero(candidates & ~same_literal))
+            return (heads[position] for position in positions)
+        return itertools.chain(
+            rules.heads_with_literal(term.literal),
+            (head for head in rules.heads() if head.literal != term.literal)
+        )
+
+    def look_for_most_similar_term(self, term: Term, rules: RuleIndex) -> InstantiatedTerm:
+        heads, degrees, unknown = self._head_degrees(term, rules)
+        for position in unknown:
+            degrees[position] = self.similarity(heads[position], term)
+        return self._most_similar_term(term, heads, degrees)
+
+    def _head_degrees(self, term: Term, rules: RuleIndex) -> Tuple[List[Term], numpy.ndarray, List[int]]:
+        # degrees of the heads read from the similarity matrix in one go, and the positions of the heads
+        # it does not cover
+        matrix = self.system.similarity_matrix
+        heads, rows = rules.encoded_heads(matrix)
+        degrees = matrix.degrees_to(rows, term.literal) if matrix is not None else None
+        if degrees is None:
+            return heads, numpy.zeros(len(heads)), range(len(heads))
+        return heads, degrees, numpy.flatnonzero(rows < 0).tolist()
+
+    def _most_similar_term(self, term: Term, heads: List[Term], degrees: numpy.ndarray) -> InstantiatedTerm:
+        if not heads:
+            return None
+        position = best_match(degrees, lambda position: heads[position].literal == term.literal)
+        sim_degree = degrees.item(position)
+        if not self.similar_enough(sim_degree):
+            return None
+        head = heads[position]
+        return InstantiatedTerm(head.definer, head.literal, term.literal, sim_degree)
+
     def similar_enough(self, sim_degree):
         return self.system.similar_enough(sim_degree)
 
-    def local_ans(self, term: Term, extended_rules: List[Rule]) -> bool:
-        rules_p = [rule for rule in extended_rules if isinstance(rule, StaticRule) and rule.head == term]
-        for rule in rules_p:
-            if all(self.local_ans(b, extended_rules) for b in rule.body):
-                return True
-        return False
+    def local_ans(self, term: Term, extended_rules: RuleIndex) -> bool:
+        # the strict closure is computed once for the extended rules of the context
+        return term in extended_rules.strict_closure()
 
     def find_support(self,
                      term: Term,
-                     extended_rules: List[Rule],
+                     extended_rules: RuleIndex,
                      context: QueryContext,
-                     hist_p: List[InstantiatedTerm]
+                     hist_p: History
     ) -> Tuple[bool, bool, ArgTree]:
 
-        rules_p = [rule for rule in extended_rules if rule.head == term]
-        supported_p = unblocked_p = False
-        arg_tree_p = ArgTree(SummarizedArgument(term))
+        rules_p = extended_rules.rules_for(term)
         results_found = dict()
 
         for rule in rules_p:
@@ -287,6 +1739,12 @@ class Agent(ComparableObject):
                 continue
             results_found[rule.id] = result_body_members
 
+        return self.select_support(term, results_found)
+
+    def select_support(self, term: Term, results_found: dict) -> Tuple[bool, bool, ArgTree]:
+        supported_p = unblocked_p = False
+        arg_tree_p = ArgTree(SummarizedArgument(term))
+
         for rule_id, (arg_tree_r, cycle_r) in results_found.items():
             if supported_p and cycle_r:
                 continue   # estrategia que busca sempre resultados mais positivos, buscando ignorar os ciclos
@@ -301,70 +1759,410 @@ class Agent(ComparableObject):
     def process_body_members(self,
                              rule: Rule,
                              context: QueryContext,
-                             hist_p: List[InstantiatedTerm]
+                             hist_p: History
                              ) -> Union[Tuple[ArgTree, bool], bool]:
 
         cycle_r = False
-        arg_tree_r = ArgTree(SummarizedArgument(rule.head))
+        arg_tree_r = context.new_arg_tree(rule.head)
 
         for body_member in rule.body:
 
-            if body_member.definer not in self.known_agents:
-                body_inst, tv_b, arg_tree_b = self.query_agents(self.known_agents + [self], body_member, rule,
-                                                                 context, hist_p)
-            else:
-                body_inst, tv_b, arg_tree_b = self.query_agents([body_member.definer], body_member, rule,
-                                                                 context, hist_p)
+            body_inst, tv_b, arg_tree_b = self.query_agents(self.agents_to_ask(body_member, context), body_member,
+                                                             context, hist_p)
 
             if tv_b == TruthValue.FALSE:
                 return False
 
             cycle_r = cycle_r or tv_b == TruthValue.UNDEFINED
             if body_inst.definer != self:
+                arg_tree_r.add_foreign_leaf(body_inst)
                 arg_tree_r.add_child(arg_tree_b)
 
         return arg_tree_r, cycle_r
 
+    def agents_to_ask(self, body_member: Term, context: QueryContext) -> List["Agent"]:
+        if body_member.definer not in self.known_agents:
+            agent_ids = self.system.literal_directory.agent_ids_for(body_member, context)
+            return self._agents_with_ids(agent_ids)
+        return [self.system.agents[body_member.definer.id]]
+
+    async def aagents_to_ask(self, body_member: Term, context: QueryContext) -> List["Agent"]:
+        if body_member.definer not in self.known_agents:
+            agent_ids = await self.system.literal_directory.aagent_ids_for(body_member, context)
+            return self._agents_with_ids(agent_ids)
+        return [self.system.agents[body_member.definer.id]]
+
+    def _agents_with_ids(self, agent_ids: FrozenSet) -> List["Agent"]:
+        # the agent itself is among the known agents unless it left the system, and is asked only once
+        agents = self.known_agents
+        if self not in agents:
+            agents.append(self)
+        return [agent for agent in agents if agent.id in agent_ids]
 
     def query_agents(self,
                     agents: List["Agent"],
                     term: Term,
                     context: QueryContext,
-                    hist_p: List[InstantiatedTerm]
+                    hist_p: History
                     ) -> Tuple[InstantiatedTerm, TruthValue, ArgTree]:
 
         term_inst = None
         tv_b = TruthValue.FALSE
-        arg_tree_b = ArgTree()
+        arg_tree_b = NO_ARG_TREE
 
         for agent in agents:
-            if (context.id, term, agent.id) in self.query_memory.keys():
-               term_aux, tv_aux, arg_tree_aux = self.query_memory[(context.id, term, agent.id)]
+            memorized = self.recall(term, agent, context)
+            if memorized is not None:
+               term_aux, tv_aux, arg_tree_aux = memorized
+            elif not allows_message(context, hist_p):
+               term_aux, tv_aux, arg_tree_aux = unexplored_answer(term)
             else:
-               answer = agent.query(self, term, context, hist_p)  # TODO: async
-               term_aux, tv_aux, arg_tree_aux = answer.equivalent_term, answer.truth_value, answer.arg_tree
-               self.query_memory[(context.id, term, agent.id)] = term_aux, tv_aux, arg_tree_aux
+               context.messages += 1
+               with context.visiting() as visits:
+                   answer = agent.query(self, term, context, hist_p)
+               term_aux, tv_aux, arg_tree_aux = self.memorize(term, agent, answer, visits, context)
 
             if tv_aux == TruthValue.FALSE:
                continue
             # if agent != self:
             #     arg_tree_aux = arg_tree_aux + []
             sim = self.similarity(term, term_aux)
-            if (
-                   tv_aux == TruthValue.UNDEFINED and tv_b != TruthValue.TRUE and
-                   (arg_tree_b == ArgTree() or self.stronger(arg_tree_b, arg_tree_aux) != arg_tree_b)
-            ):
-
-               tv_b = TruthValue.UNDEFINED
-               term_inst = InstantiatedTerm(agent, term_aux, term, sim)
-               arg_tree_b = arg_tree_aux
-            elif (
-                    tv_aux == TruthValue.TRUE and
-                    (arg_tree_b == ArgTree() or self.stronger(arg_tree_b, arg_tree_aux) != arg_tree_b)
-            ):
-                tv_b = TruthValue.TRUE
-                term_inst = InstantiatedTerm(agent, term_aux, term, sim)
-                arg_tree_b = arg_tree_aux
+            term_inst, tv_b, arg_tree_b = self.merge_answer(term_inst, tv_b, arg_tree_b,
+                                                            agent, term, term_aux, tv_aux, arg_tree_aux, sim)
+
+        return term_inst, tv_b, arg_tree_b
+
+    def merge_answer(self, term_inst, tv_b, arg_tree_b, agent, term, term_aux, tv_aux, arg_tree_aux, sim):
+        if (
+               tv_aux == TruthValue.UNDEFINED and tv_b != TruthValue.TRUE and
+               (term_inst is None or self.stronger(arg_tree_b, arg_tree_aux) != arg_tree_b)
+        ):
+           return InstantiatedTerm(agent, term_aux, term, sim), TruthValue.UNDEFINED, arg_tree_aux
+        elif (
+                tv_aux == TruthValue.TRUE and
+                (term_inst is None or self.stronger(arg_tree_b, arg_tree_aux) != arg_tree_b)
+        ):
+            return InstantiatedTerm(agent, term_aux, term, sim), TruthValue.TRUE, arg_tree_aux
+        return term_inst, tv_b, arg_tree_b
+
+    async def ainitialize_query(self, term, focus_knowledge, budget: QueryBudget = None):
+        context = self.system.new_query_context(term, self, focus_knowledge, budget)
+        try:
+            return await self.aanswer_in_context(term, context)
+        finally:
+            self.system.end_query_context(context)
+
+    async def aanswer_in_context(self, term: Term, context: QueryContext) -> Answer:
+        memorized = self.memorized_answer_for(term, context)
+        if memorized is not None:
+            return memorized
+        with self.system.evaluation(context, await self.system.cycle_analysis.aorder_free_answers(context)):
+            return self.memorize_answer(await self.aquery(self, term, context))
+
+    async def aquery(self, sender: "Agent", term: Term, context: QueryContext, hist: History = EMPTY_HISTORY):
+        # same algorithm as query, but the queries sent to several agents at once are awaited together
+
+        extended_rules = self.get_extended_rules(context)
+        equivalent_term = await self.alook_for_similar_term(term, extended_rules)
+
+        if equivalent_term is None:
+            return Answer(term, context, None, TruthValue.FALSE, None)
+        if self.local_ans(equivalent_term, extended_rules):
+            return Answer(term, context, equivalent_term, TruthValue.TRUE, arg_tree_leaf_for(equivalent_term))
+        if self.local_ans(- equivalent_term, extended_rules):
+            return Answer(term, context, equivalent_term, TruthValue.FALSE, None)
+
+        terms_on_cycles = await self.system.cycle_analysis.aterms_on_cycles(context)
+        if equivalent_term in hist:
+            if self.has_memorized(equivalent_term, context):
+                _, _, arg_tree_q = await self.aquery_agents([equivalent_term.definer], equivalent_term, context,
+                                                            hist)
+            else:
+                arg_tree_q = arg_tree_promise_for(equivalent_term)
+            unblocked_q = True
+            supported_q = False
+        else:
+            hist_q = extend_hist(hist, equivalent_term, terms_on_cycles)
+            unblocked_q, supported_q, arg_tree_q = await self.afind_support(
+                equivalent_term, extended_rules, context, hist_q
+            )
+            if not unblocked_q:
+                return Answer(term, context, equivalent_term, TruthValue.FALSE, None)
+
+        if (- equivalent_term).has_instantiated_term_in(hist):
+            _, _, arg_tree_neg_q = await self.aquery_agents([(-equivalent_term).definer], -equivalent_term,
+                                                            context, hist)
+            unblocked_neg_q = True
+            supported_neg_q = False
+        elif context.repeats_expansion(- equivalent_term, hist):
+            arg_tree_neg_q = arg_tree_promise_for(- equivalent_term)
+            unblocked_neg_q = True
+            supported_neg_q = False
+        else:
+            hist_neg_q = extend_hist(hist, - equivalent_term, terms_on_cycles)
+            with context.expanding(- equivalent_term, hist_neg_q):
+                unblocked_neg_q, supported_neg_q, arg_tree_neg_q = await self.afind_support(
+                    - equivalent_term, extended_rules, context, hist_neg_q
+                )
+
+        return self.resolve_answer(term, context, equivalent_term,
+                                   unblocked_q, supported_q, arg_tree_q,
+                                   unblocked_neg_q, supported_neg_q, arg_tree_neg_q)
+
+    async def alook_for_similar_term(self, term: Term, rules: RuleIndex) -> InstantiatedTerm:
+        if self.system.best_match:
+            heads, degrees, unknown = self._head_degrees(term, rules)
+            for position in unknown:
+                degrees[position] = await self.system.asimilarity(heads[position], term)
+            return self._most_similar_term(term, heads, degrees)
+        for head in self._candidate_heads(term, rules):
+            sim_degree = await self.system.asimilarity(head, term)
+            if self.similar_enough(sim_degree):
+                return InstantiatedTerm(head.definer, head.literal, term.literal, sim_degree)
+        return None
+
+    async def afind_support(self,
+                            term: Term,
+                            extended_rules: RuleIndex,
+                            context: QueryContext,
+                            hist_p: History
+    ) -> Tuple[bool, bool, ArgTree]:
+
+        results_found = dict()
+
+        for rule in extended_rules.rules_for(term):
+            result_body_members = await self.aprocess_body_members(rule, context, hist_p)
+            if not result_body_members:
+                continue
+            results_found[rule.id] = result_body_members
+
+        return self.select_support(term, results_found)
+
+    async def aprocess_body_members(self,
+                                    rule: Rule,
+                                    context: QueryContext,
+                                    hist_p: History
+                                    ) -> Union[Tuple[ArgTree, bool], bool]:
+
+        cycle_r = False
+        arg_tree_r = context.new_arg_tree(rule.head)
+
+        for body_member in rule.body:
+            body_inst, tv_b, arg_tree_b = await self.aquery_agents(await self.aagents_to_ask(body_member, context),
+                                                                    body_member, context, hist_p)
+            if tv_b == TruthValue.FALSE:
+                return False
+
+            cycle_r = cycle_r or tv_b == TruthValue.UNDEFINED
+            if body_inst.definer != self:
+                arg_tree_r.add_foreign_leaf(body_inst)
+                arg_tree_r.add_child(arg_tree_b)
+
+        return arg_tree_r, cycle_r
+
+    async def aquery_agents(self,
+                            agents: List["Agent"],
+                            term: Term,
+                            context: QueryContext,
+                            hist_p: History
+                            ) -> Tuple[InstantiatedTerm, TruthValue, ArgTree]:
+
+        # the agents are only asked all at once when no answer can depend on the order they are asked in: with
+        # cycles, what one of them memorizes while a cycle is open changes what the next ones answer
+        results = None
+        if await self.system.cycle_analysis.aasks_together(agents, term, context):
+            results = await self.aquery_agents_together(agents, term, context, hist_p)
+
+        term_inst = None
+        tv_b = TruthValue.FALSE
+        arg_tree_b = NO_ARG_TREE
+
+        for agent in agents:
+            if results is not None:
+                term_aux, tv_aux, arg_tree_aux = results[agent]
+            else:
+                term_aux, tv_aux, arg_tree_aux = await self.aquery_agent(agent, term, context, hist_p)
+            if tv_aux == TruthValue.FALSE:
+                continue
+            sim = await self.system.asimilarity(term, term_aux)
+            term_inst, tv_b, arg_tree_b = self.merge_answer(term_inst, tv_b, arg_tree_b,
+                                                            agent, term, term_aux, tv_aux, arg_tree_aux, sim)
+
+        return term_inst, tv_b, arg_tree_b
+
+    async def aquery_agent(self, agent: "Agent", term: Term, context: QueryContext, hist_p: History
+                           ) -> Tuple[Term, TruthValue, ArgTree]:
+        memorized = self.recall(term, agent, context)
+        if memorized is not None:
+            return memorized
+        if not allows_message(context, hist_p):
+            return unexplored_answer(term)
+        context.messages += 1
+        with context.visiting() as visits:
+            answer = await agent.aquery(self, term, context, hist_p)
+        return self.memorize(term, agent, answer, visits, context)
+
+    async def aquery_agents_together(self, agents: List["Agent"], term: Term, context: QueryContext,
+                                     hist_p: History) -> Dict["Agent", Tuple[Term, TruthValue, ArgTree]]:
+        results = dict()
+        for agent in dict.fromkeys(agents):
+            memorized = self.recall(term, agent, context)
+            if memorized is not None:
+                results[agent] = memorized
+
+        pending = [agent for agent in dict.fromkeys(agents) if agent not in results]
+        context.messages += len(pending)
+        branches = [context.branch() for _ in pending]
+        spent = [branch.spent() for branch in branches]
+        answers = await asyncio.gather(*[self._aquery_branch(agent, term, branch, hist_p)
+                                         for agent, branch in zip(pending, branches)])
+        for agent, branch, branch_spent, (answer, visits) in zip(pending, branches, spent, answers):
+            context.add_spent(branch.spent_since(branch_spent))
+            # a nested query may have asked the same agent meanwhile, for the same answer
+            memorized = self.recall(term, agent, context)
+            results[agent] = memorized if memorized is not None else self.memorize(term, agent, answer, visits,
+                                                                                 context)
+        return results
+
+    async def _aquery_branch(self, agent: "Agent", term: Term, branch: QueryContext, hist_p: History
+                             ) -> Tuple[Answer, List[Tuple]]:
+        with branch.visiting() as visits:
+            answer = await agent.aquery(self, term, branch, hist_p)
+        return answer, visits
+
+    def initialize_query_iteratively(self, term, focus_knowledge, budget: QueryBudget = None):
+        context = self.system.new_query_context(term, self, focus_knowledge, budget)
+        try:
+            return run_iteratively(self.ianswer_in_context(term, context))
+        finally:
+            self.system.end_query_context(context)
+
+    def ianswer_in_context(self, term: Term, context: QueryContext) -> Generator:
+        memorized = self.memorized_answer_for(term, context)
+        if memorized is not None:
+            return memorized
+        with self.system.evaluation(context, self.system.cycle_analysis.order_free_answers(context)):
+            return self.memorize_answer((yield self.iquery(self, term, context)))
+
+    def iquery(self, sender: "Agent", term: Term, context: QueryContext, hist: History = EMPTY_HISTORY
+               ) -> Generator:
+        # same algorithm as query, written as generators driven by run_iteratively: every nested call is
+        # yielded instead of made, and its result is sent back
+
+        extended_rules = self.get_extended_rules(context)
+        equivalent_term = self.look_for_similar_term(term, extended_rules)
+
+        if equivalent_term is None:
+            return Answer(term, context, None, TruthValue.FALSE, None)
+        if self.local_ans(equivalent_term, extended_rules):
+            return Answer(term, context, equivalent_term, TruthValue.TRUE, arg_tree_leaf_for(equivalent_term))
+        if self.local_ans(- equivalent_term, extended_rules):
+            return Answer(term, context, equivalent_term, TruthValue.FALSE, None)
+
+        terms_on_cycles = self.system.cycle_analysis.terms_on_cycles(context)
+        if equivalent_term in hist:
+            if self.has_memorized(equivalent_term, context):
+                _, _, arg_tree_q = yield self.iquery_agents([equivalent_term.definer], equivalent_term, context,
+                                                            hist)
+            else:
+                arg_tree_q = arg_tree_promise_for(equivalent_term)
+            unblocked_q = True
+            supported_q = False
+        else:
+            hist_q = extend_hist(hist, equivalent_term, terms_on_cycles)
+            unblocked_q, supported_q, arg_tree_q = yield self.ifind_support(
+                equivalent_term, extended_rules, context, hist_q
+            )
+            if not unblocked_q:
+                return Answer(term, context, equivalent_term, TruthValue.FALSE, None)
+
+        if (- equivalent_term).has_instantiated_term_in(hist):
+            _, _, arg_tree_neg_q = yield self.iquery_agents([(-equivalent_term).definer], -equivalent_term,
+                                                            context, hist)
+            unblocked_neg_q = True
+            supported_neg_q = False
+        elif context.repeats_expansion(- equivalent_term, hist):
+            arg_tree_neg_q = arg_tree_promise_for(- equivalent_term)
+            unblocked_neg_q = True
+            supported_neg_q = False
+        else:
+            hist_neg_q = extend_hist(hist, - equivalent_term, terms_on_cycles)
+            with context.expanding(- equivalent_term, hist_neg_q):
+                unblocked_neg_q, supported_neg_q, arg_tree_neg_q = yield self.ifind_support(
+                    - equivalent_term, extended_rules, context, hist_neg_q
+                )
+
+        return self.resolve_answer(term, context, equivalent_term,
+                                   unblocked_q, supported_q, arg_tree_q,
+                                   unblocked_neg_q, supported_neg_q, arg_tree_neg_q)
+
+    def ifind_support(self,
+                      term: Term,
+                      extended_rules: RuleIndex,
+                      context: QueryContext,
+                      hist_p: History
+                      ) -> Generator:
+
+        results_found = dict()
+
+        for rule in extended_rules.rules_for(term):
+            result_body_members = yield self.iprocess_body_members(rule, context, hist_p)
+            if not result_body_members:
+                continue
+            results_found[rule.id] = result_body_members
+
+        return self.select_support(term, results_found)
+
+    def iprocess_body_members(self,
+                              rule: Rule,
+                              context: QueryContext,
+                              hist_p: History
+                              ) -> Generator:
+
+        cycle_r = False
+        arg_tree_r = context.new_arg_tree(rule.head)
+
+        for body_member in rule.body:
+            body_inst, tv_b, arg_tree_b = yield self.iquery_agents(self.agents_to_ask(body_member, context),
+                                                                   body_member, context, hist_p)
+            if tv_b == TruthValue.FALSE:
+                return False
+
+            cycle_r = cycle_r or tv_b == TruthValue.UNDEFINED
+            if body_inst.definer != self:
+                arg_tree_r.add_foreign_leaf(body_inst)
+                arg_tree_r.add_child(arg_tree_b)
+
+        return arg_tree_r, cycle_r
+
+    def iquery_agents(self,
+                      agents: List["Agent"],
+                      term: Term,
+                      context: QueryContext,
+                      hist_p: History
+                      ) -> Generator:
+
+        term_inst = None
+        tv_b = TruthValue.FALSE
+        arg_tree_b = NO_ARG_TREE
+
+        for agent in agents:
+            memorized = self.recall(term, agent, context)
+            if memorized is not None:
+                term_aux, tv_aux, arg_tree_aux = memorized
+            elif not allows_message(context, hist_p):
+                term_aux, tv_aux, arg_tree_aux = unexplored_answer(term)
+            else:
+                context.messages += 1
+                with context.visiting() as visits:
+                    answer = yield agent.iquery(self, term, context, hist_p)
+                term_aux, tv_aux, arg_tree_aux = self.memorize(term, agent, answer, visits, context)
+
+            if tv_aux == TruthValue.FALSE:
+                continue
+            sim = self.similarity(term, term_aux)
+            term_inst, tv_b, arg_tree_b = self.merge_answer(term_inst, tv_b, arg_tree_b,
+                                                            agent, term, term_aux, tv_aux, arg_tree_aux, sim)
 
         return term_inst, tv_b, arg_tree_b
 
@@ -382,11 +2180,14 @@ class Agent(ComparableObject):
         return arg_tree2
 
     def calculate_arg_tree_rank(self, arg_tree: ArgTree):
-        support_set = arg_tree.get_all_foreign_leaves()
-        return sum([self.calculate_term_rank(term) for term in support_set])
+        if arg_tree is NO_ARG_TREE:
+            return 0
+        if self.id not in arg_tree.ranks:
+            arg_tree.ranks[self.id] = arg_tree.rank(self.preference_function)
+        return arg_tree.ranks[self.id]
 
     def calculate_term_rank(self, term: InstantiatedTerm):
-        return self.preference_function(term.definer) * term.sim_degree
+        return self.preference_function.get(term.definer.id, 0) * term.sim_degree
 
     def _key(self):
         return self.id
@@ -0,0 +1,195 @@
+"""
+Scaling benchmarks of the query engines over generated scenarios.
+
+    python benchmarks.py                          # runs the suite and prints the results
+    python benchmarks.py --save baseline.json     # ... and saves them as a baseline
+    python benchmarks.py --compare baseline.json  # ... and reports the regressions against a baseline
+
+Each case changes one dimension of the base scenario. Wall time is the best of the repetitions, peak memory is
+measured in a separate run (tracemalloc slows the engine down) and messages are the queries sent between agents.
+"""
+import argparse
+import asyncio
+import json
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Tuple
+
+from scenario_generator import ScenarioParameters, generate_scenario
+
+BASE_PARAMETERS = ScenarioParameters(
+    agent_count=5,
+    rules_per_agent=20,
+    chain_depth=3,
+    body_width=2,
+    any_agent_share=0.3,
+    cycle_density=0.0,
+    similar_literals=2,
+    similarity_spread=0.1,
+    query_count=5,
+)
+
+DIMENSIONS = dict(
+    agent_count=[5, 10, 20],
+    rules_per_agent=[10, 20, 40],
+    chain_depth=[2, 3, 5],
+    body_width=[1, 2, 3],
+    any_agent_share=[0.0, 0.3, 0.6],
+    cycle_density=[0.0, 0.05, 0.1],
+    similarity_spread=[0.0, 0.1, 0.3],
+)
+
+
+def run_sync(scenario):
+    return [term.definer.initialize_query(term, scenario.focus_knowledge) for term in scenario.query_terms]
+
+
+def run_async(scenario):
+    loop = asyncio.new_event_loop()
+    try:
+        return [loop.run_until_complete(scenario.system.aquery(term, scenario.focus_knowledge))
+                for term in scenario.query_terms]
+    finally:
+        loop.close()
+
+
+def run_iterative(scenario):
+    return [term.definer.initialize_query_iteratively(term, scenario.focus_knowledge)
+            for term in scenario.query_terms]
+
+
+def run_threads(scenario):
+    answers = scenario.system.query_in_parallel(scenario.query_terms, scenario.focus_knowledge)
+    return [answers[term] for term in scenario.query_terms]
+
+
+def run_verdict_only(scenario):
+    scenario.system.verdict_only = True
+    return run_sync(scenario)
+
+
+ENGINES = {"sync": run_sync, "async": run_async, "iterative": run_iterative, "threads": run_threads,
+           "verdict": run_verdict_only}
+
+
+def benchmark_cases(base: ScenarioParameters = BASE_PARAMETERS,
+                    dimensions: Dict[str, list] = None) -> List[Tuple[str, ScenarioParameters]]:
+    dimensions = DIMENSIONS if dimensions is None else dimensions
+    cases = [("base", base)]
+    for name, values in dimensions.items():
+        for value in values:
+            if value != getattr(base, name):
+                cases.append(("{}={}".format(name, value), base.replace(**{name: value})))
+    return cases
+
+
+def run_case(params: ScenarioParameters, engine: str = "sync", repeat: int = 3) -> dict:
+    run = ENGINES[engine]
+    result = dict(params=dict(params.__dict__))
+
+    try:
+        wall_times = []
+        for _ in range(repeat):
+            scenario = generate_scenario(params)
+            start = time.perf_counter()
+            answers = run(scenario)
+            wall_times.append(time.perf_counter() - start)
+
+        scenario = generate_scenario(params)
+        tracemalloc.start()
+        try:
+            run(scenario)
+            _, peak_memory = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    except RecursionError:
+        result["error"] = "RecursionError"
+        return result
+
+    result.update(
+        rules=scenario.rule_count,
+        wall_time=min(wall_times),
+        peak_memory=peak_memory,
+        messages=scenario.system.messages_sent,
+        answers=dict(Counter(answer.truth_value.name for answer in answers)),
+    )
+    return result
+
+
+def run_suite(cases: List[Tuple[str, ScenarioParameters]], engine: str = "sync", repeat: int = 3,
+              out=sys.stdout) -> dict:
+    results = dict(engine=engine, cases=dict())
+    for name, params in cases:
+        result = run_case(params, engine, repeat)
+        results["cases"][name] = result
+        if out is not None:
+            out.write(format_result(name, result) + "\n")
+    return results
+
+
+def format_result(name: str, result: dict) -> str:
+    if "error" in result:
+        return "{:<24} {}".format(name, result["error"])
+    return "{:<24} rules={:<6} time={:>9.2f}ms memory={:>8.1f}KiB messages={:<7} answers={}".format(
+        name, result["rules"], result["wall_time"] * 1000, result["peak_memory"] / 1024, result["messages"],
+        result["answers"])
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.2) -> List[str]:
+    """
+    Lists the cases in which a metric got worse than the baseline by more than the tolerance
+    (messages and answers do not depend on the machine, so any change in them is reported).
+    """
+    if results["engine"] != baseline["engine"]:
+        return ["the baseline was measured with the {} engine".format(baseline["engine"])]
+    regressions = []
+    for name, result in results["cases"].items():
+        expected = baseline["cases"].get(name)
+        if expected is None or "error" in expected:
+            continue
+        if "error" in result:
+            regressions.append("{}: {}".format(name, result["error"]))
+            continue
+        if result["params"] != expected["params"]:
+            regressions.append("{}: parameters differ from the baseline".format(name))
+            continue
+        for metric in ("wall_time", "peak_memory"):
+            if result[metric] > expected[metric] * (1 + tolerance):
+                regressions.append("{}: {} {:.4g} > {:.4g}".format(name, metric, result[metric], expected[metric]))
+        if result["messages"] != expected["messages"]:
+            regressions.append("{}: messages {} != {}".format(name, result["messages"], expected["messages"]))
+        if result["answers"] != expected["answers"]:
+            regressions.append("{}: answers {} != {}".format(name, result["answers"], expected["answers"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--engine", choices=sorted(ENGINES), default="sync")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--dimension", action="append", choices=sorted(DIMENSIONS),
+                        help="only vary these dimensions (may be repeated)")
+    parser.add_argument("--save", metavar="PATH", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results with a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    dimensions = {name: DIMENSIONS[name] for name in args.dimension} if args.dimension else DIMENSIONS
+    results = run_suite(benchmark_cases(BASE_PARAMETERS, dimensions), args.engine, args.repeat)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,490 @@
+import array
+import json
+import mmap
+import struct
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+
+import numpy
+
+from agent_sync_arguments import Agent, Literal, MultiAgentSystem, Rule, StaticRule, Term
+from similarity import SimilarityMatrix
+
+MAGIC = b"DDRMASKB"
+FORMAT_VERSION = 1
+ALIGNMENT = 8
+# rules decoded and kept by each compiled rule index, the least recently used ones being dropped
+MAX_DECODED_RULES = 4096
+
+
+class SymbolTable:
+    """
+    Maps the symbols of the literals to codes 1, 2, ...; a literal is encoded as the code of its symbol,
+    negated for a negative literal, so the complement of a literal is the opposite integer.
+    """
+
+    def __init__(self, symbols: Iterable[str] = ()):
+        self.symbols = []
+        self._codes = dict()
+        self._codes_of_strings = dict()
+        for symbol in symbols:
+            self.code_of_symbol(symbol)
+
+    @classmethod
+    def from_sequence(cls, symbols: Sequence[str]) -> "SymbolTable":
+        # the symbols are indexed on the first lookup, so a table loaded from a file costs nothing until then
+        table = cls()
+        table.symbols = symbols
+        table._codes = None
+        return table
+
+    @property
+    def codes(self) -> Dict[str, int]:
+        if self._codes is None:
+            self._codes = {symbol: code for code, symbol in enumerate(self.symbols, 1)}
+        return self._codes
+
+    def code_of_symbol(self, symbol: str) -> int:
+        code = self.codes.get(symbol)
+        if code is None:
+            if not isinstance(self.symbols, list):
+                self.symbols = list(self.symbols)
+            self.symbols.append(symbol)
+            code = self.codes[symbol] = len(self.symbols)
+        return code
+
+    def encode(self, literal: Literal) -> int:
+        code = self.code_of_symbol(literal.symbol)
+        return code if literal.positive else -code
+
+    def encode_string(self, string_literal: str) -> int:
+        # literals in the tuple format ("¬ed(m1)") are parsed once, however many rules use them
+        code = self._codes_of_strings.get(string_literal)
+        if code is None:
+            positive = string_literal[0] != "¬"
+            code = self.code_of_symbol(string_literal if positive else string_literal[1:])
+            code = self._codes_of_strings[string_literal] = code if positive else -code
+        return code
+
+    def code_of(self, literal: Literal) -> int:
+        # None for a literal whose symbol is not in the table
+        code = self.codes.get(literal.symbol)
+        if code is None:
+            return None
+        return code if literal.positive else -code
+
+    def decode(self, code: int) -> Literal:
+        return Literal(self.symbols[abs(code) - 1], code > 0)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+
+class KnowledgeBaseWriter:
+    """
+    Collects the rules of the agents, one agent after the other, into growable typed arrays.
+    """
+
+    def __init__(self, symbols: SymbolTable = None):
+        self.symbols = symbols if symbols is not None else SymbolTable()
+        self.definers = []
+        self.definer_codes = dict()
+        self.agent_ids = []
+        self.agent_starts = array.array("q", [0])
+        self.rule_ids = []
+        self.rule_agent = array.array("i")
+        self.rule_head_definer = array.array("i")
+        self.rule_head = array.array("i")
+        self.rule_strict = array.array("b")
+        self.body_offsets = array.array("q", [0])
+        self.body_definers = array.array("i")
+        self.body_literals = array.array("i")
+        self.preference_functions = dict()
+        self._agent_rule_keys = set()
+
+    def definer_code(self, definer: str) -> int:
+        code = self.definer_codes.get(definer)
+        if code is None:
+            self.definers.append(definer)
+            code = self.definer_codes[definer] = len(self.definers) - 1
+        return code
+
+    def start_agent(self, agent_id: str, preference_function: Dict[str, float] = None):
+        if agent_id in self.agent_ids:
+            raise ValueError("the rules of agent {} were already written".format(agent_id))
+        self.agent_ids.append(agent_id)
+        self.preference_functions[agent_id] = dict(preference_function or {})
+        self.agent_starts.append(len(self.rule_ids))
+        self._agent_rule_keys = set()
+
+    def add_rule(self, rule_id: str, head: Tuple[str, int], body: List[Tuple[str, int]], strict: bool = False):
+        # as in RuleIndex, a rule with the same head and body as a previous one of the agent is left out
+        key = (head, tuple(body))
+        if key in self._agent_rule_keys:
+            return
+        self._agent_rule_keys.add(key)
+        self.rule_ids.append(rule_id)
+        self.rule_agent.append(self.definer_code(self.agent_ids[-1]))
+        self.rule_head_definer.append(self.definer_code(head[0]))
+        self.rule_head.append(head[1])
+        self.rule_strict.append(strict)
+        for definer, literal_code in body:
+            self.body_definers.append(self.definer_code(definer))
+            self.body_literals.append(literal_code)
+        self.body_offsets.append(len(self.body_literals))
+        self.agent_starts[-1] = len(self.rule_ids)
+
+    def add_tuple_rule(self, tuple_rule):
+        rule_id, (head_definer, head_literal), body = tuple_rule
+        self.add_rule(rule_id, (head_definer, self.symbols.encode_string(head_literal)),
+                      [(definer, self.symbols.encode_string(literal)) for definer, literal in body])
+
+    def add_rule_object(self, rule: Rule):
+        self.add_rule(rule.id, (definer_name(rule.head.definer), self.symbols.encode(rule.head.literal)),
+                      [(definer_name(term.definer), self.symbols.encode(term.literal)) for term in rule.body],
+                      isinstance(rule, StaticRule))
+
+    def compile(self) -> "CompiledKnowledgeBase":
+        return CompiledKnowledgeBase(
+            self.symbols, self.definers, self.agent_ids, numpy.array(self.agent_starts, dtype=numpy.int64),
+            self.rule_ids,
+            numpy.array(self.rule_agent, dtype=numpy.int32), numpy.array(self.rule_head_definer, dtype=numpy.int32),
+            numpy.array(self.rule_head, dtype=numpy.int32), numpy.array(self.rule_strict, dtype=numpy.bool_),
+            numpy.array(self.body_offsets, dtype=numpy.int64), numpy.array(self.body_definers, dtype=numpy.int32),
+            numpy.array(self.body_literals, dtype=numpy.int32), preference_functions=self.preference_functions,
+        )
+
+
+def definer_name(definer) -> str:
+    return definer.id if isinstance(definer, Agent) else definer
+
+
+class CompiledKnowledgeBase:
+    """
+    Rules of all the agents of a system stored as arrays, one entry per rule: owner agent, head (definer code
+    and signed literal code) and strict flag, with the bodies of all rules concatenated and delimited by
+    body_offsets. The rules of an agent are contiguous (agent_starts), and head_order sorts each agent's
+    rules by head literal (keeping their order otherwise) for binary search in sorted_heads.
+    """
+
+    def __init__(self, symbols: SymbolTable, definers: List[str], agent_ids: List[str], agent_starts: numpy.ndarray,
+                 rule_ids: Sequence[str], rule_agent: numpy.ndarray, rule_head_definer: numpy.ndarray,
+                 rule_head: numpy.ndarray, rule_strict: numpy.ndarray, body_offsets: numpy.ndarray,
+                 body_definers: numpy.ndarray, body_literals: numpy.ndarray, head_order: numpy.ndarray = None,
+                 sorted_heads: numpy.ndarray = None, preference_functions: Dict[str, Dict[str, float]] = None):
+        self.symbols = symbols
+        self.definers = definers
+        self.definer_codes = {definer: code for code, definer in enumerate(definers)}
+        self.agent_ids = agent_ids
+        self.agent_starts = agent_starts
+        self.rule_ids = rule_ids
+        self.rule_agent = rule_agent
+        self.rule_head_definer = rule_head_definer
+        self.rule_head = rule_head
+        self.rule_strict = rule_strict
+        self.body_offsets = body_offsets
+        self.body_definers = body_definers
+        self.body_literals = body_literals
+        self.head_order = head_order if head_order is not None else self._sort_heads()
+        self.sorted_heads = sorted_heads if sorted_heads is not None else rule_head[self.head_order]
+        self.preference_functions = preference_functions if preference_functions is not None else dict()
+
+    @classmethod
+    def from_tuple_rules(cls, tuple_rules_by_agent: Dict[str, list], symbols: SymbolTable = None,
+                         preference_functions: Dict[str, Dict[str, float]] = None) -> "CompiledKnowledgeBase":
+        preference_functions = preference_functions if preference_functions is not None else dict()
+        writer = KnowledgeBaseWriter(symbols)
+        for agent_id, tuple_rules in tuple_rules_by_agent.items():
+            writer.start_agent(agent_id, preference_functions.get(agent_id))
+            for tuple_rule in tuple_rules:
+                writer.add_tuple_rule(tuple_rule)
+        return writer.compile()
+
+    @classmethod
+    def from_agents(cls, agents: Iterable[Agent], symbols: SymbolTable = None) -> "CompiledKnowledgeBase":
+        writer = KnowledgeBaseWriter(symbols)
+        for agent in agents:
+            writer.start_agent(agent.id, agent.preference_function)
+            for rule in agent.rules:
+                writer.add_rule_object(rule)
+        return writer.compile()
+
+    def _sort_heads(self) -> numpy.ndarray:
+        head_order = numpy.empty(len(self.rule_head), dtype=numpy.int64)
+        for start, end in zip(self.agent_starts[:-1], self.agent_starts[1:]):
+            head_order[start:end] = start + numpy.argsort(self.rule_head[start:end], kind="stable")
+        return head_order
+
+    def __len__(self) -> int:
+        return len(self.rule_head)
+
+    def agent_range(self, agent_id: str) -> Tuple[int, int]:
+        position = self.agent_ids.index(agent_id)
+        return int(self.agent_starts[position]), int(self.agent_starts[position + 1])
+
+    def rules_with_head_literal(self, literal: Literal) -> numpy.ndarray:
+        # positions of the rules of any agent with the given head literal, found with one scan of the array
+        code = self.symbols.code_of(literal)
+        if code is None:
+            return numpy.empty(0, dtype=numpy.int64)
+        return numpy.flatnonzero(self.rule_head == code)
+
+    def rule_index(self, agent_id: str, system: MultiAgentSystem,
+                   max_rules: int = MAX_DECODED_RULES) -> "CompiledRuleIndex":
+        return CompiledRuleIndex(self, agent_id, system, max_rules)
+
+    def install(self, system: MultiAgentSystem):
+        """
+        Gives every agent of the knowledge base its compiled rules and its preferences, creating the agents
+        missing in the system.
+        """
+        for agent_id in self.agent_ids:
+            if agent_id not in system.agents:
+                system.agents[agent_id] = Agent(agent_id, system)
+        for agent_id in self.agent_ids:
+            agent = system.agents[agent_id]
+            agent.load_rules(self.rule_index(agent_id, system))
+            agent.preference_function.update(self.preference_functions.get(agent_id, {}))
+
+    def save(self, path: str):
+        """
+        Writes the knowledge base in the binary format read by load_knowledge_base: the magic bytes, the format
+        version and the size of a JSON header, the header (names, preferences and the layout of the arrays),
+        then the arrays in little-endian order, each one aligned on 8 bytes.
+        """
+        symbol_offsets, symbol_bytes = encode_strings(self.symbols.symbols)
+        rule_id_offsets, rule_id_bytes = encode_strings(self.rule_ids)
+        arrays = dict(
+            agent_starts=self.agent_starts, rule_agent=self.rule_agent, rule_head_definer=self.rule_head_definer,
+            rule_head=self.rule_head, rule_strict=self.rule_strict, body_offsets=self.body_offsets,
+            body_definers=self.body_definers, body_literals=self.body_literals, head_order=self.head_order,
+            sorted_heads=self.sorted_heads, symbol_offsets=symbol_offsets, symbol_bytes=symbol_bytes,
+            rule_id_offsets=rule_id_offsets, rule_id_bytes=rule_id_bytes,
+        )
+        layout = dict()
+        offset = 0
+        for name, values in arrays.items():
+            values = arrays[name] = numpy.ascontiguousarray(values, dtype=numpy.dtype(values.dtype).newbyteorder("<"))
+            layout[name] = (values.dtype.str, offset, len(values))
+            offset = aligned(offset + values.nbytes)
+        header = json.dumps(dict(definers=self.definers, agent_ids=self.agent_ids,
+                                 preference_functions=self.preference_functions, arrays=layout)).encode("utf-8")
+
+        with open(path, "wb") as file:
+            file.write(MAGIC + struct.pack("<II", FORMAT_VERSION, len(header)) + header)
+            file.write(bytes(aligned(file.tell()) - file.tell()))
+            start = file.tell()
+            for name, values in arrays.items():
+                file.write(bytes(start + layout[name][1] - file.tell()))
+                file.write(values.tobytes())
+
+
+class CompiledRuleIndex:
+    """
+    Read-only RuleIndex over the rules of one agent in a compiled knowledge base. Rules and terms are only
+    built from the arrays when they are reached: the heads are then kept, the rules up to max_rules of them.
+    Definers are looked up in the agents of the system, so the terms are built again if they are replaced.
+    """
+    version = 0
+    base = None
+
+    def __init__(self, knowledge_base: CompiledKnowledgeBase, agent_id: str, system: MultiAgentSystem,
+                 max_rules: int = MAX_DECODED_RULES):
+        self.knowledge_base = knowledge_base
+        self.system = system
+        self.max_rules = max_rules
+        self.start, self.end = knowledge_base.agent_range(agent_id)
+        self._sorted_positions = knowledge_base.head_order[self.start:self.end]
+        self._sorted_heads = knowledge_base.sorted_heads[self.start:self.end]
+        self._agents = system.agents
+        self._rules = OrderedDict()
+        self._heads = None
+        self._encoded_heads = None
+        self._lock = threading.Lock()
+
+    def _definer(self, code: int):
+        definer = self.knowledge_base.definers[code]
+        return self.system.agents.get(definer, definer)
+
+    def _check_agents(self):
+        # terms built for agents no longer in the system are dropped
+        if self.system.agents is not self._agents:
+            with self._lock:
+                self._agents = self.system.agents
+                self._rules = OrderedDict()
+                self._heads = None
+                self._encoded_heads = None
+
+    def _term(self, definer_code: int, literal_code: int) -> Term:
+        return Term(self._definer(definer_code), self.knowledge_base.symbols.decode(literal_code))
+
+    def _rule(self, position: int) -> Rule:
+        self._check_agents()
+        rules = self._rules
+        rule = rules.get(position)
+        if rule is not None:
+            with self._lock:
+                if position in rules:
+                    rules.move_to_end(position)
+            return rule
+        kb = self.knowledge_base
+        head = self._term(kb.rule_head_definer[position], kb.rule_head[position])
+        body_start, body_end = kb.body_offsets[position], kb.body_offsets[position + 1]
+        body = [self._term(definer, literal) for definer, literal in
+                zip(kb.body_definers[body_start:body_end].tolist(), kb.body_literals[body_start:body_end].tolist())]
+        rule_class = StaticRule if kb.rule_strict[position] else Rule
+        rule = rule_class(kb.rule_ids[position], head, body)
+        with self._lock:
+            rules[position] = rule
+            if len(rules) > self.max_rules:
+                rules.popitem(last=False)
+        return rule
+
+    def _positions_with_literal(self, literal: Literal) -> List[int]:
+        code = self.knowledge_base.symbols.code_of(literal)
+        if code is None:
+            return []
+        low = numpy.searchsorted(self._sorted_heads, code, side="left")
+        high = numpy.searchsorted(self._sorted_heads, code, side="right")
+        return self._sorted_positions[low:high].tolist()
+
+    def _positions_with_head(self, head: Term) -> List[int]:
+        definer_code = self.knowledge_base.definer_codes.get(definer_name(head.definer))
+        return [position for position in self._positions_with_literal(head.literal)
+                if self.knowledge_base.rule_head_definer[position] == definer_code]
+
+    def has_head(self, head: Term) -> bool:
+        return bool(self._positions_with_head(head))
+
+    def rules_for(self, head: Term) -> List[Rule]:
+        return [self._rule(position) for position in self._positions_with_head(head)]
+
+    def strict_rules_for(self, head: Term) -> List[Rule]:
+        return [self._rule(position) for position in self._positions_with_head(head)
+                if self.knowledge_base.rule_strict[position]]
+
+    def strict_rules(self) -> Iterator[Rule]:
+        for position in numpy.flatnonzero(self.knowledge_base.rule_strict[self.start:self.end]).tolist():
+            yield self._rule(self.start + position)
+
+    def heads(self) -> Iterator[Term]:
+        return iter(self._head_terms()[1])
+
+    def _head_terms(self) -> Tuple[List[int], List[Term]]:
+        # the literal codes and the terms of the heads, in the order of the first rule of each head as in RuleIndex
+        self._check_agents()
+        heads = self._heads
+        if heads is None:
+            kb = self.knowledge_base
+            pairs = list(dict.fromkeys(zip(kb.rule_head_definer[self.start:self.end].tolist(),
+                                           kb.rule_head[self.start:self.end].tolist())))
+            heads = self._heads = ([literal for _, literal in pairs],
+                                   [self._term(definer, literal) for definer, literal in pairs])
+        return heads
+
+    def encoded_heads(self, matrix: SimilarityMatrix) -> Tuple[List[Term], numpy.ndarray]:
+        """
+        As RuleIndex.encoded_heads, with each literal code of the heads looked up in the matrix only once.
+        """
+        codes, heads = self._head_terms()
+        encoded = self._encoded_heads
+        if encoded is None or encoded[0] is not matrix:
+            rows = None
+            if matrix is not None:
+                unique_codes, inverse = numpy.unique(numpy.array(codes, dtype=numpy.int64), return_inverse=True)
+                rows = matrix.rows_of(self.knowledge_base.symbols.decode(code) for code in unique_codes.tolist())
+                rows = rows[inverse.reshape(-1)]
+            encoded = self._encoded_heads = matrix, heads, rows
+        return encoded[1], encoded[2]
+
+    def heads_with_literal(self, literal: Literal) -> List[Term]:
+        heads = []
+        for position in self._positions_with_literal(literal):
+            head = self._term(self.knowledge_base.rule_head_definer[position], self.knowledge_base.rule_head[position])
+            if head not in heads:
+                heads.append(head)
+        return heads
+
+    def state(self) -> Tuple:
+        return (self.version,)
+
+    def __contains__(self, rule: Rule) -> bool:
+        return any(self._rule(position) == rule for position in self._positions_with_head(rule.head))
+
+    def __iter__(self) -> Iterator[Rule]:
+        for position in range(self.start, self.end):
+            yield self._rule(position)
+
+    def __len__(self) -> int:
+        return self.end - self.start
+
+
+class EncodedStrings(Sequence):
+    """
+    Read-only sequence of strings stored as their concatenated UTF-8 bytes and the offsets delimiting them,
+    decoded on access.
+    """
+
+    def __init__(self, offsets: numpy.ndarray, data: numpy.ndarray):
+        self.offsets = offsets
+        self.data = data
+
+    def __getitem__(self, position: int) -> str:
+        if isinstance(position, slice):
+            return [self[position] for position in range(*position.indices(len(self)))]
+        if not -len(self) <= position < len(self):
+            raise IndexError(position)
+        position %= len(self)
+        return self.data[self.offsets[position]:self.offsets[position + 1]].tobytes().decode("utf-8")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+
+def encode_strings(strings: Iterable[str]) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    if isinstance(strings, EncodedStrings):
+        return strings.offsets, strings.data
+    encoded = [string.encode("utf-8") for string in strings]
+    offsets = numpy.zeros(len(encoded) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(string) for string in encoded], out=offsets[1:])
+    return offsets, numpy.frombuffer(b"".join(encoded), dtype=numpy.uint8)
+
+
+def aligned(offset: int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def load_knowledge_base(path: str) -> CompiledKnowledgeBase:
+    """
+    Maps a knowledge base saved with CompiledKnowledgeBase.save into memory. The arrays are read-only views of
+    the mapped file, so the pages are only read when reached and are shared by the processes loading the same
+    file; symbols, rule ids and rules are decoded on access.
+    """
+    with open(path, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    prefix_size = len(MAGIC) + struct.calcsize("<II")
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError("{} is not a knowledge base file".format(path))
+    version, header_size = struct.unpack("<II", buffer[len(MAGIC):prefix_size])
+    if version != FORMAT_VERSION:
+        raise ValueError("{} has format version {}, expected {}".format(path, version, FORMAT_VERSION))
+    header = json.loads(buffer[prefix_size:prefix_size + header_size].decode("utf-8"))
+    start = aligned(prefix_size + header_size)
+    arrays = {name: numpy.frombuffer(buffer, dtype=numpy.dtype(dtype), count=count, offset=start + offset)
+              for name, (dtype, offset, count) in header["arrays"].items()}
+
+    return CompiledKnowledgeBase(
+        SymbolTable.from_sequence(EncodedStrings(arrays["symbol_offsets"], arrays["symbol_bytes"])),
+        header["definers"], header["agent_ids"], arrays["agent_starts"],
+        EncodedStrings(arrays["rule_id_offsets"], arrays["rule_id_bytes"]),
+        arrays["rule_agent"], arrays["rule_head_definer"], arrays["rule_head"], arrays["rule_strict"],
+        arrays["body_offsets"], arrays["body_definers"], arrays["body_literals"], arrays["head_order"],
+        arrays["sorted_heads"], header["preference_functions"],
+    )
+
+
+def load_system(path: str, similarity_function, similarity_threshold: float = 0, **options) -> MultiAgentSystem:
+    system = MultiAgentSystem(similarity_function, similarity_threshold, **options)
+    load_knowledge_base(path).install(system)
+    return system
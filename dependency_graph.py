@@ -0,0 +1,73 @@
+from typing import Dict, FrozenSet, Hashable, Iterable, List
+
+
+def strongly_connected_components(graph: Dict[Hashable, Iterable[Hashable]]) -> List[List[Hashable]]:
+    """
+    Tarjan's algorithm over a graph given as the successors of each node, with an explicit stack so that long
+    chains do not hit the recursion limit. Components come out in reverse topological order (a component
+    before the components leading to it).
+    """
+    index = dict()
+    low_link = dict()
+    on_stack = set()
+    stack = []
+    components = []
+
+    for root in graph:
+        if root in index:
+            continue
+        index[root] = low_link[root] = len(index)
+        stack.append(root)
+        on_stack.add(root)
+        work = [(root, iter(graph.get(root, ())))]
+        while work:
+            node, successors = work[-1]
+            for successor in successors:
+                if successor not in index:
+                    index[successor] = low_link[successor] = len(index)
+                    stack.append(successor)
+                    on_stack.add(successor)
+                    work.append((successor, iter(graph.get(successor, ()))))
+                    break
+                if successor in on_stack:
+                    low_link[node] = min(low_link[node], index[successor])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    low_link[parent] = min(low_link[parent], low_link[node])
+                if low_link[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(component)
+    return components
+
+
+def nodes_on_cycles(graph: Dict[Hashable, Iterable[Hashable]]) -> FrozenSet[Hashable]:
+    # a node is on a cycle if its component has other nodes or if it leads to itself
+    nodes = set()
+    for component in strongly_connected_components(graph):
+        if len(component) > 1 or component[0] in graph.get(component[0], ()):
+            nodes.update(component)
+    return frozenset(nodes)
+
+
+def nodes_leading_to(graph: Dict[Hashable, Iterable[Hashable]], targets: Iterable[Hashable]) -> FrozenSet[Hashable]:
+    # the targets and the nodes with a path to some target
+    predecessors = dict()
+    for node, successors in graph.items():
+        for successor in successors:
+            predecessors.setdefault(successor, []).append(node)
+    nodes = set(targets)
+    pending = list(nodes)
+    while pending:
+        for predecessor in predecessors.get(pending.pop(), ()):
+            if predecessor not in nodes:
+                nodes.add(predecessor)
+                pending.append(predecessor)
+    return frozenset(nodes)
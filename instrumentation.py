@@ -0,0 +1,263 @@
+import contextvars
+import inspect
+import itertools
+import json
+import time
+from collections import Counter
+from functools import partial
+from typing import List, Union
+
+from agent_sync_arguments import Agent, MultiAgentSystem, unwrap_method, wrap_method
+
+TRACED_CALLS = dict(
+    query="query", query_agents="query_agents", find_support="find_support",
+    process_body_members="process_body_members", local_ans="local_ans",
+    aquery="query", aquery_agents="query_agents", afind_support="find_support",
+    aprocess_body_members="process_body_members",
+    iquery="query", iquery_agents="query_agents", ifind_support="find_support",
+    iprocess_body_members="process_body_members",
+)
+COUNTED_CALLS = dict(similarity="similarity", stronger="stronger")
+
+
+def term_label(term) -> str:
+    if term is None:
+        return None
+    definer = getattr(term.definer, "id", term.definer)
+    literal = term.literal
+    return "{}:{}{}".format(definer, "" if literal.positive else "¬", literal.symbol)
+
+
+class InMemorySink:
+    """
+    Keeps the events, summarizes them in counters and rebuilds the inter-agent call tree of a context.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def record(self, event: dict):
+        self.events.append(event)
+
+    def close(self):
+        pass
+
+    def counters(self) -> dict:
+        spans = [event for event in self.events if "duration" in event]
+        instants = Counter((event["kind"], event["agent"]) for event in self.events if "duration" not in event)
+        queries = [event for event in spans if event["kind"] == "query"]
+        hits = sum(count for (kind, _), count in instants.items() if kind == "memory_hit")
+        misses = sum(count for (kind, _), count in instants.items() if kind == "memory_miss")
+
+        time_by_call = Counter()
+        for event in spans:
+            time_by_call[event["kind"]] += event["duration"]
+
+        return dict(
+            messages_received=dict(Counter(event["agent"] for event in queries)),
+            messages_sent=dict(Counter(event["sender"] for event in queries)),
+            max_depth=max((event["depth"] for event in spans), default=0),
+            calls=dict(Counter(event["kind"] for event in spans)),
+            time_by_call=dict(time_by_call),
+            similarity_calls=sum(count for (kind, _), count in instants.items() if kind == "similarity"),
+            stronger_comparisons=sum(count for (kind, _), count in instants.items() if kind == "stronger"),
+            memory_hits=hits,
+            memory_misses=misses,
+            memory_hit_rate=hits / (hits + misses) if hits + misses else None,
+        )
+
+    def call_tree(self, context_id) -> List[dict]:
+        """
+        Queries exchanged by the agents under a context, each one with the queries it caused as children.
+        """
+        by_id = {event["id"]: event for event in self.events if "duration" in event}
+        nodes = dict()
+        roots = []
+        for event in sorted(by_id.values(), key=lambda event: event["id"]):
+            if event["kind"] != "query" or event["context"] != context_id:
+                continue
+            node = dict(agent=event["agent"], sender=event["sender"], term=event["term"],
+                        duration=event["duration"], children=[])
+            nodes[event["id"]] = node
+            parent = by_id.get(event["parent"])
+            while parent is not None and parent["kind"] != "query":
+                parent = by_id.get(parent["parent"])
+            if parent is not None and parent["id"] in nodes:
+                nodes[parent["id"]]["children"].append(node)
+            else:
+                roots.append(node)
+        return roots
+
+
+class JsonLinesSink:
+
+    def __init__(self, file):
+        self.file = file
+
+    def record(self, event: dict):
+        self.file.write(json.dumps(event) + "\n")
+
+    def close(self):
+        self.file.flush()
+
+
+class ChromeTraceSink:
+    """
+    Writes the events in the Chrome trace event format (chrome://tracing, Perfetto) when closed.
+    """
+
+    def __init__(self, file):
+        self.file = file
+        self.trace_events = []
+
+    def record(self, event: dict):
+        trace_event = dict(name="{}.{}".format(event["agent"], event["kind"]), cat=event["kind"],
+                           ts=event["start"] * 1e6, pid=1, tid=1,
+                           args=dict(term=event.get("term"), context=event.get("context"), sender=event.get("sender")))
+        if "duration" in event:
+            trace_event.update(ph="X", dur=event["duration"] * 1e6)
+        else:
+            trace_event.update(ph="i", s="t")
+        self.trace_events.append(trace_event)
+
+    def close(self):
+        json.dump(dict(traceEvents=self.trace_events, displayTimeUnit="ms"), self.file)
+        self.file.flush()
+
+
+class Tracer:
+    """
+    Records the calls made by the agents of a system into sinks. The sync, async and iterative engines are
+    traced alike, their calls recorded under the same kinds of event.
+    The traced methods are wrapped on the agent instances only while the tracer is installed, so a system
+    without a tracer runs the plain methods and pays nothing for it.
+    The stack of open calls giving each event its parent is a context variable: every thread and every asyncio
+    task has its own, so queries run by query_in_parallel or by concurrent coroutines are not nested in each
+    other.
+    """
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+        self.stack = contextvars.ContextVar("tracer_stack", default=())
+        self.event_ids = itertools.count()
+        self.origin = time.perf_counter()
+        self.installed = []
+
+    def install(self, system: MultiAgentSystem) -> "Tracer":
+        for agent in system.agents.values():
+            wrapped = [(agent, name, partial(self._traced, agent, name, kind)) for name, kind in TRACED_CALLS.items()]
+            wrapped.extend((agent, name, partial(self._counted, agent, kind)) for name, kind in COUNTED_CALLS.items())
+            wrapped.append((agent.query_memory, "get", partial(self._memory_get, agent)))
+            for obj, name, wrapper in wrapped:
+                wrap_method(obj, name, wrapper)
+            self.installed.extend(wrapped)
+        # the async engine computes similarities through the system, for the agent of the innermost open call
+        wrap_method(system, "asimilarity", self._acounted_similarity)
+        self.installed.append((system, "asimilarity", self._acounted_similarity))
+        return self
+
+    def uninstall(self):
+        for obj, name, wrapper in self.installed:
+            unwrap_method(obj, name, wrapper)
+        self.installed = []
+        for sink in self.sinks:
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.uninstall()
+
+    def emit(self, event: dict):
+        for sink in self.sinks:
+            sink.record(event)
+
+    def _new_event(self, kind: str, agent: Union[Agent, str], term=None, context=None) -> dict:
+        stack = self.stack.get()
+        parent = stack[-1] if stack else None
+        if context is None and parent is not None:
+            context = parent["context"]
+        return dict(id=next(self.event_ids), parent=parent["id"] if parent is not None else None, kind=kind,
+                    agent=getattr(agent, "id", agent), term=term_label(term), context=context, depth=len(stack),
+                    start=time.perf_counter() - self.origin)
+
+    def _traced(self, agent: Agent, name: str, kind: str, method):
+        traced_method = getattr(Agent, name)
+        parameters = list(inspect.signature(traced_method).parameters)[1:]
+        term_index = parameters.index("term") if "term" in parameters else None
+        rule_index = parameters.index("rule") if "rule" in parameters else None
+        context_index = parameters.index("context") if "context" in parameters else None
+
+        def open_call(args, kwargs):
+            if term_index is not None:
+                term = args[term_index] if term_index < len(args) else kwargs.get("term")
+            else:
+                term = (args[rule_index] if rule_index < len(args) else kwargs["rule"]).head
+            context = None
+            if context_index is not None:
+                context = (args[context_index] if context_index < len(args) else kwargs["context"]).id
+            event = self._new_event(kind, agent, term, context)
+            if kind == "query":
+                sender = args[0] if args else kwargs["sender"]
+                event["sender"] = sender.id
+            stack = self.stack.get()
+            self.stack.set(stack + (event,))
+            return event, stack
+
+        def close_call(event, stack):
+            self.stack.set(stack)
+            event["duration"] = time.perf_counter() - self.origin - event["start"]
+            self.emit(event)
+
+        if inspect.iscoroutinefunction(traced_method):
+            async def traced(*args, **kwargs):
+                event, stack = open_call(args, kwargs)
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    close_call(event, stack)
+        elif inspect.isgeneratorfunction(traced_method):
+            # the call is open from the first step of its generator to the last, run_iteratively resuming the
+            # generators of the nested calls in between
+            def traced(*args, **kwargs):
+                event, stack = open_call(args, kwargs)
+                try:
+                    return (yield from method(*args, **kwargs))
+                finally:
+                    close_call(event, stack)
+        else:
+            def traced(*args, **kwargs):
+                event, stack = open_call(args, kwargs)
+                try:
+                    return method(*args, **kwargs)
+                finally:
+                    close_call(event, stack)
+
+        return traced
+
+    def _counted(self, agent: Agent, kind: str, method):
+
+        def counted(*args, **kwargs):
+            self.emit(self._new_event(kind, agent))
+            return method(*args, **kwargs)
+
+        return counted
+
+    def _acounted_similarity(self, method):
+
+        async def asimilarity(*args, **kwargs):
+            stack = self.stack.get()
+            self.emit(self._new_event("similarity", stack[-1]["agent"] if stack else None))
+            return await method(*args, **kwargs)
+
+        return asimilarity
+
+    def _memory_get(self, agent: Agent, method):
+
+        def get(key, default=None):
+            value = method(key, default)
+            self.emit(self._new_event("memory_miss" if value is default else "memory_hit", agent))
+            return value
+
+        return get
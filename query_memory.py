@@ -0,0 +1,108 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Tuple
+
+
+class QueryMemory:
+    """
+    Answers received by an agent, keyed by (context id, term, agent id).
+    Entries are grouped by context so that all the memory of a context is freed when the context ends. The
+    answers kept for other evaluations (see keep) may be dropped and given again, so, when max_entries is set,
+    the least recently used of them are evicted to stay under it; the answers of the evaluations under way are
+    never evicted, as an evaluation missing one of its answers could end up with another result.
+    The memory of an agent is shared by the contexts evaluated concurrently, so it is updated under a lock.
+    """
+
+    def __init__(self, max_entries: int = None):
+        self.max_entries = max_entries
+        self.entries = dict()
+        # the keys of the entries that may be evicted, least recently used first
+        self.evictable = OrderedDict()
+        self.keys_by_context = dict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.RLock()
+
+    def get(self, key: Tuple, default=None):
+        with self._lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            if key in self.evictable:
+                self.evictable.move_to_end(key)
+            return self.entries[key]
+
+    def setdefault(self, key: Tuple, value):
+        with self._lock:
+            if key not in self.entries:
+                self[key] = value
+                return value
+            return self.entries[key]
+
+    def keep(self, key: Tuple, value):
+        # memorizes an answer that may be evicted
+        with self._lock:
+            self._add(key, value)
+            self.evictable[key] = None
+            self.evictable.move_to_end(key)
+            self._evict()
+
+    def discard(self, key: Tuple):
+        with self._lock:
+            if key in self.entries:
+                self._remove(key)
+
+    def end_context(self, context_id: Hashable):
+        with self._lock:
+            for key in self.keys_by_context.pop(context_id, ()):
+                del self.entries[key]
+                self.evictable.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.entries))
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.evictable.clear()
+            self.keys_by_context.clear()
+
+    def _add(self, key: Tuple, value):
+        if key not in self.entries:
+            self.keys_by_context.setdefault(key[0], set()).add(key)
+        self.entries[key] = value
+
+    def _remove(self, key: Tuple):
+        del self.entries[key]
+        self.evictable.pop(key, None)
+        context_keys = self.keys_by_context[key[0]]
+        context_keys.discard(key)
+        if not context_keys:
+            del self.keys_by_context[key[0]]
+
+    def _evict(self):
+        while self.max_entries is not None and len(self.entries) > self.max_entries and self.evictable:
+            key, _ = self.evictable.popitem(last=False)
+            self._remove(key)
+            self.evictions += 1
+
+    def __setitem__(self, key: Tuple, value):
+        # memorizes an answer of an evaluation under way, kept until its context (or scope) ends
+        with self._lock:
+            self._add(key, value)
+            self.evictable.pop(key, None)
+            self._evict()
+
+    def __getitem__(self, key: Tuple):
+        return self.entries[key]
+
+    def __contains__(self, key: Tuple) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
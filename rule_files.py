@@ -0,0 +1,117 @@
+"""
+Line-oriented rule files, read as a stream so that a knowledge base of any size is loaded in constant memory.
+
+Each line holds one rule as tab-separated fields: the agent owning the rule, the rule id, the head, then the
+members of the body (none for a fact). A term is written definer:literal, with "¬" before a negative literal.
+Blank lines and lines starting with "#" are skipped.
+
+    A	r_a1	A:¬ed(m1)	X:dc(m1)
+    E	r_e1	E:spa(m1)	E:hv(m1)	E:pbc(m1)
+"""
+from typing import Callable, Dict, Iterable, Iterator, TextIO, Tuple
+
+from agent_sync_arguments import Agent, MultiAgentSystem
+from builders import Builder
+
+COMMENT = "#"
+FIELD_SEPARATOR = "\t"
+DEFINER_SEPARATOR = ":"
+ANY_AGENT = "X"
+
+
+class RuleFileError(ValueError):
+
+    def __init__(self, source: str, line_number: int, message: str):
+        super().__init__("{}, line {}: {}".format(source, line_number, message))
+        self.source = source
+        self.line_number = line_number
+        self.message = message
+
+
+def parse_term(field: str) -> Tuple[str, str]:
+    definer, separator, literal = field.strip().partition(DEFINER_SEPARATOR)
+    if not separator or not definer or literal in ("", "¬"):
+        raise ValueError("expected a term as definer{}literal, got {!r}".format(DEFINER_SEPARATOR, field))
+    return definer, literal
+
+
+def parse_rule_line(line: str) -> Tuple[str, tuple]:
+    fields = line.split(FIELD_SEPARATOR)
+    if len(fields) < 3:
+        raise ValueError("expected agent, rule id and head, got {} field(s)".format(len(fields)))
+    agent_id, rule_id = fields[0].strip(), fields[1].strip()
+    if not agent_id or not rule_id:
+        raise ValueError("missing agent or rule id")
+    head = parse_term(fields[2])
+    body = [parse_term(field) for field in fields[3:] if field.strip()]
+    return agent_id, (rule_id, head, body)
+
+
+def parse_rule_lines(lines: Iterable[str], source: str = "<rules>",
+                     on_error: Callable[[RuleFileError], None] = None) -> Iterator[Tuple[int, str, tuple]]:
+    """
+    Yields the line number, the agent id and the rule in the tuple format of Builder, line after line.
+    A malformed line raises a RuleFileError, unless on_error is given: it is called with the error and the
+    line is skipped.
+    """
+    for line_number, line in enumerate(lines, 1):
+        line = line.rstrip("\r\n")
+        if not line.strip() or line.lstrip().startswith(COMMENT):
+            continue
+        try:
+            agent_id, tuple_rule = parse_rule_line(line)
+        except ValueError as error:
+            error = RuleFileError(source, line_number, str(error))
+            if on_error is None:
+                raise error from None
+            on_error(error)
+            continue
+        yield line_number, agent_id, tuple_rule
+
+
+def read_rule_file(path: str, on_error: Callable[[RuleFileError], None] = None) -> Iterator[Tuple[int, str, tuple]]:
+    with open(path, encoding="utf-8") as file:
+        yield from parse_rule_lines(file, path, on_error)
+
+
+def write_rule_file(file: TextIO, tuple_rules_by_agent: Dict[str, list]):
+    for agent_id, tuple_rules in tuple_rules_by_agent.items():
+        for rule_id, head, body in tuple_rules:
+            terms = [DEFINER_SEPARATOR.join(term) for term in [head] + list(body)]
+            file.write(FIELD_SEPARATOR.join([agent_id, rule_id] + terms) + "\n")
+
+
+def load_rules(system: MultiAgentSystem, parsed_rules: Iterable[Tuple[int, str, tuple]],
+               agent_ids: Iterable[str] = (), progress: Callable[[int, int], None] = None,
+               progress_every: int = 10000) -> int:
+    """
+    Appends the parsed rules to the rules of their agents as they come and returns the number of rules loaded.
+    Every definer named by a rule other than "X" is an agent: the agents missing in the system are created
+    before the rule is built, so a term referring to an agent whose rules come later in the file is bound to
+    that agent rather than kept as a name (which would be asked like "X"). agent_ids are created up front.
+    progress is called with the line number and the number of rules loaded every progress_every rules and at
+    the end.
+    """
+    for agent_id in agent_ids:
+        if agent_id not in system.agents:
+            system.agents[agent_id] = Agent(agent_id, system)
+    builder = Builder(system.agents)
+    count = 0
+    line_number = 0
+    for line_number, agent_id, tuple_rule in parsed_rules:
+        _, head, body = tuple_rule
+        for definer in [agent_id, head[0]] + [term[0] for term in body]:
+            if definer != ANY_AGENT and definer not in system.agents:
+                system.agents[definer] = Agent(definer, system)
+        system.agents[agent_id].rules.append(builder.build_rule(tuple_rule))
+        count += 1
+        if progress is not None and count % progress_every == 0:
+            progress(line_number, count)
+    if progress is not None:
+        progress(line_number, count)
+    return count
+
+
+def load_rule_file(system: MultiAgentSystem, path: str, on_error: Callable[[RuleFileError], None] = None,
+                   **options) -> int:
+    return load_rules(system, read_rule_file(path, on_error), **options)
@@ -0,0 +1,161 @@
+import random
+from typing import Dict, List, Tuple
+
+from agent_sync_arguments import Agent, MultiAgentSystem, Term
+from builders import Builder
+from mushroom_example_commons import X, FOCUS
+
+
+class ScenarioParameters:
+
+    def __init__(self,
+                 agent_count: int = 5,
+                 rules_per_agent: int = 10,
+                 chain_depth: int = 3,
+                 body_width: int = 2,
+                 any_agent_share: float = 0.3,
+                 cycle_density: float = 0.0,
+                 similarity_threshold: float = 0.5,
+                 similarity_spread: float = 0.0,
+                 similar_literals: int = 0,
+                 focus_facts: float = 0.5,
+                 query_count: int = 5,
+                 seed: int = 0):
+        self.agent_count = agent_count
+        self.rules_per_agent = rules_per_agent
+        self.chain_depth = chain_depth
+        self.body_width = body_width
+        self.any_agent_share = any_agent_share
+        self.cycle_density = cycle_density
+        self.similarity_threshold = similarity_threshold
+        self.similarity_spread = similarity_spread
+        self.similar_literals = similar_literals
+        self.focus_facts = focus_facts
+        self.query_count = query_count
+        self.seed = seed
+
+    def replace(self, **changes) -> "ScenarioParameters":
+        params = dict(self.__dict__)
+        params.update(changes)
+        return ScenarioParameters(**params)
+
+
+class Scenario:
+
+    def __init__(self, params: ScenarioParameters, system: MultiAgentSystem, focus_knowledge, query_terms: List[Term],
+                 tuple_rules: Dict[str, list]):
+        self.params = params
+        self.system = system
+        self.focus_knowledge = focus_knowledge
+        self.query_terms = query_terms
+        self.tuple_rules = tuple_rules
+
+    @property
+    def rule_count(self) -> int:
+        return sum(len(rules) for rules in self.tuple_rules.values())
+
+
+def literal_name(layer: int, index: int) -> str:
+    return "p{}_{}(s)".format(layer, index)
+
+
+def generate_tuple_rules(params: ScenarioParameters, rng: random.Random) -> Tuple[Dict[str, list], list, list]:
+    """
+    Rules are generated in the tuple format of mushroom_rules_examples. Literals are organized in layers:
+    layer 0 holds the facts of the focus knowledge and the body of a rule of layer n refers to heads of layer n-1,
+    except for the body members turned into cycles (pointing to layer n or above) with cycle_density.
+    """
+    agent_ids = ["ag{}".format(n) for n in range(params.agent_count)]
+    depth = max(params.chain_depth, 1)
+    literals_per_layer = max(1, params.agent_count * params.rules_per_agent // (2 * depth))
+    layers = [[literal_name(layer, index) for index in range(literals_per_layer)] for layer in range(depth + 1)]
+
+    heads = []
+    for n in range(params.agent_count * params.rules_per_agent):
+        agent_id = agent_ids[n % params.agent_count]
+        layer = 1 + rng.randrange(depth)
+        literal = rng.choice(layers[layer])
+        heads.append((agent_id, layer, literal if rng.random() < 0.5 else "¬" + literal))
+
+    definers = dict()
+    heads_by_layer = [[] for _ in range(depth + 1)]
+    for agent_id, layer, literal in heads:
+        if literal not in definers:
+            heads_by_layer[layer].append(literal)
+        definers.setdefault(literal, set()).add(agent_id)
+
+    tuple_rules = {agent_id: [] for agent_id in agent_ids}
+    for n, (agent_id, layer, head) in enumerate(heads):
+        body = []
+        for _ in range(params.body_width):
+            body_layer = layer - 1
+            if rng.random() < params.cycle_density:
+                body_layer = rng.randrange(layer, depth + 1)
+            if body_layer == 0 or not heads_by_layer[body_layer]:
+                body_literal = rng.choice(layers[body_layer])
+            else:
+                body_literal = rng.choice(heads_by_layer[body_layer])
+            if body_layer == 0 or rng.random() < params.any_agent_share or body_literal not in definers:
+                definer = X
+            else:
+                definer = rng.choice(sorted(definers[body_literal]))
+            body.append((definer, body_literal))
+        tuple_rules[agent_id].append(("r_{}_{}".format(agent_id, n), (agent_id, head), body))
+
+    facts = [literal for literal in layers[0] if rng.random() < params.focus_facts]
+    tuple_focus = [("r_fk{}".format(n), (FOCUS, literal), []) for n, literal in enumerate(facts)]
+
+    top_heads = sorted(set((agent_id, head) for agent_id, layer, head in heads if layer == depth))
+    tuple_queries = rng.sample(top_heads, min(params.query_count, len(top_heads)))
+
+    return tuple_rules, tuple_focus, tuple_queries
+
+
+def generate_similarities(params: ScenarioParameters, rules: Dict[str, list], rng: random.Random) -> Dict:
+    """
+    Gives each literal up to similar_literals other literals of the same polarity with a similarity degree
+    drawn uniformly within similarity_spread of the threshold.
+    """
+    literals = sorted(set(head for agent_rules in rules.values() for _, (_, head), _ in agent_rules))
+    similarities = dict()
+    if len(literals) < 2:
+        return similarities
+    for literal in literals:
+        for other in rng.sample(literals, min(params.similar_literals, len(literals))):
+            if other == literal or (other[0] == "¬") != (literal[0] == "¬"):
+                continue
+            low = max(0.0, params.similarity_threshold - params.similarity_spread)
+            high = min(1.0, params.similarity_threshold + params.similarity_spread)
+            degree = rng.uniform(low, high)
+            similarities[(literal, other)] = similarities[(other, literal)] = degree
+    return similarities
+
+
+def generate_scenario(params: ScenarioParameters) -> Scenario:
+    rng = random.Random(params.seed)
+    tuple_rules, tuple_focus, tuple_queries = generate_tuple_rules(params, rng)
+    similarities = generate_similarities(params, tuple_rules, rng)
+
+    def similarity_function(term1: Term, term2: Term):
+        if term1.literal == term2.literal:
+            return 1
+        return similarities.get((string_literal(term1), string_literal(term2)), 0)
+
+    system = MultiAgentSystem(similarity_function, params.similarity_threshold)
+    agents_dict = {agent_id: Agent(agent_id, system) for agent_id in tuple_rules}
+    builder = Builder(agents_dict)
+    for agent_id, rules in tuple_rules.items():
+        agents_dict[agent_id].rules = builder.build_rules(rules)
+        for other_id in agents_dict:
+            if other_id != agent_id:
+                agents_dict[agent_id].preference_function[other_id] = round(rng.random(), 2)
+    system.agents = agents_dict
+
+    focus_knowledge = Builder({}).build_rules(tuple_focus)
+    query_terms = [builder.build_term(tuple_term) for tuple_term in tuple_queries]
+    return Scenario(params, system, focus_knowledge, query_terms, tuple_rules)
+
+
+def string_literal(term: Term) -> str:
+    literal = term.literal
+    return literal.symbol if literal.positive else "¬" + literal.symbol
@@ -0,0 +1,145 @@
+import inspect
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, Tuple
+
+import numpy
+
+
+class SimilarityCache:
+    """
+    Similarity degrees memoized by pair of literals, so the similarity function must depend only on the
+    literals of the terms. When max_entries is set, the least recently used pairs are evicted to stay under it.
+    """
+
+    def __init__(self, similarity_function: Callable, max_entries: int = None):
+        self.similarity_function = similarity_function
+        self.max_entries = max_entries
+        self.degrees = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # the function is called out of the lock: a pair asked from two threads at once may be computed twice
+        self._lock = threading.Lock()
+
+    def similarity(self, term1, term2) -> float:
+        key = (term1.literal, term2.literal)
+        sim_degree = self.degrees.get(key)
+        if sim_degree is not None:
+            return self._hit(key, sim_degree)
+        self.misses += 1
+        return self._store(key, self.similarity_function(term1, term2))
+
+    async def asimilarity(self, term1, term2) -> float:
+        key = (term1.literal, term2.literal)
+        sim_degree = self.degrees.get(key)
+        if sim_degree is not None:
+            return self._hit(key, sim_degree)
+        self.misses += 1
+        sim_degree = self.similarity_function(term1, term2)
+        if inspect.isawaitable(sim_degree):
+            sim_degree = await sim_degree
+        return self._store(key, sim_degree)
+
+    def stats(self) -> Dict[str, int]:
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions, entries=len(self.degrees))
+
+    def clear(self):
+        with self._lock:
+            self.degrees.clear()
+
+    def _hit(self, key: Tuple, sim_degree: float) -> float:
+        self.hits += 1
+        if self.max_entries is not None:
+            with self._lock:
+                if key in self.degrees:
+                    self.degrees.move_to_end(key)
+        return sim_degree
+
+    def _store(self, key: Tuple, sim_degree: float) -> float:
+        with self._lock:
+            self.degrees[key] = sim_degree
+            if self.max_entries is not None and len(self.degrees) > self.max_entries:
+                self.degrees.popitem(last=False)
+                self.evictions += 1
+        return sim_degree
+
+
+class SimilarityMatrix:
+    """
+    Dense matrix of the similarity degrees between the literals of a vocabulary (row: first term, column:
+    second term), along with the mask of the degrees that are similar enough for the threshold.
+    Literals outside the vocabulary are not answered (None), so the caller falls back to the function.
+    """
+
+    def __init__(self, literals: Iterable, degrees: numpy.ndarray, similarity_threshold: float = 0):
+        self.literals = list(literals)
+        self.index = {literal: position for position, literal in enumerate(self.literals)}
+        self.degrees = numpy.asarray(degrees, dtype=float)
+        if self.degrees.shape != (len(self.literals), len(self.literals)):
+            raise ValueError("expected a {0}x{0} matrix of degrees, got {1}".format(len(self.literals),
+                                                                                 self.degrees.shape))
+        self.similarity_threshold = similarity_threshold
+        self.mask = self.degrees >= similarity_threshold
+
+    @classmethod
+    def from_function(cls, terms: Iterable, similarity_function: Callable,
+                      similarity_threshold: float = 0) -> "SimilarityMatrix":
+        # one term per literal of the vocabulary, as the function is called with terms
+        terms = list(terms)
+        degrees = numpy.array([[similarity_function(term1, term2) for term2 in terms] for term1 in terms],
+                              dtype=float).reshape(len(terms), len(terms))
+        return cls([term.literal for term in terms], degrees, similarity_threshold)
+
+    def __contains__(self, literal) -> bool:
+        return literal in self.index
+
+    def __len__(self) -> int:
+        return len(self.literals)
+
+    def similarity(self, literal1, literal2) -> float:
+        row = self.index.get(literal1)
+        column = self.index.get(literal2)
+        if row is None or column is None:
+            return None
+        return self.degrees.item(row, column)
+
+    def rows_of(self, literals: Iterable) -> numpy.ndarray:
+        return numpy.array([self.index.get(literal, -1) for literal in literals], dtype=numpy.intp)
+
+    def degrees_to(self, rows: numpy.ndarray, literal) -> numpy.ndarray:
+        """
+        Degrees of the literals at the given rows to the given literal (zero for rows outside the vocabulary),
+        or None if the literal is not in the vocabulary.
+        """
+        column = self.index.get(literal)
+        if column is None:
+            return None
+        return numpy.where(rows >= 0, self.degrees[rows, column], 0.0)
+
+    def similar_to(self, rows: numpy.ndarray, literal, similarity_threshold: float) -> numpy.ndarray:
+        """
+        Whether the literals at the given rows are similar enough to the given literal (False for rows outside
+        the vocabulary), or None if the literal is not in the vocabulary. The mask is read as is when the
+        threshold is the one it was computed for.
+        """
+        column = self.index.get(literal)
+        if column is None:
+            return None
+        if similarity_threshold == self.similarity_threshold:
+            similar = self.mask[rows, column]
+        else:
+            similar = self.degrees[rows, column] >= similarity_threshold
+        return similar & (rows >= 0)
+
+
+def best_match(degrees: numpy.ndarray, is_preferred: Callable[[int], bool]) -> int:
+    """
+    Position of the highest degree. Ties go to the first preferred position (e.g. the one holding the queried
+    literal itself), then to the first one, so the match depends on nothing but the order of the positions.
+    """
+    ties = numpy.flatnonzero(degrees == degrees.max())
+    for position in ties:
+        if is_preferred(position):
+            return int(position)
+    return int(ties[0])
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import time
+
+from agent_runtime import ProcessRuntime, PipeTransport, SocketTransport
+from agent_sync_arguments import EMPTY_HISTORY, Literal, QueryBudget, Term, TruthValue, wrap_method
+from builders import Builder
+from mushroom_rules_examples import R_FOCUS_MUSHROOM
+from test_agent_sync import chain_system, create_scenario_mushroom_hunters, fan_out_system, term_key
+
+
+def query_scenario(system):
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    answers = []
+    for agent_id in ("A", "B", "E"):
+        for literal in (Literal("col(m1)", False), Literal("ed(m1)", False), Literal("spa(m1)")):
+            agent = system.agents[agent_id]
+            answer = agent.initialize_query(Term(agent, literal), focus_knowledge_base)
+            answers.append((answer.truth_value, term_key(answer.equivalent_term)))
+    return answers
+
+
+def test_runtime_answers_match_local_system():
+    expected = query_scenario(create_scenario_mushroom_hunters())
+
+    for transport in (PipeTransport(), SocketTransport()):
+        system = create_scenario_mushroom_hunters()
+        with ProcessRuntime(system, worker_count=2, transport=transport):
+            assert query_scenario(system) == expected
+
+
+def test_runtime_workers_answer_one_broadcast_at_once(tmp_path):
+    log_path = str(tmp_path / "busy.log")
+
+    def logged(method):
+
+        async def aquery(sender, term, context, hist=EMPTY_HISTORY):
+            start = time.monotonic()
+            await asyncio.sleep(0.2)
+            answer = await method(sender, term, context, hist)
+            if term.literal == Literal("p"):
+                with open(log_path, "a") as log:
+                    log.write("{} {} {}\n".format(os.getpid(), start, time.monotonic()))
+            return answer
+
+        return aquery
+
+    system, focus_knowledge_base = fan_out_system(2)
+    for agent_id in ("B", "C"):
+        wrap_method(system.agents[agent_id], "aquery", logged)
+    with ProcessRuntime(system, placement=dict(A=1, B=2, C=3)):
+        answer = system.agents["A"].initialize_query(Term(system.agents["A"], Literal("q")), focus_knowledge_base)
+    assert answer.truth_value == TruthValue.TRUE
+
+    with open(log_path) as log:
+        (pid_b, start_b, end_b), (pid_c, start_c, end_c) = [line.split() for line in log]
+    # the workers of B and C were busy with the query at the same time
+    assert pid_b != pid_c
+    assert max(float(start_b), float(start_c)) < min(float(end_b), float(end_c))
+
+
+def test_runtime_spends_one_budget_across_processes():
+    def query_chain(system, budget):
+        answer = system.agents["A"].initialize_query(Term(system.agents["A"], Literal("p0")), focus_knowledge_base,
+                                                     budget)
+        return answer.truth_value, answer.partial, answer.context.budget.messages, answer.context.messages
+
+    for budget in (QueryBudget(max_messages=10), QueryBudget(max_depth=10), QueryBudget(time_limit=60),
+                   QueryBudget(time_limit=0)):
+        system, focus_knowledge_base = chain_system(30)
+        expected = query_chain(system, budget)
+
+        system, focus_knowledge_base = chain_system(30)
+        with ProcessRuntime(system, worker_count=2):
+            assert query_chain(system, budget) == expected
+            assert system.messages_sent == expected[3]
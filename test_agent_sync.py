@@ -1,6 +1,17 @@
-from agent_sync_arguments import MultiAgentSystem, Agent, Literal, Term
+import asyncio
+import copy
+import pickle
+import sys
+import threading
+
+import pytest
+
+from agent_sync_arguments import MultiAgentSystem, Agent, Literal, Term, Rule, StaticRule, QueryBudget, \
+    InstantiatedTerm, ArgTree, ArgSummary, ArgumentArena, History, SummarizedArgument, TruthValue, NO_ARG_TREE, \
+    EMPTY_HISTORY, wrap_method
 from builders import Builder
 from mushroom_rules_examples import R_MUSHROOM, R_FOCUS_MUSHROOM
+from scenario_generator import ScenarioParameters, generate_scenario
 
 
 def create_scenario_mushroom_hunters():
@@ -59,6 +70,55 @@ def create_scenario_mushroom_hunters():
     return system
 
 
+def term_key(term):
+    # terms built on different systems are never the same term, so they are compared through their agent ids
+    if term is None:
+        return None
+    return term.definer.id, term.literal
+
+
+def answer_keys(answers):
+    return [(answer.truth_value, term_key(answer.equivalent_term)) for answer in answers]
+
+
+# generated scenarios with cycles, on which answers depend the most on the order terms are evaluated in
+CYCLIC_SCENARIOS = [ScenarioParameters(rules_per_agent=15, cycle_density=cycle_density, similar_literals=2,
+                                       similarity_spread=0.1, query_count=8, seed=seed)
+                    for seed, cycle_density in [(7, 0.1), (1, 0.3), (3, 0.3), (14, 0.3), (19, 0.3), (5, 0.05)]]
+
+
+def scenario_id(params):
+    return "seed={}-cycles={}".format(params.seed, params.cycle_density)
+
+
+def sync_answers(params):
+    scenario = generate_scenario(params)
+    return answer_keys(term.definer.initialize_query(term, scenario.focus_knowledge) for term in scenario.query_terms)
+
+
+def chain_system(depth):
+    # p0 <- p1 <- ... <- p<depth>, the rules alternating between two agents, p<depth> in the focus knowledge
+    system = MultiAgentSystem(lambda term1, term2: 1 if term1.literal == term2.literal else 0, 0.5)
+    agents = [Agent("A", system), Agent("B", system)]
+    system.agents = {agent.id: agent for agent in agents}
+    for n in range(depth):
+        agent, other = agents[n % 2], agents[(n + 1) % 2]
+        agent.rules.append(Rule("r{}".format(n), Term(agent, Literal("p{}".format(n))),
+                                [Term(other, Literal("p{}".format(n + 1)))]))
+    return system, [Rule("f", Term("F", Literal("p{}".format(depth))), [])]
+
+
+def fan_out_system(width):
+    # A: q <- X:p, answered by each of the other agents with p <- s, s in the focus knowledge
+    system = MultiAgentSystem(lambda term1, term2: 1 if term1.literal == term2.literal else 0, 0.5)
+    agents = [Agent(chr(ord("A") + n), system) for n in range(width + 1)]
+    system.agents = {agent.id: agent for agent in agents}
+    agents[0].rules.append(Rule("r_A", Term(agents[0], Literal("q")), [Term("X", Literal("p"))]))
+    for agent in agents[1:]:
+        agent.rules.append(Rule("r_" + agent.id, Term(agent, Literal("p")), [Term(agent, Literal("s"))]))
+    return system, [Rule("f", Term("F", Literal("s")), [])]
+
+
 def test_scenario_mushroon_hunters():
     system = create_scenario_mushroom_hunters()
     term_to_query = Term(system.agents["A"], Literal("col(m1)"))
@@ -69,4 +129,479 @@ def test_scenario_mushroon_hunters():
     answer = system.agents["A"].initialize_query(term_to_query, focus_knowledge_base)
 
 
-test_scenario_mushroon_hunters()
\ No newline at end of file
+def test_strict_closure_handles_cycles_and_follows_added_rules():
+    system = create_scenario_mushroom_hunters()
+    agent_e = system.agents["E"]
+    p, q, r, s = (Term(agent_e, Literal(symbol + "(m1)")) for symbol in "pqrs")
+    agent_e.rules.extend([StaticRule("r_p", p, [q]), StaticRule("r_q", q, [p]), StaticRule("r_r", r, []),
+                          StaticRule("r_s", s, [r, r])])
+    extended_rules = agent_e.create_extended_rules([])
+
+    assert agent_e.local_ans(s, extended_rules)
+    assert not agent_e.local_ans(p, extended_rules)
+
+    agent_e.rules.append(StaticRule("r_q2", q, [s]))
+    assert extended_rules.strict_closure() == {p, q, r, s}
+
+
+def test_rule_index_follows_added_rules():
+    system = create_scenario_mushroom_hunters()
+    agent_b = system.agents["B"]
+    ed = Term(agent_b, Literal("ed(m1)", False))
+    hv = Term(agent_b, Literal("hv(m1)"))
+
+    assert [rule.id for rule in agent_b.rules.rules_for(ed)] == ["r_b1"]
+
+    agent_b.rules.append(StaticRule("r_b4", hv, []))
+    assert [rule.id for rule in agent_b.rules.strict_rules_for(hv)] == ["r_b4"]
+    assert agent_b.local_ans(hv, agent_b.rules)
+
+    extended_rules = agent_b.create_extended_rules([Rule("r_fk", Term("FK", Literal("pbc(m1)")), [])])
+    assert len(extended_rules) == len(agent_b.rules) + 1
+    assert agent_b.look_for_similar_term(Term("X", Literal("pbc(m1)")), extended_rules) is not None
+
+
+def test_extended_rules_built_once_per_context():
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    context = system.new_query_context(Term(agent_a, Literal("col(m1)")), agent_a, focus_knowledge_base)
+
+    extended_rules = agent_a.get_extended_rules(context)
+    assert agent_a.get_extended_rules(context) is extended_rules
+
+    system.end_query_context(context)
+    assert context.id not in agent_a.extended_rules_by_context
+
+    agent_a.initialize_query(Term(agent_a, Literal("col(m1)")), focus_knowledge_base)
+    assert all(not agent.extended_rules_by_context for agent in system.agents.values())
+
+
+def test_async_query_matches_sync_query():
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+
+    for agent_id in ("A", "B", "E"):
+        for literal in (Literal("col(m1)", False), Literal("ed(m1)", False), Literal("spa(m1)")):
+            system = create_scenario_mushroom_hunters()
+            sync_answer = system.agents[agent_id].initialize_query(Term(system.agents[agent_id], literal),
+                                                                   focus_knowledge_base)
+            system = create_scenario_mushroom_hunters()
+            loop = asyncio.new_event_loop()
+            try:
+                async_answer = loop.run_until_complete(
+                    system.aquery(Term(system.agents[agent_id], literal), focus_knowledge_base)
+                )
+            finally:
+                loop.close()
+
+            assert async_answer.truth_value == sync_answer.truth_value
+            assert term_key(async_answer.equivalent_term) == term_key(sync_answer.equivalent_term)
+
+
+@pytest.mark.parametrize("analyse_cycles", [False, True])
+@pytest.mark.parametrize("params", CYCLIC_SCENARIOS, ids=scenario_id)
+def test_async_query_matches_sync_query_with_cycles(params, analyse_cycles):
+    scenario = generate_scenario(params)
+    scenario.system.analyse_cycles = analyse_cycles
+    loop = asyncio.new_event_loop()
+    try:
+        answers = [loop.run_until_complete(scenario.system.aquery(term, scenario.focus_knowledge))
+                   for term in scenario.query_terms]
+    finally:
+        loop.close()
+
+    assert answer_keys(answers) == sync_answers(params)
+
+
+def test_async_query_asks_independent_agents_at_once():
+    system, focus_knowledge_base = fan_out_system(5)
+    in_flight = []
+    most_in_flight = []
+
+    def counted(method):
+
+        async def aquery(sender, term, context, hist=EMPTY_HISTORY):
+            in_flight.append(term)
+            most_in_flight.append(len(in_flight))
+            try:
+                await asyncio.sleep(0.01)
+                return await method(sender, term, context, hist)
+            finally:
+                in_flight.remove(term)
+
+        return aquery
+
+    for agent in list(system.agents.values())[1:]:
+        wrap_method(agent, "aquery", counted)
+    loop = asyncio.new_event_loop()
+    try:
+        answer = loop.run_until_complete(system.aquery(Term(system.agents["A"], Literal("q")), focus_knowledge_base))
+    finally:
+        loop.close()
+
+    assert answer.truth_value == TruthValue.TRUE
+    # the five agents asked about X:p are all asked before any of them answers
+    assert max(most_in_flight) >= 5
+    assert answer.context.messages == 10
+
+
+def test_iterative_query_matches_sync_query():
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+
+    for agent_id in ("A", "B", "E"):
+        for literal in (Literal("col(m1)", False), Literal("ed(m1)", False), Literal("spa(m1)")):
+            system = create_scenario_mushroom_hunters()
+            sync_answer = system.agents[agent_id].initialize_query(Term(system.agents[agent_id], literal),
+                                                                   focus_knowledge_base)
+            system = create_scenario_mushroom_hunters()
+            iterative_answer = system.query_iteratively(Term(system.agents[agent_id], literal), focus_knowledge_base)
+
+            assert iterative_answer.truth_value == sync_answer.truth_value
+            assert term_key(iterative_answer.equivalent_term) == term_key(sync_answer.equivalent_term)
+
+
+def test_iterative_query_is_not_bounded_by_recursion_limit():
+    depth = 2000
+    system, focus_knowledge_base = chain_system(depth)
+    agents = list(system.agents.values())
+
+    with pytest.raises(RecursionError):
+        agents[0].initialize_query(Term(agents[0], Literal("p0")), focus_knowledge_base)
+
+    answer = system.query_iteratively(Term(agents[0], Literal("p0")), focus_knowledge_base)
+    assert answer.truth_value == TruthValue.TRUE
+    assert len(answer.arg_tree.get_all_foreign_leaves()) == depth
+
+
+def test_term_met_again_before_being_answered_is_promised():
+    # A: a <- B: b <- A: a, so a is met again while its own evaluation is under way and nothing is memorized
+    # for it yet; asking A again would start the same evaluation over, until the recursion limit
+    def create_system():
+        system = MultiAgentSystem(lambda term1, term2: 1 if term1.literal == term2.literal else 0, 0.5)
+        agent_a, agent_b = Agent("A", system), Agent("B", system)
+        system.agents = {"A": agent_a, "B": agent_b}
+        term_a, term_b = Term(agent_a, Literal("a")), Term(agent_b, Literal("b"))
+        agent_a.rules = [Rule("r1", term_a, [term_b])]
+        agent_b.rules = [Rule("r2", term_b, [term_a])]
+        return system, term_a
+
+    system, term_a = create_system()
+    sync_answer = term_a.definer.initialize_query(term_a, [])
+    assert system.messages_sent == 2
+    system, term_a = create_system()
+    loop = asyncio.new_event_loop()
+    try:
+        async_answer = loop.run_until_complete(system.aquery(term_a, []))
+    finally:
+        loop.close()
+
+    for answer in (sync_answer, async_answer):
+        assert answer.truth_value == sync_answer.truth_value
+        assert answer.arg_tree.children[0].children[0].is_promise
+    assert system.messages_sent == 2
+
+
+def test_negated_term_expanded_again_without_progress_is_a_cycle():
+    # a <- a and ¬a <- ¬a: each negated branch expands the other term again under the same history, which
+    # used to go on until the recursion limit (and forever with the iterative engine)
+    system = MultiAgentSystem(lambda term1, term2: 1 if term1.literal == term2.literal else 0, 0.5)
+    agent = Agent("A", system)
+    system.agents = {agent.id: agent}
+    positive, negative = Term(agent, Literal("a")), Term(agent, Literal("a", False))
+    agent.rules = [Rule("r1", positive, [positive]), Rule("r2", negative, [negative])]
+
+    loop = asyncio.new_event_loop()
+    try:
+        async_answer = loop.run_until_complete(system.aquery(positive, []))
+    finally:
+        loop.close()
+    answers = [agent.initialize_query(positive, []), system.query_iteratively(positive, []), async_answer]
+
+    assert [answer.truth_value for answer in answers] == [TruthValue.UNDEFINED] * 3
+
+
+def test_literals_and_terms_are_interned():
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+
+    assert Literal("ed(m1)") is Literal("ed(m1)")
+    assert - Literal("ed(m1)") is Literal("ed(m1)", False)
+    assert - - Literal("ed(m1)") is Literal("ed(m1)")
+    assert Term(agent_a, Literal("col(m1)")) is Term(agent_a, Literal("col(m1)"))
+    assert - Term(agent_a, Literal("col(m1)")) is Term(agent_a, Literal("col(m1)", False))
+    assert Term(agent_a, Literal("col(m1)")) is not Term(create_scenario_mushroom_hunters().agents["A"],
+                                                         Literal("col(m1)"))
+
+    instantiated = InstantiatedTerm(agent_a, Literal("col(m1)"), Literal("col(m1)"), 1)
+    assert instantiated == Term(agent_a, Literal("col(m1)"))
+    assert instantiated in [Term(agent_a, Literal("col(m1)"))]
+    assert Term(agent_a, Literal("col(m1)")) in [instantiated]
+    assert - instantiated is Term(agent_a, Literal("col(m1)", False))
+
+
+def test_arg_tree_rank_is_kept_until_tree_changes():
+    system = create_scenario_mushroom_hunters()
+    agent_a, agent_b, agent_c = system.agents["A"], system.agents["B"], system.agents["C"]
+
+    leaf = ArgTree(SummarizedArgument(Term(agent_b, Literal("ed(m1)"))))
+    leaf.add_foreign_leaf(InstantiatedTerm(agent_b, Literal("hv(m1)"), Literal("hv(m1)"), 1))
+    tree = ArgTree(SummarizedArgument(Term(agent_a, Literal("col(m1)"))))
+    tree.add_foreign_leaf(InstantiatedTerm(agent_b, Literal("ed(m1)"), Literal("ed(m1)"), 1))
+    tree.add_child(leaf)
+
+    assert agent_a.calculate_arg_tree_rank(tree) == 0.8
+    assert tree.ranks == {"A": 0.8}
+    assert tree.get_all_foreign_leaves() is tree.get_all_foreign_leaves()
+
+    tree.add_foreign_leaf(InstantiatedTerm(agent_c, Literal("ed(m1)"), Literal("ed(m1)"), 0.5))
+    assert tree.ranks == dict()
+    assert agent_a.calculate_arg_tree_rank(tree) == pytest.approx(0.8 + 0.3)
+
+
+def test_empty_arg_tree_is_never_changed():
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+    agent_a.initialize_query(Term(agent_a, Literal("col(m1)", False)), Builder({}).build_rules(R_FOCUS_MUSHROOM))
+
+    assert agent_a.calculate_arg_tree_rank(NO_ARG_TREE) == 0
+    assert (NO_ARG_TREE.ranks, NO_ARG_TREE.support_bits, NO_ARG_TREE.children) == (dict(), 0, [])
+    with pytest.raises(TypeError):
+        NO_ARG_TREE.add_child(ArgTree())
+    assert pickle.loads(pickle.dumps(NO_ARG_TREE)) is NO_ARG_TREE
+
+
+def test_argument_arena_numbers_leaves_once_across_threads():
+    system = MultiAgentSystem()
+    agents = [Agent(str(n), system) for n in range(4)]
+    leaves = [InstantiatedTerm(agents[n % 4], Literal("l{}".format(n)), Literal("l{}".format(n)), 1)
+              for n in range(1000)]
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for _ in range(20):
+            arena = ArgumentArena()
+            codes = dict()
+            barrier = threading.Barrier(8)
+
+            def number(offset):
+                barrier.wait()
+                for leaf in leaves[offset % 2::2]:
+                    codes.setdefault(leaf, set()).add(arena.code_of(leaf))
+
+            threads = [threading.Thread(target=number, args=(offset,)) for offset in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+            assert len(arena.leaves) == len(leaves)
+            assert all(len(leaf_codes) == 1 and arena.leaves[next(iter(leaf_codes))] is leaf
+                       for leaf, leaf_codes in codes.items())
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+
+def test_support_set_keeps_first_leaf_of_a_term():
+    system = create_scenario_mushroom_hunters()
+    agent_a, agent_b = system.agents["A"], system.agents["B"]
+    arena = ArgumentArena()
+
+    def leaf(sim_degree):
+        return InstantiatedTerm(agent_b, Literal("ed(m1)"), Literal("ed(m1)"), sim_degree)
+
+    first = ArgTree(SummarizedArgument(Term(agent_b, Literal("p"))), arena=arena)
+    first.add_foreign_leaf(leaf(0.5))
+    second = ArgTree(SummarizedArgument(Term(agent_b, Literal("q"))), arena=arena)
+    second.add_foreign_leaf(leaf(1))
+    tree = ArgTree(SummarizedArgument(Term(agent_a, Literal("col(m1)"))), [first, second], arena=arena)
+
+    assert [term.sim_degree for term in tree.get_all_foreign_leaves()] == [0.5]
+    assert agent_a.calculate_arg_tree_rank(tree) == pytest.approx(0.4 * 0.5)
+    tree.add_foreign_leaf(leaf(1))
+    assert [term.sim_degree for term in tree.get_all_foreign_leaves()] == [1]
+
+    # a subtree from another context is numbered anew, and a tree copied (or sent) leaves its arena behind
+    other = ArgTree(SummarizedArgument(Term(agent_a, Literal("r"))), [second], arena=ArgumentArena())
+    other.add_foreign_leaf(InstantiatedTerm(agent_a, Literal("hv(m1)"), Literal("hv(m1)"), 1))
+    assert len(other.get_all_foreign_leaves()) == 2
+    copied = copy.copy(other)
+    assert copied.arena is None and copied.get_all_foreign_leaves() == other.get_all_foreign_leaves()
+
+
+def test_query_many_matches_separate_queries():
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    literals = (Literal("col(m1)", False), Literal("ed(m1)", False), Literal("spa(m1)"), Literal("hv(m1)"))
+
+    system = create_scenario_mushroom_hunters()
+    terms = [Term(system.agents[agent_id], literal) for agent_id in ("A", "B", "E") for literal in literals]
+    answers = system.query_many(terms, focus_knowledge_base)
+
+    assert list(answers) == terms
+    assert len(set(answer.context.id for answer in answers.values())) == 1
+    assert system.query_memory_stats()["entries"] == 0
+    for term, answer in answers.items():
+        separate_answer = term.definer.initialize_query(term, focus_knowledge_base)
+        assert answer.truth_value == separate_answer.truth_value
+        assert answer.equivalent_term == separate_answer.equivalent_term
+
+
+@pytest.mark.parametrize("reverse", [False, True], ids=["in order", "reversed"])
+@pytest.mark.parametrize("params", CYCLIC_SCENARIOS, ids=scenario_id)
+def test_query_many_matches_separate_queries_with_cycles(params, reverse):
+    scenario = generate_scenario(params)
+    terms = scenario.query_terms[::-1] if reverse else scenario.query_terms
+    answers = scenario.system.query_many(terms, scenario.focus_knowledge)
+
+    assert answer_keys(answers[term] for term in scenario.query_terms) == sync_answers(params)
+    assert scenario.system.query_memory_stats()["entries"] == 0
+
+    scenario = generate_scenario(params)
+    terms = scenario.query_terms[::-1] if reverse else scenario.query_terms
+    loop = asyncio.new_event_loop()
+    try:
+        answers = loop.run_until_complete(scenario.system.aquery_many(terms, scenario.focus_knowledge))
+    finally:
+        loop.close()
+
+    assert answer_keys(answers[term] for term in scenario.query_terms) == sync_answers(params)
+
+
+@pytest.mark.parametrize("configure", [
+    lambda system: None,
+    lambda system: system.memoize_similarity(max_entries=8),
+    lambda system: setattr(system, "share_answers", True),
+], ids=["own contexts", "bounded similarity cache", "shared answers"])
+def test_parallel_queries_match_serial_queries(configure):
+    params = CYCLIC_SCENARIOS[2].replace(query_count=30)
+    scenario = generate_scenario(params)
+    expected = [(answer.truth_value, term_key(answer.equivalent_term))
+                for answer in (term.definer.initialize_query(term, scenario.focus_knowledge)
+                               for term in scenario.query_terms)]
+
+    scenario = generate_scenario(params)
+    configure(scenario.system)
+    answers = scenario.system.query_in_parallel(scenario.query_terms * 4, scenario.focus_knowledge, max_workers=8)
+
+    assert [(answers[term].truth_value, term_key(answers[term].equivalent_term))
+            for term in scenario.query_terms] == expected
+    assert scenario.system.query_contexts == dict()
+    assert len(set(answer.context.id for answer in answers.values())) == len(answers)
+
+
+def test_budget_leaves_unexplored_branches_undefined():
+    system, focus_knowledge_base = chain_system(50)
+    term = Term(system.agents["A"], Literal("p0"))
+
+    answer = system.agents["A"].initialize_query(term, focus_knowledge_base, QueryBudget(max_messages=50))
+    assert answer.truth_value == TruthValue.TRUE and not answer.partial
+    assert answer.context.budget.messages == 50
+
+    for budget in (QueryBudget(max_messages=10), QueryBudget(max_depth=10), QueryBudget(time_limit=0)):
+        loop = asyncio.new_event_loop()
+        try:
+            answers = [system.agents["A"].initialize_query(term, focus_knowledge_base, budget),
+                       system.query_iteratively(term, focus_knowledge_base, budget),
+                       loop.run_until_complete(system.aquery(term, focus_knowledge_base, budget))]
+        finally:
+            loop.close()
+        assert [(answer.truth_value, answer.partial) for answer in answers] == [(TruthValue.UNDEFINED, True)] * 3
+        assert all(answer.context.budget.messages <= 10 for answer in answers)
+
+    system.analyse_cycles = True
+    answer = system.agents["A"].initialize_query(term, focus_knowledge_base, QueryBudget(max_depth=49))
+    assert (answer.truth_value, answer.partial) == (TruthValue.UNDEFINED, True)
+    assert answer.context.budget.messages == 49
+
+
+def test_budgeted_engines_agree():
+    scenario = generate_scenario(ScenarioParameters(rules_per_agent=20, cycle_density=0.1, similar_literals=2,
+                                                    similarity_spread=0.1, query_count=10))
+    for max_messages in (0, 5, 20, 1000):
+        budget = QueryBudget(max_messages=max_messages)
+        for term in scenario.query_terms:
+            answer = term.definer.initialize_query(term, scenario.focus_knowledge, budget)
+            iterative_answer = scenario.system.query_iteratively(term, scenario.focus_knowledge, budget)
+            assert (iterative_answer.truth_value, iterative_answer.partial) == (answer.truth_value, answer.partial)
+            assert answer.context.budget.messages <= max_messages
+            if not answer.partial:
+                assert answer.truth_value == term.definer.initialize_query(term, scenario.focus_knowledge).truth_value
+
+
+
+def test_verdict_only_answers_rebuild_their_argument_tree():
+    scenario = generate_scenario(ScenarioParameters(rules_per_agent=20, cycle_density=0.1, similar_literals=2,
+                                                    similarity_spread=0.1, query_count=10))
+    expected = [term.definer.initialize_query(term, scenario.focus_knowledge) for term in scenario.query_terms]
+
+    scenario.system.verdict_only = True
+    answers = [term.definer.initialize_query(term, scenario.focus_knowledge) for term in scenario.query_terms]
+    assert [answer.truth_value for answer in answers] == [answer.truth_value for answer in expected]
+    for answer, full_answer in zip(answers, expected):
+        if full_answer.argument is None:
+            assert answer.argument is None and answer.arg_tree is None
+            continue
+        assert answer.argument.get_all_foreign_leaves() == full_answer.argument.get_all_foreign_leaves()
+        assert answer.arg_tree is answer.argument and not isinstance(answer.arg_tree, ArgSummary)
+        assert answer.arg_tree.get_all_foreign_leaves() == full_answer.arg_tree.get_all_foreign_leaves()
+
+    system, focus_knowledge_base = chain_system(50)
+    term = Term(system.agents["A"], Literal("p0"))
+    answer = system.agents["A"].initialize_query(term, focus_knowledge_base)
+    system.verdict_only = True
+    summary = system.query_iteratively(term, focus_knowledge_base)
+    assert isinstance(summary.argument, ArgSummary)
+    assert summary.argument.rank(system.agents["A"].preference_function) == \
+        answer.arg_tree.rank(system.agents["A"].preference_function)
+    assert not summary.argument.children
+    assert copy.copy(summary.argument).get_all_foreign_leaves() == answer.arg_tree.get_all_foreign_leaves()
+    assert len(summary.arg_tree.children) == 1
+
+
+def test_cycle_analysis_finds_terms_met_again():
+    system = MultiAgentSystem(lambda term1, term2: 1 if term1.literal == term2.literal else 0, 0.5,
+                              analyse_cycles=True)
+    agent_a, agent_b = Agent("A", system), Agent("B", system)
+    system.agents = dict(A=agent_a, B=agent_b)
+    p, q, r, s, t = (Literal(symbol) for symbol in "pqrst")
+    agent_a.rules = [Rule("r1", Term(agent_a, p), [Term("X", q)]), Rule("r2", Term(agent_a, r), [Term("X", s)])]
+    agent_b.rules = [Rule("r3", Term(agent_b, q), [Term("X", p)]), Rule("r4", Term(agent_b, t), [Term(agent_b, t)])]
+    context = system.new_query_context(None, agent_a, [])
+
+    assert system.cycle_analysis.terms_on_cycles(context) == {Term(agent_a, p), Term(agent_b, q), Term(agent_b, t)}
+    assert agent_a.initialize_query(Term(agent_a, p), []).truth_value == TruthValue.UNDEFINED
+
+
+def test_history_is_shared_when_extended():
+    terms = [Term("X", Literal("p{}".format(n))) for n in range(40)]
+    history = History.of(terms)
+    extended = history.add(Term("X", Literal("q")))
+
+    assert len(history) == 40 and len(extended) == 41
+    assert extended.parent is history
+    assert all(term in extended for term in terms) and Term("X", Literal("q")) not in history
+    assert list(pickle.loads(pickle.dumps(extended))) == list(extended)
+
+
+def test_literal_directory_lists_agents_able_to_answer():
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+    context = system.new_query_context(None, agent_a, Builder({}).build_rules(R_FOCUS_MUSHROOM))
+    directory = system.literal_directory
+
+    assert directory.agent_ids_for(Term("X", Literal("ed(m1)", False)), context) == {"A", "B", "D"}
+    assert directory.agent_ids_for(Term("X", Literal("ed(m1)")), context) == {"C"}
+    assert directory.agent_ids_for(Term("X", Literal("hv(m1)")), context) == set(system.agents)
+    assert [agent.id for agent in agent_a.agents_to_ask(Term("X", Literal("ed(m1)")), context)] == ["C"]
+    # the agent itself is asked once
+    assert [agent.id for agent in agent_a.agents_to_ask(Term("X", Literal("ed(m1)", False)), context)] == \
+        ["A", "B", "D"]
+
+    system.agents["C"].rules.append(Rule("r_c2", Term(system.agents["C"], Literal("ed(m1)", False)), []))
+    assert directory.agent_ids_for(Term("X", Literal("ed(m1)", False)), context) == {"A", "B", "C", "D"}
+
+    system.end_query_context(context)
+    assert context.id not in directory._focus_matches_by_context
+
+
+if __name__ == "__main__":
+    test_scenario_mushroon_hunters()
@@ -0,0 +1,53 @@
+from benchmarks import benchmark_cases, compare, run_suite, run_sync
+from scenario_generator import ScenarioParameters, generate_scenario
+
+SMALL_PARAMETERS = ScenarioParameters(agent_count=3, rules_per_agent=6, chain_depth=2, similar_literals=1,
+                                      similarity_spread=0.2, query_count=3, seed=7)
+
+
+def test_generated_scenario_is_deterministic():
+    scenario = generate_scenario(SMALL_PARAMETERS)
+
+    assert scenario.rule_count == 18
+    assert sorted(scenario.system.agents) == ["ag0", "ag1", "ag2"]
+    assert scenario.tuple_rules == generate_scenario(SMALL_PARAMETERS).tuple_rules
+    assert all(len(rule.body) == 2 for agent in scenario.system.agents.values() for rule in agent.rules)
+
+
+def test_suite_results_compare_with_baseline():
+    cases = benchmark_cases(SMALL_PARAMETERS, dict(cycle_density=[0.0, 0.2]))
+    results = run_suite(cases, repeat=1, out=None)
+
+    assert list(results["cases"]) == ["base", "cycle_density=0.2"]
+    assert results["cases"]["base"]["messages"] > 0
+    assert compare(results, results) == []
+
+    baseline = dict(engine="sync", cases={name: dict(result) for name, result in results["cases"].items()})
+    baseline["cases"]["base"]["messages"] -= 1
+    assert compare(results, baseline, tolerance=float("inf")) == [
+        "base: messages {} != {}".format(results["cases"]["base"]["messages"], baseline["cases"]["base"]["messages"])
+    ]
+
+
+def test_iterative_engine_matches_sync_engine():
+    cases = benchmark_cases(SMALL_PARAMETERS, dict(cycle_density=[0.2], rules_per_agent=[10]))
+    sync_results = run_suite(cases, "sync", repeat=1, out=None)
+    iterative_results = run_suite(cases, "iterative", repeat=1, out=None)
+
+    for name, result in sync_results["cases"].items():
+        assert "error" not in result
+        assert iterative_results["cases"][name]["answers"] == result["answers"]
+        assert iterative_results["cases"][name]["messages"] == result["messages"]
+
+
+def test_cycle_analysis_keeps_answers():
+    params = SMALL_PARAMETERS.replace(cycle_density=0.3, rules_per_agent=10)
+    scenario = generate_scenario(params)
+    expected = [answer.truth_value for answer in run_sync(scenario)]
+
+    scenario = generate_scenario(params)
+    scenario.system.analyse_cycles = True
+    assert [answer.truth_value for answer in run_sync(scenario)] == expected
+    context = scenario.system.new_query_context(None, None, scenario.focus_knowledge)
+    terms_on_cycles = scenario.system.cycle_analysis.terms_on_cycles(context)
+    assert 0 < len(terms_on_cycles) < scenario.rule_count
@@ -0,0 +1,114 @@
+import mmap
+
+import pytest
+
+from agent_sync_arguments import Agent, Literal, Rule, Term
+from builders import Builder
+from compiled_kb import CompiledKnowledgeBase, SymbolTable, load_knowledge_base, load_system
+from mushroom_rules_examples import R_FOCUS_MUSHROOM, R_MUSHROOM
+from scenario_generator import ScenarioParameters, generate_scenario
+from test_agent_sync import create_scenario_mushroom_hunters, term_key
+
+
+def test_symbol_table_encodes_negation_as_sign():
+    symbols = SymbolTable()
+    ed = symbols.encode_string("ed(m1)")
+
+    assert symbols.encode_string("¬ed(m1)") == -ed
+    assert symbols.encode(Literal("ed(m1)", False)) == -ed
+    assert symbols.decode(-ed) == Literal("ed(m1)", False)
+    assert symbols.code_of(Literal("hv(m1)")) is None
+    assert len(symbols) == 1
+
+
+def mushroom_answers(system):
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    queries = [("A", Literal("col(m1)", False)), ("B", Literal("ed(m1)", False)), ("E", Literal("spa(m1)")),
+               ("C", Literal("ed(m1)"))]
+    return [(answer.truth_value, term_key(answer.equivalent_term))
+            for answer in (system.agents[agent_id].initialize_query(Term(system.agents[agent_id], literal),
+                                                                    focus_knowledge_base)
+                           for agent_id, literal in queries)]
+
+
+def test_compiled_rules_give_the_same_answers():
+    expected = mushroom_answers(create_scenario_mushroom_hunters())
+
+    system = create_scenario_mushroom_hunters()
+    knowledge_base = CompiledKnowledgeBase.from_tuple_rules(R_MUSHROOM)
+    knowledge_base.install(system)
+    assert [len(agent.rules) for agent in system.agents.values()] == [len(R_MUSHROOM[id_]) for id_ in system.agents]
+    assert mushroom_answers(system) == expected
+
+    agent = system.agents["C"]
+    rule = Rule("r_new", Term(agent, Literal("new")), [])
+    agent.rules.append(rule)
+    assert rule in agent.rules and agent.rules.has_head(rule.head)
+
+
+def test_compiled_rules_read_the_similarity_matrix():
+    expected = mushroom_answers(create_scenario_mushroom_hunters())
+
+    system = create_scenario_mushroom_hunters()
+    CompiledKnowledgeBase.from_tuple_rules(R_MUSHROOM).install(system)
+    system.precompute_similarity(rule.head.literal for rule in Builder({}).build_rules(R_FOCUS_MUSHROOM))
+    assert mushroom_answers(system) == expected
+
+    reference = create_scenario_mushroom_hunters()
+    reference.best_match = system.best_match = True
+    assert mushroom_answers(system) == mushroom_answers(reference)
+
+
+def test_compiled_rule_index_keeps_a_bounded_number_of_rules():
+    system = create_scenario_mushroom_hunters()
+    knowledge_base = CompiledKnowledgeBase.from_tuple_rules(R_MUSHROOM)
+    rule_index = knowledge_base.rule_index("A", system, max_rules=2)
+    rules = list(rule_index)
+    assert len(rules) == len(R_MUSHROOM["A"]) > 2
+    assert len(rule_index._rules) == 2
+    assert list(rule_index) == rules
+
+    # the terms are built again for the agents replacing those of the system
+    system.agents = dict(system.agents)
+    system.agents["A"] = agent = Agent("A", system)
+    assert all(head.definer is agent for head in rule_index.heads())
+    assert rule_index.rules_for(Term(agent, rules[0].head.literal))
+
+
+def test_compiled_knowledge_base_from_agents():
+    scenario = generate_scenario(ScenarioParameters(rules_per_agent=20, similar_literals=2, similarity_spread=0.1))
+    expected = [term.definer.initialize_query(term, scenario.focus_knowledge).truth_value
+                for term in scenario.query_terms]
+
+    knowledge_base = CompiledKnowledgeBase.from_agents(scenario.system.agents.values())
+    for agent in scenario.system.agents.values():
+        rules = list(agent.rules)
+        agent.load_rules(knowledge_base.rule_index(agent.id, scenario.system))
+        assert list(agent.rules) == rules
+        assert list(agent.rules.heads()) == list(dict.fromkeys(rule.head for rule in rules))
+
+    assert [term.definer.initialize_query(term, scenario.focus_knowledge).truth_value
+            for term in scenario.query_terms] == expected
+
+
+def test_saved_knowledge_base_is_loaded_memory_mapped(tmp_path):
+    reference = create_scenario_mushroom_hunters()
+    expected = mushroom_answers(reference)
+    path = str(tmp_path / "mushroom.kb")
+    CompiledKnowledgeBase.from_agents(reference.agents.values()).save(path)
+
+    knowledge_base = load_knowledge_base(path)
+    assert isinstance(knowledge_base.rule_head.base.obj, mmap.mmap)
+    assert not knowledge_base.rule_head.flags.writeable
+    assert list(knowledge_base.rule_ids[:2]) == [rule.id for rule in list(reference.agents["A"].rules)[:2]]
+
+    system = load_system(path, reference.similarity_function, reference.similarity_threshold)
+    assert system.agents["A"].preference_function == reference.agents["A"].preference_function
+    assert [[rule.id for rule in agent.rules] for agent in system.agents.values()] == \
+        [[rule.id for rule in agent.rules] for agent in reference.agents.values()]
+    assert mushroom_answers(system) == expected
+
+    with open(path, "r+b") as file:
+        file.write(b"NOTAKB!!")
+    with pytest.raises(ValueError):
+        load_knowledge_base(path)
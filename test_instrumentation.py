@@ -0,0 +1,132 @@
+import asyncio
+import io
+import json
+import sys
+
+from agent_sync_arguments import EMPTY_HISTORY, Literal, Term, wrap_method
+from builders import Builder
+from instrumentation import ChromeTraceSink, InMemorySink, JsonLinesSink, Tracer, term_label
+from mushroom_rules_examples import R_FOCUS_MUSHROOM
+from scenario_generator import generate_scenario
+from test_agent_sync import CYCLIC_SCENARIOS, create_scenario_mushroom_hunters, fan_out_system
+
+
+def test_tracer_records_calls_and_call_tree():
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+    term = Term(agent_a, Literal("col(m1)", False))
+    untraced = agent_a.initialize_query(term, Builder({}).build_rules(R_FOCUS_MUSHROOM))
+
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+    sink = InMemorySink()
+    lines = io.StringIO()
+    chrome = io.StringIO()
+    with Tracer(sink, JsonLinesSink(lines), ChromeTraceSink(chrome)).install(system):
+        answer = agent_a.initialize_query(Term(agent_a, Literal("col(m1)", False)),
+                                          Builder({}).build_rules(R_FOCUS_MUSHROOM))
+
+    assert answer.truth_value == untraced.truth_value
+    assert "query" not in vars(agent_a)
+
+    counters = sink.counters()
+    assert counters["messages_received"]["A"] >= 1
+    assert sum(counters["messages_sent"].values()) == counters["calls"]["query"]
+    assert counters["max_depth"] > 0
+    assert counters["similarity_calls"] > 0
+    assert counters["memory_misses"] > 0
+
+    roots = sink.call_tree(answer.context.id)
+    assert [(root["agent"], root["term"]) for root in roots] == [("A", "A:¬col(m1)")]
+    assert roots[0]["children"]
+
+    assert len(lines.getvalue().splitlines()) == len(sink.events)
+    assert len(json.loads(chrome.getvalue())["traceEvents"]) == len(sink.events)
+
+
+def run_async(query):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(query)
+    finally:
+        loop.close()
+
+
+def call_tree_shape(nodes):
+    return sorted((node["agent"], node["sender"], node["term"], call_tree_shape(node["children"])) for node in nodes)
+
+
+def test_tracer_records_calls_of_every_engine():
+    runs = dict(sync=lambda system, term, focus: term.definer.initialize_query(term, focus),
+                iterative=lambda system, term, focus: system.query_iteratively(term, focus),
+                asynchronous=lambda system, term, focus: run_async(system.aquery(term, focus)))
+    traces = dict()
+    for engine, run in runs.items():
+        system = create_scenario_mushroom_hunters()
+        sink = InMemorySink()
+        with Tracer(sink).install(system):
+            answer = run(system, Term(system.agents["A"], Literal("col(m1)", False)),
+                         Builder({}).build_rules(R_FOCUS_MUSHROOM))
+        assert "aquery" not in vars(system.agents["A"]) and "asimilarity" not in vars(system)
+        traces[engine] = (call_tree_shape(sink.call_tree(answer.context.id)), sink.counters())
+
+    sync_tree, sync_counters = traces["sync"]
+    assert sync_tree
+    for tree, counters in traces.values():
+        assert tree == sync_tree
+        assert counters["calls"] == sync_counters["calls"]
+        assert counters["max_depth"] == sync_counters["max_depth"]
+        assert counters["similarity_calls"] > 0
+
+
+def assert_nested_within_contexts(events):
+    spans = {event["id"]: event for event in events if "duration" in event}
+    for event in spans.values():
+        parent = spans.get(event["parent"])
+        if parent is None:
+            assert event["depth"] == 0
+        else:
+            assert (parent["context"], parent["depth"] + 1) == (event["context"], event["depth"])
+            assert parent["start"] <= event["start"]
+
+
+def test_tracer_keeps_parallel_queries_apart():
+    scenario = generate_scenario(CYCLIC_SCENARIOS[2].replace(query_count=30))
+    sink = InMemorySink()
+    switch_interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        with Tracer(sink).install(scenario.system):
+            answers = scenario.system.query_in_parallel(scenario.query_terms, scenario.focus_knowledge,
+                                                        max_workers=8)
+    finally:
+        sys.setswitchinterval(switch_interval)
+
+    assert_nested_within_contexts(sink.events)
+    for term, answer in answers.items():
+        roots = sink.call_tree(answer.context.id)
+        assert [(root["agent"], root["term"]) for root in roots] == [(term.definer.id, term_label(term))]
+
+
+def test_tracer_keeps_concurrent_coroutines_apart():
+    system, focus_knowledge_base = fan_out_system(5)
+
+    def delayed(method):
+
+        async def aquery(sender, term, context, hist=EMPTY_HISTORY):
+            await asyncio.sleep(0.01)
+            return await method(sender, term, context, hist)
+
+        return aquery
+
+    for agent in list(system.agents.values())[1:]:
+        wrap_method(agent, "aquery", delayed)
+    sink = InMemorySink()
+    with Tracer(sink).install(system):
+        answer = run_async(system.aquery(Term(system.agents["A"], Literal("q")), focus_knowledge_base))
+
+    assert_nested_within_contexts(sink.events)
+    roots = sink.call_tree(answer.context.id)
+    # the five agents are asked at once, and each one's query of its own s stays under its query of p
+    asked = [(agent_id, "A", "X:p", [(agent_id, agent_id, agent_id + ":s", [])]) for agent_id in "BCDEF"]
+    assert call_tree_shape(roots) == [("A", "A", "A:q", asked)]
@@ -0,0 +1,129 @@
+import asyncio
+
+import pytest
+
+from agent_sync_arguments import Literal, Term, Rule, focus_knowledge_fingerprint
+from builders import Builder
+from mushroom_rules_examples import R_FOCUS_MUSHROOM
+from query_memory import QueryMemory
+from scenario_generator import generate_scenario
+from test_agent_sync import CYCLIC_SCENARIOS, answer_keys, create_scenario_mushroom_hunters, scenario_id, sync_answers
+
+
+def test_query_memory_evicts_least_recently_used():
+    memory = QueryMemory(max_entries=2)
+    memory.keep(("q0", "a", "A"), 1)
+    memory.keep(("q0", "b", "A"), 2)
+    assert memory.get(("q0", "a", "A")) == 1
+    memory.keep(("q1", "c", "A"), 3)
+
+    assert ("q0", "b", "A") not in memory
+    assert memory.get(("q0", "b", "A")) is None
+    assert memory.stats() == dict(hits=1, misses=1, evictions=1, entries=2)
+
+    memory.end_context("q0")
+    assert list(memory.keys()) == [("q1", "c", "A")]
+
+
+def test_query_memory_never_evicts_answers_of_evaluations_under_way():
+    memory = QueryMemory(max_entries=3)
+    memory.keep(("q1", "c", "A"), 3)
+    memory[("q0", "a", "A")] = 1
+    memory[("q0", "b", "A")] = 2
+    memory[("q0", "d", "A")] = 4
+
+    assert list(memory.keys()) == [("q0", "a", "A"), ("q0", "b", "A"), ("q0", "d", "A")]
+    assert memory.stats()["evictions"] == 1
+
+
+@pytest.mark.parametrize("params", CYCLIC_SCENARIOS, ids=scenario_id)
+def test_bounded_query_memory_keeps_answers(params):
+    for share_answers in (False, True):
+        scenario = generate_scenario(params)
+        scenario.system.share_answers = share_answers
+        for agent in scenario.system.agents.values():
+            agent.query_memory.max_entries = 4
+        answers = [term.definer.initialize_query(term, scenario.focus_knowledge) for term in scenario.query_terms]
+
+        assert answer_keys(answers) == sync_answers(params)
+
+    scenario = generate_scenario(params)
+    for agent in scenario.system.agents.values():
+        agent.query_memory.max_entries = 4
+    answers = scenario.system.query_many(scenario.query_terms, scenario.focus_knowledge)
+
+    assert answer_keys(answers[term] for term in scenario.query_terms) == sync_answers(params)
+    assert scenario.system.query_memory_stats()["evictions"] > 0
+
+
+def test_ended_context_frees_query_memory():
+    system = create_scenario_mushroom_hunters()
+    agent_a = system.agents["A"]
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+
+    agent_a.initialize_query(Term(agent_a, Literal("col(m1)", False)), focus_knowledge_base)
+
+    stats = system.query_memory_stats()
+    assert stats["misses"] > 0
+    assert stats["entries"] == 0
+    assert system.query_contexts == dict()
+
+
+def test_contexts_with_same_focus_knowledge_share_answers():
+    system = create_scenario_mushroom_hunters()
+    system.share_answers = True
+    agent_a = system.agents["A"]
+    term = Term(agent_a, Literal("col(m1)", False))
+
+    first = agent_a.initialize_query(term, Builder({}).build_rules(R_FOCUS_MUSHROOM))
+    stats = system.query_memory_stats()
+    second = agent_a.initialize_query(term, Builder({}).build_rules(list(reversed(R_FOCUS_MUSHROOM))))
+
+    assert second.context.id != first.context.id
+    assert (second.truth_value, second.arg_tree) == (first.truth_value, first.arg_tree)
+    assert system.query_memory_stats()["misses"] == stats["misses"]
+
+    agent_a.rules.append(Rule("r_a4", term, []))
+    third = agent_a.initialize_query(term, Builder({}).build_rules(R_FOCUS_MUSHROOM))
+    assert third.context.memory_scope != first.context.memory_scope
+    # the answers of the scope left behind are dropped, no context uses it any more
+    assert all(key[0] == third.context.memory_scope
+               for agent in system.agents.values() for key in agent.query_memory.keys())
+
+
+@pytest.mark.parametrize("reverse", [False, True], ids=["in order", "reversed"])
+@pytest.mark.parametrize("params", CYCLIC_SCENARIOS, ids=scenario_id)
+def test_shared_answers_match_answers_of_own_contexts(params, reverse):
+    scenario = generate_scenario(params)
+    scenario.system.share_answers = True
+    terms = scenario.query_terms[::-1] if reverse else scenario.query_terms
+    answers = {term: term.definer.initialize_query(term, scenario.focus_knowledge) for term in terms}
+
+    assert answer_keys(answers[term] for term in scenario.query_terms) == sync_answers(params)
+    assert scenario.system.query_memory_stats()["hits"] > 0
+
+
+@pytest.mark.parametrize("params", CYCLIC_SCENARIOS[:3], ids=scenario_id)
+def test_interleaved_contexts_sharing_answers_match_answers_of_own_contexts(params):
+    scenario = generate_scenario(params)
+    scenario.system.share_answers = True
+
+    async def query_all():
+        return await asyncio.gather(*[scenario.system.aquery(term, scenario.focus_knowledge)
+                                      for term in scenario.query_terms])
+
+    loop = asyncio.new_event_loop()
+    try:
+        answers = loop.run_until_complete(query_all())
+    finally:
+        loop.close()
+
+    assert answer_keys(answers) == sync_answers(params)
+
+
+def test_focus_knowledge_fingerprint_ignores_order_and_definers():
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    renamed = [Rule(rule.id, Term("OTHER", rule.head.literal), rule.body) for rule in focus_knowledge_base]
+
+    assert focus_knowledge_fingerprint(focus_knowledge_base) == focus_knowledge_fingerprint(reversed(renamed))
+    assert focus_knowledge_fingerprint(focus_knowledge_base) != focus_knowledge_fingerprint(focus_knowledge_base[:1])
@@ -0,0 +1,59 @@
+import io
+
+import pytest
+
+from agent_sync_arguments import Literal, MultiAgentSystem, Term, TruthValue
+from mushroom_rules_examples import R_MUSHROOM
+from rule_files import RuleFileError, load_rule_file, load_rules, parse_rule_lines, write_rule_file
+from test_agent_sync import create_scenario_mushroom_hunters
+from test_compiled_kb import mushroom_answers
+
+
+def test_rule_file_loads_the_same_system(tmp_path):
+    reference = create_scenario_mushroom_hunters()
+    path = tmp_path / "mushroom.rules"
+    with open(path, "w", encoding="utf-8") as file:
+        file.write("# mushroom hunters\n\n")
+        write_rule_file(file, R_MUSHROOM)
+
+    system = MultiAgentSystem(reference.similarity_function, reference.similarity_threshold)
+    progress = []
+    count = load_rule_file(system, str(path), agent_ids=R_MUSHROOM, progress=lambda *args: progress.append(args),
+                           progress_every=4)
+    for agent_id, agent in reference.agents.items():
+        system.agents[agent_id].preference_function.update(agent.preference_function)
+
+    assert count == sum(len(rules) for rules in R_MUSHROOM.values())
+    assert progress == [(6, 4), (10, 8), (11, 9)]
+    assert system.agents["E"].rules.rules_for(list(system.agents["E"].rules)[0].head)[0].body[0].definer is \
+        system.agents["E"]
+    assert mushroom_answers(system) == mushroom_answers(reference)
+
+
+def test_malformed_rules_are_reported_with_line_numbers():
+    lines = io.StringIO("A\tr1\tA:p\tX:q\nA\tr2\tA:p\tq\n\nA\tr3\nA\tr4\tA:¬\nA\tr5\tA:¬p\n")
+
+    with pytest.raises(RuleFileError, match="line 2"):
+        list(parse_rule_lines(lines, "kb.rules"))
+
+    lines.seek(0)
+    errors = []
+    system = MultiAgentSystem(lambda term1, term2: 1, 0.5)
+    assert load_rules(system, parse_rule_lines(lines, "kb.rules", errors.append)) == 2
+    assert [(error.source, error.line_number) for error in errors] == [("kb.rules", 2), ("kb.rules", 4),
+                                                                       ("kb.rules", 5)]
+    assert [rule.id for rule in system.agents["A"].rules] == ["r1", "r5"]
+
+
+def test_definer_with_rules_later_in_the_file_is_bound_to_its_agent():
+    lines = io.StringIO("A\tr1\tA:p\tB:q\tX:s\nB\tr2\tB:q\nC\tr3\tC:s\n")
+    system = MultiAgentSystem(lambda term1, term2: 1 if term1.literal == term2.literal else 0, 0.5)
+
+    assert load_rules(system, parse_rule_lines(lines)) == 3
+
+    body = system.agents["A"].rules.rules_for(Term(system.agents["A"], Literal("p")))[0].body
+    assert body[0].definer is system.agents["B"]
+    assert body[1].definer == "X"
+    assert sorted(system.agents) == ["A", "B", "C"]
+    answer = system.agents["A"].initialize_query(Term(system.agents["A"], Literal("p")), [])
+    assert answer.truth_value == TruthValue.TRUE
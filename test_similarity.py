@@ -0,0 +1,165 @@
+import numpy
+
+from agent_sync_arguments import Agent, Literal, MultiAgentSystem, Rule, RuleIndex, Term
+from builders import Builder
+from mushroom_rules_examples import R_FOCUS_MUSHROOM
+from similarity import SimilarityCache, SimilarityMatrix
+from test_agent_sync import create_scenario_mushroom_hunters, term_key
+
+
+def test_similarity_cache_evicts_least_recently_used_pairs():
+    calls = []
+
+    def similarity_function(term1, term2):
+        calls.append((term1.literal, term2.literal))
+        return 1 if term1.literal == term2.literal else 0
+
+    cache = SimilarityCache(similarity_function, max_entries=2)
+    a, b, c = (Term("X", Literal(symbol)) for symbol in "abc")
+    assert cache.similarity(a, a) == 1
+    assert cache.similarity(a, b) == 0
+    assert cache.similarity(Term("A", Literal("a")), Term("B", Literal("a"))) == 1
+    cache.similarity(a, c)
+
+    assert len(calls) == 3
+    assert cache.stats() == dict(hits=1, misses=3, evictions=1, entries=2)
+    assert (Literal("a"), Literal("b")) not in cache.degrees
+
+
+def test_similarity_matrix_masks_degrees_under_threshold():
+    literals = [Literal("a"), Literal("b"), Literal("c")]
+    matrix = SimilarityMatrix(literals, numpy.array([[1, 0.2, 0.6], [0.2, 1, 0.5], [0.6, 0.5, 1]]), 0.5)
+
+    assert matrix.similarity(Literal("a"), Literal("c")) == 0.6
+    assert matrix.similarity(Literal("a"), Literal("d")) is None
+    rows = matrix.rows_of([Literal("a"), Literal("b"), Literal("d")])
+    assert matrix.similar_to(rows, Literal("c"), 0.5).tolist() == [True, True, False]
+    assert matrix.similar_to(rows, Literal("c"), 0.55).tolist() == [True, False, False]
+    assert matrix.similar_to(rows, Literal("d"), 0.5) is None
+
+
+def test_memoized_and_precomputed_similarity_keep_answers():
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    queries = [("A", Literal("col(m1)", False)), ("B", Literal("ed(m1)", False)), ("E", Literal("spa(m1)"))]
+
+    def answers(system):
+        return [(answer.truth_value, term_key(answer.equivalent_term))
+                for answer in (system.agents[agent_id].initialize_query(Term(system.agents[agent_id], literal),
+                                                                        focus_knowledge_base)
+                               for agent_id, literal in queries)]
+
+    expected = answers(create_scenario_mushroom_hunters())
+
+    system = create_scenario_mushroom_hunters()
+    cache = system.memoize_similarity()
+    assert answers(system) == expected
+    assert cache.stats()["hits"] > 0
+
+    system = create_scenario_mushroom_hunters()
+    matrix = system.precompute_similarity(rule.head.literal for rule in focus_knowledge_base)
+    function_calls = []
+    similarity_function = system.similarity_function
+    system.similarity_function = lambda term1, term2: function_calls.append(1) or similarity_function(term1, term2)
+    assert answers(system) == expected
+    assert Literal("hv(m1)") in matrix and Literal("ed(m1)", False) in matrix
+    assert function_calls == []
+
+
+def test_first_match_reads_the_similarity_matrix():
+    degrees = {("b", "a"): 0.2, ("c", "a"): 0.6, ("d", "a"): 0.9}
+    calls = []
+
+    def similarity_function(term1, term2):
+        calls.append(term1.literal.symbol)
+        if term1.literal == term2.literal:
+            return 1
+        return degrees.get((term1.literal.symbol, term2.literal.symbol), 0.7)
+
+    system = MultiAgentSystem(similarity_function, 0.5)
+    agent = Agent("A", system)
+    system.agents = dict(A=agent)
+    agent.rules = [Rule("r_" + symbol, Term(agent, Literal(symbol)), []) for symbol in "bcd"]
+    term = Term("X", Literal("a"))
+    by_function = agent.look_for_similar_term(term, agent.rules)
+
+    system.precompute_similarity([Literal("a")])
+    agent.rules.append(Rule("r_e", Term(agent, Literal("e")), []))
+    agent.rules.append(Rule("r_a", Term(agent, Literal("a")), []))
+    del calls[:]
+    assert (by_function.literal, by_function.sim_degree) == (Literal("c"), 0.6)
+    assert agent.look_for_similar_term(term, agent.rules).literal == Literal("a")
+    agent.rules = [rule for rule in agent.rules if rule.id != "r_a"]
+    by_matrix = agent.look_for_similar_term(term, agent.rules)
+    assert (by_matrix.literal, by_matrix.sim_degree) == (Literal("c"), 0.6)
+    assert calls == []
+
+    # heads outside the vocabulary are still asked to the function, in the order of the rules
+    system.similarity_threshold = 0.95
+    assert agent.look_for_similar_term(term, agent.rules) is None
+    assert calls == ["e"]
+
+
+def test_extended_rules_encode_only_their_own_heads():
+    literals = [Literal(symbol) for symbol in "abc"]
+    matrix = SimilarityMatrix(literals, numpy.eye(3), 0.5)
+    base = RuleIndex(Rule("r_" + symbol, Term("A", Literal(symbol)), []) for symbol in "ab")
+    extended = [RuleIndex([Rule("f_" + symbol, Term("A", Literal(symbol)), []) for symbol in symbols], base=base)
+                for symbols in ("ca", "d")]
+
+    encoded = [index.encoded_heads(matrix) for index in extended]
+    assert [heads for heads, _ in encoded] == [list(index.heads()) for index in extended]
+    assert [rows.tolist() for _, rows in encoded] == [[0, 1, 2], [0, 1, -1]]
+
+    encoded_literals = []
+    rows_of = matrix.rows_of
+
+    def logged_rows_of(literals):
+        literals = list(literals)
+        encoded_literals.extend(literals)
+        return rows_of(literals)
+
+    matrix.rows_of = logged_rows_of
+    extended.append(RuleIndex([Rule("f_b", Term("A", Literal("b")), [])], base=base))
+    assert extended[-1].encoded_heads(matrix)[1].tolist() == [0, 1]
+    assert encoded_literals == []
+    base.append(Rule("r_c", Term("A", Literal("c")), []))
+    assert extended[0].encoded_heads(matrix)[1].tolist() == [0, 1, 2]
+    assert encoded_literals == literals
+
+
+def test_memoized_similarity_calls_the_current_function():
+    system = MultiAgentSystem(lambda term1, term2: 0, 0.5)
+    cache = system.memoize_similarity()
+    system.similarity_function = lambda term1, term2: 1
+    assert system.similarity(Term("X", Literal("a")), Term("X", Literal("b"))) == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_best_match_picks_most_similar_head():
+    degrees = {("b", "a"): 0.6, ("c", "a"): 0.9, ("d", "a"): 0.9}
+
+    def similarity_function(term1, term2):
+        if term1.literal == term2.literal:
+            return 0.9
+        return degrees.get((term1.literal.symbol, term2.literal.symbol), 0)
+
+    system = MultiAgentSystem(similarity_function, 0.5)
+    agent = Agent("A", system)
+    system.agents = dict(A=agent)
+    agent.rules = [Rule("r_" + symbol, Term(agent, Literal(symbol)), []) for symbol in "bcd"]
+    term = Term("X", Literal("a"))
+
+    assert agent.look_for_similar_term(term, agent.rules).literal == Literal("b")
+
+    system.best_match = True
+    by_function = agent.look_for_similar_term(term, agent.rules)
+    system.precompute_similarity([Literal("a")])
+    by_matrix = agent.look_for_similar_term(term, agent.rules)
+    # c and d are tied: the first one wins
+    assert (by_function.literal, by_function.sim_degree) == (Literal("c"), 0.9)
+    assert (by_matrix.literal, by_matrix.sim_degree) == (Literal("c"), 0.9)
+
+    # ... unless a head holds the queried literal itself
+    agent.rules.append(Rule("r_a", Term(agent, Literal("a")), []))
+    assert agent.look_for_similar_term(term, agent.rules).literal == Literal("a")
+    assert agent.look_for_similar_term(Term("X", Literal("e")), agent.rules) is None
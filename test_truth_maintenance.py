@@ -0,0 +1,89 @@
+from agent_sync_arguments import Term, TruthValue
+from builders import Builder
+from instrumentation import InMemorySink, Tracer
+from mushroom_rules_examples import R_FOCUS_MUSHROOM
+from test_agent_sync import create_scenario_mushroom_hunters, term_key
+from truth_maintenance import TruthMaintenance
+
+QUERIES = [("A", "¬col(m1)"), ("B", "¬ed(m1)"), ("C", "ed(m1)"), ("D", "¬ed(m1)"), ("E", "spa(m1)")]
+
+
+def query_terms(system):
+    return [Term(system.agents[agent_id], Builder({}).build_literal(literal)) for agent_id, literal in QUERIES]
+
+
+def fresh_answers(changes, focus_rules=()):
+    system = create_scenario_mushroom_hunters()
+    for change in changes:
+        change(system)
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM + list(focus_rules))
+    return [(answer.truth_value, term_key(answer.equivalent_term))
+            for answer in (term.definer.initialize_query(term, focus_knowledge_base) for term in query_terms(system))]
+
+
+def monitored_answers(maintenance, system):
+    return [(answer.truth_value, term_key(answer.equivalent_term))
+            for answer in (maintenance.answers[term] for term in query_terms(system))]
+
+
+def add_rule(agent_id, tuple_rule):
+
+    def change(system):
+        system.agents[agent_id].rules.append(Builder(system.agents).build_rule(tuple_rule))
+
+    return change
+
+
+def test_answers_are_kept_up_to_date():
+    system = create_scenario_mushroom_hunters()
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    with TruthMaintenance(system, focus_knowledge_base) as maintenance:
+        for term in query_terms(system):
+            maintenance.monitor(term)
+        assert monitored_answers(maintenance, system) == fresh_answers([])
+        assert maintenance.refresh() == {}
+
+        changes = [add_rule("E", ("r_e2", ("E", "zz(m1)"), []))]
+        changes[0](system)
+        assert maintenance.refresh() == {}
+
+        changes.append(add_rule("C", ("r_c2", ("C", "avl(m1)"), [])))
+        changes[-1](system)
+        refreshed = maintenance.refresh()
+        assert refreshed and len(refreshed) < len(QUERIES)
+        assert monitored_answers(maintenance, system) == fresh_answers(changes)
+
+        def prefer_b(system_):
+            system_.agents["A"].preference_function["B"] = 0.9
+
+        changes.append(prefer_b)
+        prefer_b(system)
+        assert maintenance.refresh()[query_terms(system)[0]].truth_value == TruthValue.TRUE
+        assert monitored_answers(maintenance, system) == fresh_answers(changes)
+
+        focus_rule = ("r_fk3", ("FK", "am(m1)"), [])
+        maintenance.add_focus_rule(Builder({}).build_rule(focus_rule))
+        maintenance.refresh()
+        assert monitored_answers(maintenance, system) == fresh_answers(changes, [focus_rule])
+
+    assert "query" not in vars(system.agents["A"])
+    assert not any(agent.query_memory.entries for agent in system.agents.values())
+
+
+def test_traced_while_kept_up_to_date():
+    system = create_scenario_mushroom_hunters()
+    focus_knowledge_base = Builder({}).build_rules(R_FOCUS_MUSHROOM)
+    sink = InMemorySink()
+    tracer = Tracer(sink).install(system)
+    with TruthMaintenance(system, focus_knowledge_base) as maintenance:
+        # the tracer is removed first, while the truth maintenance still records the dependencies
+        tracer.uninstall()
+        traced_events = len(sink.events)
+        for term in query_terms(system):
+            maintenance.monitor(term)
+        assert len(sink.events) == traced_events
+        assert maintenance.dependencies
+        assert monitored_answers(maintenance, system) == fresh_answers([])
+
+    agent_a = system.agents["A"]
+    assert "query" not in vars(agent_a) and "get" not in vars(agent_a.query_memory)
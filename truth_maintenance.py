@@ -0,0 +1,257 @@
+from functools import partial
+from typing import Dict, Hashable, Iterable, Tuple
+
+from agent_sync_arguments import (EMPTY_HISTORY, Agent, Answer, MultiAgentSystem, Rule, StaticRule, Term,
+                                  unwrap_method, wrap_method)
+
+
+class TruthMaintenance:
+    """
+    Keeps the answers to a standing set of monitored terms up to date as the knowledge changes, recomputing only
+    the answers affected by a change (sync engine).
+
+    The monitored terms are evaluated under a context of their own, which is kept open. While they are evaluated,
+    each answer an agent memorizes (an evaluation: asker id, term, answering agent id) records what it depends
+    on: the answers it used, the rules of the answering agent for the term it matched and for its negation,
+    the strict rules (local_ans), the heads the term was matched against, the agents a body member was routed
+    to, and the preferences of the agents comparing arguments. When something changes, the evaluations
+    depending on it, and the ones depending on those, are removed from the query memory; refresh evaluates the
+    monitored terms again, reusing every answer left in the memory. An answer met again through a cycle depends
+    on all the evaluations under way, so a change within a cycle invalidates the whole of it.
+
+    Rules appended to the agents and changes to their preference functions are found by refresh; rules given
+    anew (Agent.rules = ...) or new agents invalidate everything. Focus rules are added with add_focus_rule and
+    changes to the similarity degrees are reported with similarity_changed.
+    """
+    WRAPPED_CALLS = ("query", "find_support", "local_ans", "agents_to_ask", "stronger", "has_memorized")
+
+    def __init__(self, system: MultiAgentSystem, focus_knowledge: Iterable[Rule]):
+        self.system = system
+        self.context = system.new_query_context(None, None, list(focus_knowledge))
+        # the answers are kept under the context itself, as a shared scope would change with every new rule
+        self.context.memory_scope = self.context.id
+        self.answers = dict()
+        self.stack = []
+        self.dependencies = dict()
+        self.dependents = dict()
+        self.matched_terms = dict()
+        self.routed_terms = set()
+        self.invalidated = 0
+        self.installed = dict()
+        self.snapshots = dict()
+        for agent in system.agents.values():
+            self._install(agent)
+
+    def monitor(self, term: Term) -> Answer:
+        answer = self.answers[term] = term.definer.answer_in_context(term, self.context)
+        return answer
+
+    def add_focus_rule(self, rule: Rule):
+        self.context.focus_knowledge.append(rule)
+        for agent in self.system.agents.values():
+            local_rule = agent.convert_focus_rule_to_local(rule)
+            extended_rules = agent.extended_rules_by_context.get(self.context.id)
+            if extended_rules is not None:
+                extended_rules.append(local_rule)
+            self._rule_added(agent, local_rule)
+        # the agents matching a term through the focus knowledge are found again
+        self.system.literal_directory.end_query_context(self.context)
+        self.system.cycle_analysis.end_query_context(self.context)
+
+    def similarity_changed(self, *literals):
+        """
+        Invalidates the answers depending on the similarity degrees of the given literals (all of them when
+        none is given), e.g. after changing the similarity function or the similarity matrix.
+        """
+        if self.system.similarity_cache is not None:
+            self.system.similarity_cache.clear()
+        self.system.literal_directory.knowledge_version = None
+        self.system.cycle_analysis.knowledge_version = None
+        literals = set(literals)
+        for agent_id, terms in list(self.matched_terms.items()):
+            for term in list(terms):
+                if not literals or term.literal in literals:
+                    self._invalidate(("match", agent_id, term))
+        for term in list(self.routed_terms):
+            if not literals or term.literal in literals:
+                self._invalidate(("route", term))
+
+    def refresh(self) -> Dict[Term, Answer]:
+        """
+        Finds the changes to the agents' rules and preferences, and evaluates again the monitored terms whose
+        answers were invalidated. Returns their new answers.
+        """
+        for agent in list(self.system.agents.values()):
+            if agent not in self.installed:
+                self._install(agent)
+                self._reset()
+                continue
+            generation, version, preferences = self.snapshots[agent]
+            if agent.rules_version[0] != generation:
+                agent.extended_rules_by_context.pop(self.context.id, None)
+                self._reset()
+            else:
+                for rule in agent.rules.added_since(version):
+                    self._rule_added(agent, rule)
+            if agent.preference_function != preferences:
+                self._preferences_changed(agent)
+            self.snapshots[agent] = self._snapshot(agent)
+
+        refreshed = dict()
+        for term in self.answers:
+            if (self.context.memory_scope, term, term.definer.id) not in term.definer.query_memory:
+                refreshed[term] = self.monitor(term)
+        return refreshed
+
+    def close(self):
+        for wrapped in self.installed.values():
+            for obj, name, wrapper in wrapped:
+                unwrap_method(obj, name, wrapper)
+        self.installed = dict()
+        self.system.end_query_context(self.context)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _snapshot(self, agent: Agent) -> Tuple[int, int, dict]:
+        generation, version = agent.rules_version
+        return generation, version, dict(agent.preference_function)
+
+    def _install(self, agent: Agent):
+        wrapped = [(agent, name, partial(getattr(self, "_" + name), agent)) for name in self.WRAPPED_CALLS]
+        wrapped.append((agent.query_memory, "get", partial(self._memory_get, agent)))
+        for obj, name, wrapper in wrapped:
+            wrap_method(obj, name, wrapper)
+        self.installed[agent] = wrapped
+        self.snapshots[agent] = self._snapshot(agent)
+
+    def _depend(self, dependency: Hashable):
+        if self.stack:
+            evaluation = self.stack[-1]
+            self.dependencies.setdefault(evaluation, set()).add(dependency)
+            self.dependents.setdefault(dependency, set()).add(evaluation)
+
+    def _invalidate(self, dependency: Hashable):
+        pending = list(self.dependents.pop(dependency, ()))
+        while pending:
+            evaluation = pending.pop()
+            if evaluation not in self.dependencies:
+                continue
+            for other_dependency in self.dependencies.pop(evaluation):
+                self.dependents.get(other_dependency, set()).discard(evaluation)
+            asker_id, term, agent_id = evaluation
+            self.system.agents[asker_id].query_memory.discard((self.context.memory_scope, term, agent_id))
+            self.invalidated += 1
+            pending.extend(self.dependents.pop(("answer", evaluation), ()))
+
+    def _reset(self):
+        for agent in self.system.agents.values():
+            agent.query_memory.end_context(self.context.memory_scope)
+        self.invalidated += len(self.dependencies)
+        self.dependencies = dict()
+        self.dependents = dict()
+        self.matched_terms = dict()
+        self.routed_terms = set()
+
+    def _similar(self, head: Term, term: Term) -> bool:
+        return self.system.similar_enough(self.system.similarity(head, term))
+
+    def _rule_added(self, agent: Agent, rule: Rule):
+        self._invalidate(("head", agent.id, rule.head))
+        if isinstance(rule, StaticRule):
+            self._invalidate(("strict", agent.id))
+        # the head may be a new one, which terms matched or routed before may now be matched with
+        for term in list(self.matched_terms.get(agent.id, ())):
+            if self._similar(rule.head, term):
+                self._invalidate(("match", agent.id, term))
+        for term in list(self.routed_terms):
+            if self._similar(rule.head, term):
+                self._invalidate(("route", term))
+
+    def _preferences_changed(self, agent: Agent):
+        self._invalidate(("preference", agent.id))
+        # the ranks kept by the argumentation trees still in the memory were given with the former preferences
+        pending = [entry[2] for other in self.system.agents.values()
+                   for key, entry in other.query_memory.entries.items() if key[0] == self.context.memory_scope]
+        seen = set()
+        while pending:
+            tree = pending.pop()
+            if tree is None or id(tree) in seen:
+                continue
+            seen.add(id(tree))
+            tree.ranks.pop(agent.id, None)
+            pending.extend(tree.children)
+
+    def _query(self, agent: Agent, method):
+
+        def query(sender, term, context, hist=EMPTY_HISTORY):
+            if context is not self.context:
+                return method(sender, term, context, hist)
+            evaluation = (sender.id, term, agent.id)
+            self._depend(("answer", evaluation))
+            self.stack.append(evaluation)
+            try:
+                self._depend(("match", agent.id, term))
+                self.matched_terms.setdefault(agent.id, set()).add(term)
+                return method(sender, term, context, hist)
+            finally:
+                self.stack.pop()
+
+        return query
+
+    def _find_support(self, agent: Agent, method):
+
+        def find_support(term, extended_rules, context, hist_p):
+            self._depend(("head", agent.id, Term(term.definer, term.literal)))
+            return method(term, extended_rules, context, hist_p)
+
+        return find_support
+
+    def _local_ans(self, agent: Agent, method):
+
+        def local_ans(term, extended_rules):
+            self._depend(("strict", agent.id))
+            return method(term, extended_rules)
+
+        return local_ans
+
+    def _agents_to_ask(self, agent: Agent, method):
+
+        def agents_to_ask(body_member, context):
+            if self.stack:
+                self._depend(("route", body_member))
+                self.routed_terms.add(body_member)
+            return method(body_member, context)
+
+        return agents_to_ask
+
+    def _stronger(self, agent: Agent, method):
+
+        def stronger(arg_tree1, arg_tree2):
+            self._depend(("preference", agent.id))
+            return method(arg_tree1, arg_tree2)
+
+        return stronger
+
+    def _has_memorized(self, agent: Agent, method):
+
+        def has_memorized(term, context):
+            # only asked about a term met again through a cycle, which may close on any evaluation under way
+            for evaluation in self.stack[:-1]:
+                self._depend(("answer", evaluation))
+            return method(term, context)
+
+        return has_memorized
+
+    def _memory_get(self, agent: Agent, method):
+
+        def get(key, default=None):
+            value = method(key, default)
+            if value is not default and key[0] == self.context.memory_scope:
+                self._depend(("answer", (agent.id, key[1], key[2])))
+            return value
+
+        return get